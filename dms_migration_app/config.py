@@ -1,8 +1,12 @@
 # Basic app properties
 APP_NAME = 'dms'
+REGION = 'us-east-1'
 SOURCE_TYPE = 'oracle' # can be  oracle|mysql|postgres
 FL_ETL_FILE = 'fl_processing.py'
 CDC_ETL_FILE = 'cdc_processing.py'
+EMR_MAX_TABLE_WORKERS = 4 # tables of a multi-table job run processed as concurrent Spark jobs
+EMR_RESULTS_FOLDER = 'emr-results' # status of every table of a multi-table job run
+ENV_NAME = 'dev' # -e of the EMR scripts, names the staging and artifact buckets and the CDC state table
 
 # DMS Replication Instance properties
 DMS_REPLICATION_INSTANCE = f'{APP_NAME}'
@@ -13,11 +17,78 @@ ENGINE_VERSION = '3.5.1'
 PUBLICLY_ACCESSIBLE = False
 REPLICATION_INSTANCE_ENGINE_VERSION ='3.5.1'
 RI_AVAILIBILITY_ZONE = 'us-east-1b'
+MAX_FULL_LOAD_SUB_TASKS = 49 # DMS allows at most 49 tables or segments loaded in parallel per task
+# Pool of replication instances created by the DmsStack. New tasks go to the least loaded instance with
+# fewer than max_tasks active tasks and max_bytes expected source bytes, or wait until one has room.
+DMS_REPLICATION_INSTANCE_POOL = [
+    {'id': DMS_REPLICATION_INSTANCE, 'class': REPLICATION_INSTANCE_CLASS, 'max_tasks': 4, 'max_bytes': 200 * 1024 ** 3},
+    {'id': f'{APP_NAME}-2', 'class': REPLICATION_INSTANCE_CLASS, 'max_tasks': 4, 'max_bytes': 200 * 1024 ** 3},
+]
+PLACEMENT_RETRY_SECONDS = 300 # wait before retrying the placement of a task when the pool is full
+PLACEMENT_TTL = 172800 # seconds a placement record is kept for a task never deleted
+REUSE_FULL_LOAD_TASKS = False # keep full-load tasks between runs and restart them with reload-target
+TASK_MODIFY_WAIT_SECONDS = 30 # wait before checking if a reused task finished its modification
+
+# Event driven waits, DMS and EMR Serverless state changes resume the executions through task tokens
+EVENT_WAIT_TIMEOUT_SECONDS = 1800 # wait for an event before falling back to polling
+POLL_MIN_SECONDS = 15 # first fallback poll interval, doubled after every poll
+POLL_MAX_SECONDS = 300 # poll interval cap, lowered to a quarter of the expected duration when known
+TASK_TOKEN_TTL = 86400
+
+# Parent workflow migrating a list or manifest of tables, one load execution per table
+MIGRATION_MAX_CONCURRENT_TABLES = 8 # tables of the source database migrated at once, the tasks per replication instance are capped by max_tasks of the pool
+MIGRATION_TIMEOUT_MINUTES = 1440
+MIGRATION_CONCURRENCY = min(MIGRATION_MAX_CONCURRENT_TABLES, sum(instance['max_tasks'] for instance in DMS_REPLICATION_INSTANCE_POOL)) # never more tables at once than the pool runs together
+
+# Parallel load split properties
+SPLIT_TARGET_ROWS_PER_SEGMENT = 10000000
+SPLIT_BOUNDARY_ROUND_MULTIPLE = 100000
+SPLIT_SKEW_THRESHOLD = 2.0 # segments above this multiple of the median rows are split again
+SPLIT_SECRET_CACHE_TTL = 300 # seconds the source secret is reused by warm get-splits invocations
+
+# DMS ARN cache properties
+ARN_CACHE_TTL = 86400 # seconds a resolved endpoint, instance or task ARN is reused by the DMS Lambdas
+
+# Small table packing properties
+PACK_MAX_TASK_BYTES = 20 * 1024 ** 3 # source bytes loaded by one packed task
+PACK_MAX_TABLES_PER_TASK = 100
+PACK_DEFAULT_TABLE_BYTES = 1024 ** 3 # size assumed for tables given without size_bytes
+
+# DMS task settings profiles, merged over the defaults and the recommendations from earlier runs.
+# 'default' applies to every task, 'cdc' to CDC tasks, the others are picked per table or per execution.
+TASK_SETTINGS_PROFILES = {
+    'default': {
+        'FullLoadSettings': {'CommitRate': 10000},
+        'TargetMetadata': {'ParallelLoadThreads': 0, 'ParallelLoadBufferSize': 50},
+    },
+    'cdc': {
+        'TargetMetadata': {'BatchApplyEnabled': True},
+        'ChangeProcessingTuning': {'BatchApplyPreserveTransaction': True},
+    },
+    'narrow': {
+        'FullLoadSettings': {'CommitRate': 50000},
+        'TargetMetadata': {'ParallelLoadThreads': 8, 'ParallelLoadBufferSize': 500},
+    },
+    'wide': {
+        'FullLoadSettings': {'CommitRate': 1000},
+        'TargetMetadata': {'ParallelLoadBufferSize': 10, 'SupportLobs': True, 'LimitedSizeLobMode': True, 'LobMaxSize': 32},
+    },
+    'lob': {
+        'FullLoadSettings': {'CommitRate': 1000},
+        'TargetMetadata': {'SupportLobs': True, 'FullLobMode': True, 'LimitedSizeLobMode': False, 'LobChunkSize': 64},
+    },
+}
+# 'SCHEMA.TABLE' to profile name
+TABLE_SETTINGS_PROFILES = {}
 
 # S3 properties
 S3_BUCKET_FOLDER ='dmstarget'
 S3_BUCKET_NAME ='test-dms-replication-blog'
 S3_DATAMART_BUCKET_NAME = 'blogdatamart'
+CDC_FILE_INDEX_TTL = 30 * 86400 # seconds a CDC file stays in the index, longer gaps between CDC runs are checked against S3
+CDC_FILE_INDEX_SETTLE_SECONDS = 300 # CDC files written this recently wait for the next run, their notifications can arrive out of order
+CDC_BATCH_TTL = 30 * 86400 # seconds the record of a processed CDC batch is kept
+CDC_PK_BUCKETS = 0 # primary key buckets of the staging tables, the CDC merge only rewrites the buckets of a batch; 0 rewrites the whole table
 
 # S3 Endpoint properties
 S3_ENDPOINT = 'dms-s3-endpoint'
@@ -45,15 +45,17 @@ class DmsStack(NestedStack):
               
        
 
-        dms_replication_instance = DmsReplicationInstance(self,
-                                                          'dms-instance',
-                                                          ri_identifier='dms',
-                                                          ri_class=config.REPLICATION_INSTANCE_CLASS,
-                                                          engine_version=config.ENGINE_VERSION,
-                                                          availability_zone=config.RI_AVAILIBILITY_ZONE,
-                                                          multi_az=False,
-                                                          publicly_accessible=False,
-                                                          subnet_group_id='dms-subnet-group')
+        # the first instance of the pool keeps the construct id of the former single instance
+        for index, instance in enumerate(config.DMS_REPLICATION_INSTANCE_POOL):
+            DmsReplicationInstance(self,
+                                   'dms-instance' if index == 0 else f'dms-instance-{instance["id"]}',
+                                   ri_identifier=instance['id'],
+                                   ri_class=instance.get('class', config.REPLICATION_INSTANCE_CLASS),
+                                   engine_version=config.ENGINE_VERSION,
+                                   availability_zone=instance.get('availability_zone', config.RI_AVAILIBILITY_ZONE),
+                                   multi_az=False,
+                                   publicly_accessible=False,
+                                   subnet_group_id='dms-subnet-group')
         # create source endpoints
         if config.SOURCE_TYPE.lower() == 'oracle':
             oracle_endpoint = DmsOracleEndpoint(self,
@@ -24,4 +24,88 @@ class DynamoDbStack(NestedStack):
                                           stream=dynamodb.StreamViewType.NEW_AND_OLD_IMAGES,
                                           removal_policy=removal_policy.DESTROY,
                             )
-        props['dynamodb_table'] = dynamodb_table
\ No newline at end of file
+        # run history of a table for the task settings recommendations
+        dynamodb_table.add_global_secondary_index(index_name='tablename-index',
+                                                  partition_key=dynamodb.Attribute(name='tablename',
+                                                                                    type=dynamodb.AttributeType.STRING),
+                            )
+        props['dynamodb_table'] = dynamodb_table
+        
+        split_cache_table = dynamodb.Table(self, 
+                                         'split-boundaries-table',
+                                          table_name='split-boundaries-table',
+                                          encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                                          partition_key=dynamodb.Attribute(name='split_key',
+                                                                            type=dynamodb.AttributeType.STRING),
+                                          removal_policy=removal_policy.DESTROY,
+                            )
+        props['split_cache_table'] = split_cache_table
+        
+        arn_cache_table = dynamodb.Table(self, 
+                                         'dms-arn-cache-table',
+                                          table_name='dms-arn-cache-table',
+                                          encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                                          partition_key=dynamodb.Attribute(name='resource_key',
+                                                                            type=dynamodb.AttributeType.STRING),
+                                          time_to_live_attribute='expires_at',
+                                          removal_policy=removal_policy.DESTROY,
+                            )
+        props['arn_cache_table'] = arn_cache_table
+        
+        placement_table = dynamodb.Table(self, 
+                                         'replication-placement-table',
+                                          table_name='replication-placement-table',
+                                          encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                                          partition_key=dynamodb.Attribute(name='replication_task_id',
+                                                                            type=dynamodb.AttributeType.STRING),
+                                          time_to_live_attribute='expires_at',
+                                          removal_policy=removal_policy.DESTROY,
+                            )
+        props['placement_table'] = placement_table
+        
+        task_generation_table = dynamodb.Table(self, 
+                                         'replication-task-generations',
+                                          table_name='replication-task-generations',
+                                          encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                                          partition_key=dynamodb.Attribute(name='replication_task_id',
+                                                                            type=dynamodb.AttributeType.STRING),
+                                          removal_policy=removal_policy.DESTROY,
+                            )
+        props['task_generation_table'] = task_generation_table
+        
+        task_token_table = dynamodb.Table(self, 
+                                         'task-token-table',
+                                          table_name='task-token-table',
+                                          encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                                          partition_key=dynamodb.Attribute(name='resource_id',
+                                                                            type=dynamodb.AttributeType.STRING),
+                                          time_to_live_attribute='expires_at',
+                                          removal_policy=removal_policy.DESTROY,
+                            )
+        props['task_token_table'] = task_token_table
+        
+        # CDC files written by DMS, fed by the S3 notifications of the DMS folder
+        cdc_file_index_table = dynamodb.Table(self, 
+                                         'cdc-file-index-table',
+                                          table_name='cdc-file-index-table',
+                                          encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                                          partition_key=dynamodb.Attribute(name='table_prefix',
+                                                                            type=dynamodb.AttributeType.STRING),
+                                          sort_key=dynamodb.Attribute(name='file_key', type=dynamodb.AttributeType.STRING),
+                                          time_to_live_attribute='expires_at',
+                                          removal_policy=removal_policy.DESTROY,
+                            )
+        props['cdc_file_index_table'] = cdc_file_index_table
+        
+        # CDC batches processed by cdc_processing.py, the range of files of every batch
+        cdc_batch_table = dynamodb.Table(self, 
+                                         'cdc-batch-table',
+                                          table_name='cdc-batch-table',
+                                          encryption=dynamodb.TableEncryption.AWS_MANAGED,
+                                          partition_key=dynamodb.Attribute(name='path',
+                                                                            type=dynamodb.AttributeType.STRING),
+                                          sort_key=dynamodb.Attribute(name='batch_end', type=dynamodb.AttributeType.STRING),
+                                          time_to_live_attribute='expires_at',
+                                          removal_policy=removal_policy.DESTROY,
+                            )
+        props['cdc_batch_table'] = cdc_batch_table
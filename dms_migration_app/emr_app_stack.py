@@ -40,6 +40,10 @@ class EmrJobStack(NestedStack):
 
         )                        
         
+        # the CDC processing reads the new files of a table from the CDC file index and records its batches
+        props['cdc_file_index_table'].grant_read_data(self.emr_role.emr_role_arn)
+        props['cdc_batch_table'].grant_write_data(self.emr_role.emr_role_arn)
+        
         props['emr_application_id'] = self.emr_serverless_job.emr_application_id
         props['emr_role_arn'] = self.emr_role.emr_role_arn.role_arn
         
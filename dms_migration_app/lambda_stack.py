@@ -1,10 +1,16 @@
 from aws_cdk import (
     aws_ec2 as ec2,
     CfnOutput,
+    BundlingOptions,
     NestedStack,
     aws_lambda as _lambda,
     aws_iam as iam,
+    aws_events as events,
+    aws_events_targets as targets,
+    aws_s3 as s3,
+    aws_s3_notifications as s3n,
 )
+import json
 from constructs import Construct
 from . import DataMigrationService
 from . import config
@@ -15,6 +21,18 @@ class LamdaStack(NestedStack):
         super().__init__(scope, id, **kwargs)
         
         dynamodb_table = props['dynamodb_table']
+        split_cache_table = props['split_cache_table']
+        arn_cache_table = props['arn_cache_table']
+        placement_table = props['placement_table']
+        task_generation_table = props['task_generation_table']
+        task_token_table = props['task_token_table']
+        cdc_file_index_table = props['cdc_file_index_table']
+        
+        source_secret_names = {
+            'oracle': config.ORACLE_SECRET_NAME,
+            'mysql': config.MYSQL_SECRET_ARN,
+            'postgres': config.POSTGRES_SECRET_ARN,
+        }
         
         iam_policy_getsplits = iam.ManagedPolicy(
             self,
@@ -39,7 +57,9 @@ class LamdaStack(NestedStack):
                     actions=['dms:DescribeEndpoints', 
                              'dms:DescribeReplicationInstances',
                              'dms:CreateReplicationTask',
-                             'dms:DescribeReplicationTask'],
+                             'dms:ModifyReplicationTask',
+                             'dms:DescribeReplicationTask',
+                             'dms:DescribeReplicationTasks'],
                     resources=['*'])
             ]
         )
@@ -74,13 +94,27 @@ class LamdaStack(NestedStack):
             ]
         )   
                 
-        # create a Lambda layer for cx_oracle which is used to connect to Oracle
-        oracle_layer = _lambda.LayerVersion(
-            self,
-            'OracleLayer',
-            code=_lambda.Code.from_asset(path="lambda_layer/layer.zip"),
-            compatible_runtimes=[_lambda.Runtime.PYTHON_3_9],
-            description='Oracle Connection layer for Python 3.9')
+        # the driver of the source engine for get-splits: the cx_Oracle layer built by hand with the Oracle
+        # Instant Client, see the README, or pymysql / psycopg2 installed from driver_layers/<source type>
+        if config.SOURCE_TYPE == 'oracle':
+            driver_layer = _lambda.LayerVersion(
+                self,
+                'OracleLayer',
+                code=_lambda.Code.from_asset(path="lambda_layer/layer.zip"),
+                compatible_runtimes=[_lambda.Runtime.PYTHON_3_9],
+                description='Oracle Connection layer for Python 3.9')
+        else:
+            driver_layer = _lambda.LayerVersion(
+                self,
+                f'{config.SOURCE_TYPE}-driver-layer',
+                code=_lambda.Code.from_asset(
+                    path=f"driver_layers/{config.SOURCE_TYPE}",
+                    bundling=BundlingOptions(
+                        image=_lambda.Runtime.PYTHON_3_9.bundling_image,
+                        command=['bash', '-c', 'pip install -r requirements.txt -t /asset-output/python'],
+                    )),
+                compatible_runtimes=[_lambda.Runtime.PYTHON_3_9],
+                description=f'{config.SOURCE_TYPE} Connection layer for Python 3.9')
         
         
         get_splits_lambda = _lambda.Function(self,
@@ -90,9 +124,18 @@ class LamdaStack(NestedStack):
                                               code=_lambda.Code.from_asset('lambda'),
                                               handler='get-splits.handler',
                                               vpc=props['vpc'],
-                                              layers=[oracle_layer],
+                                              layers=[driver_layer],
                                               environment={
                                                   'dynamodb_table': dynamodb_table.table_name,
+                                                  'split_cache_table': split_cache_table.table_name,
+                                                  'source_type': config.SOURCE_TYPE,
+                                                  'source_secret_name': source_secret_names[config.SOURCE_TYPE],
+                                                  'max_full_load_subtasks': str(config.MAX_FULL_LOAD_SUB_TASKS),
+                                                  'target_rows_per_segment': str(config.SPLIT_TARGET_ROWS_PER_SEGMENT),
+                                                  'boundary_round_multiple': str(config.SPLIT_BOUNDARY_ROUND_MULTIPLE),
+                                                  'skew_threshold': str(config.SPLIT_SKEW_THRESHOLD),
+                                                  'secret_region': config.REGION,
+                                                  'secret_cache_ttl': str(config.SPLIT_SECRET_CACHE_TTL),
                                                   'LD_LIBRARY_PATH' : '/var/lang/lib:/lib64:/usr/lib64:/var/runtime:/var/runtime/lib:/var/task:/var/task/lib:/opt/lib:/opt/python',
                                               }
                                             )
@@ -100,6 +143,7 @@ class LamdaStack(NestedStack):
         get_splits_lambda.role.add_managed_policy(iam_policy_getsplits)
         dynamodb_table.grant_read_write_data(get_splits_lambda.role)
         dynamodb_table.grant(get_splits_lambda.role, "dynamodb:DescribeTable")
+        split_cache_table.grant_read_write_data(get_splits_lambda.role)
         props['get_splits_lambda'] = get_splits_lambda
         
         if config.SOURCE_TYPE == 'oracle':
@@ -109,7 +153,8 @@ class LamdaStack(NestedStack):
                 'destination_endpoint_id': config.S3_ENDPOINT,
                 'replication_instance_id': config.DMS_REPLICATION_INSTANCE,
                 'dms_bucket_name':config.S3_BUCKET_NAME,
-                'dms_folder':config.S3_BUCKET_FOLDER
+                'dms_folder':config.S3_BUCKET_FOLDER,
+                'max_full_load_subtasks': str(config.MAX_FULL_LOAD_SUB_TASKS),
             }
         
         if config.SOURCE_TYPE == 'mysql':
@@ -119,7 +164,8 @@ class LamdaStack(NestedStack):
                 'destination_endpoint_id': config.S3_ENDPOINT,
                 'replication_instance_id': config.DMS_REPLICATION_INSTANCE,
                 'dms_bucket_name':config.S3_BUCKET_NAME,
-                'dms_folder':config.S3_BUCKET_FOLDER
+                'dms_folder':config.S3_BUCKET_FOLDER,
+                'max_full_load_subtasks': str(config.MAX_FULL_LOAD_SUB_TASKS),
             }
         if config.SOURCE_TYPE == 'postgres':
             lambdas_env_variables = {
@@ -128,9 +174,26 @@ class LamdaStack(NestedStack):
                 'destination_endpoint_id': config.S3_ENDPOINT,
                 'replication_instance_id': config.DMS_REPLICATION_INSTANCE,
                 'dms_bucket_name':config.S3_BUCKET_NAME,
-                'dms_folder':config.S3_BUCKET_FOLDER
+                'dms_folder':config.S3_BUCKET_FOLDER,
+                'max_full_load_subtasks': str(config.MAX_FULL_LOAD_SUB_TASKS),
             }
         
+        # ARNs resolved by one of the DMS Lambdas are shared with the others through the cache table
+        lambdas_env_variables['arn_cache_table'] = arn_cache_table.table_name
+        lambdas_env_variables['arn_cache_ttl'] = str(config.ARN_CACHE_TTL)
+        lambdas_env_variables['pack_max_task_bytes'] = str(config.PACK_MAX_TASK_BYTES)
+        lambdas_env_variables['pack_max_tables_per_task'] = str(config.PACK_MAX_TABLES_PER_TASK)
+        lambdas_env_variables['pack_default_table_bytes'] = str(config.PACK_DEFAULT_TABLE_BYTES)
+        lambdas_env_variables['task_settings_profiles'] = json.dumps(config.TASK_SETTINGS_PROFILES)
+        lambdas_env_variables['table_settings_profiles'] = json.dumps(config.TABLE_SETTINGS_PROFILES)
+        lambdas_env_variables['replication_instance_pool'] = json.dumps([
+            {'id': instance['id'], 'max_tasks': instance['max_tasks'], 'max_bytes': instance.get('max_bytes')}
+            for instance in config.DMS_REPLICATION_INSTANCE_POOL])
+        lambdas_env_variables['placement_table'] = placement_table.table_name
+        lambdas_env_variables['placement_ttl'] = str(config.PLACEMENT_TTL)
+        lambdas_env_variables['task_generation_table'] = task_generation_table.table_name
+        lambdas_env_variables['reuse_tasks'] = str(config.REUSE_FULL_LOAD_TASKS).lower()
+        
         create_task_lambda = _lambda.Function(self,
                                               'create-task-lambda',
                                               function_name='create-task-lambda',
@@ -145,6 +208,9 @@ class LamdaStack(NestedStack):
         
         dynamodb_table.grant_read_write_data(create_task_lambda.role)
         dynamodb_table.grant(create_task_lambda.role, "dynamodb:DescribeTable")
+        arn_cache_table.grant_read_write_data(create_task_lambda.role)
+        placement_table.grant_read_write_data(create_task_lambda.role)
+        task_generation_table.grant_read_write_data(create_task_lambda.role)
         create_task_lambda.role.add_managed_policy(iam_policy_createdmstask)
         props['create_task_lambda'] = create_task_lambda
         
@@ -161,6 +227,7 @@ class LamdaStack(NestedStack):
         
         dynamodb_table.grant_read_write_data(start_task_lambda.role)
         dynamodb_table.grant(start_task_lambda.role, "dynamodb:DescribeTable")
+        arn_cache_table.grant_read_write_data(start_task_lambda.role)
         start_task_lambda.role.add_managed_policy(iam_policy_startdmstask)
         props['start_task_lambda'] = start_task_lambda
         
@@ -178,6 +245,131 @@ class LamdaStack(NestedStack):
         
         dynamodb_table.grant_read_write_data(delete_task_lambda.role)
         dynamodb_table.grant(delete_task_lambda.role, "dynamodb:DescribeTable")
+        arn_cache_table.grant_read_write_data(delete_task_lambda.role)
+        placement_table.grant_read_write_data(delete_task_lambda.role)
         delete_task_lambda.role.add_managed_policy(iam_policy_deletedmstask)
         props['delete_task_lambda'] = delete_task_lambda
-        
\ No newline at end of file
+        
+        
+        iam_policy_taskstate = iam.ManagedPolicy(
+            self,
+            'task-state-policy',
+              managed_policy_name='TaskStatePolicy',
+            statements=[
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=['dms:DescribeReplicationTasks',
+                             'emr-serverless:GetJobRun',
+                             'states:SendTaskSuccess'],
+                    resources=['*'])
+            ]
+        )
+        
+        # Resumes the executions waiting on a task token when DMS or EMR Serverless report a state change,
+        # and polls the state for the executions whose wait timed out
+        task_state_lambda = _lambda.Function(self,
+                                              'task-state-lambda',
+                                              function_name='task-state-lambda',
+                                              runtime=_lambda.Runtime.PYTHON_3_9,
+                                              code=_lambda.Code.from_asset('lambda'),
+                                              handler='task-state.handler',
+                                              vpc=props['vpc'],
+                                              environment={
+                                                  'task_token_table': task_token_table.table_name,
+                                                  'task_token_ttl': str(config.TASK_TOKEN_TTL),
+                                                  'poll_min_seconds': str(config.POLL_MIN_SECONDS),
+                                                  'poll_max_seconds': str(config.POLL_MAX_SECONDS),
+                                              }
+                                            )
+        
+        task_token_table.grant_read_write_data(task_state_lambda.role)
+        task_state_lambda.role.add_managed_policy(iam_policy_taskstate)
+        props['task_state_lambda'] = task_state_lambda
+        
+        events.Rule(self,
+                    'dms-task-state-change-rule',
+                    rule_name='dms-task-state-change-rule',
+                    event_pattern=events.EventPattern(
+                        source=['aws.dms'],
+                        detail_type=['DMS Replication Task State Change'],
+                    ),
+                    targets=[targets.LambdaFunction(task_state_lambda)],
+                    )
+        
+        events.Rule(self,
+                    'emr-job-state-change-rule',
+                    rule_name='emr-job-state-change-rule',
+                    event_pattern=events.EventPattern(
+                        source=['aws.emr-serverless'],
+                        detail_type=['EMR Serverless Job Run State Change'],
+                    ),
+                    targets=[targets.LambdaFunction(task_state_lambda)],
+                    )
+        
+        iam_policy_migrationmanifest = iam.ManagedPolicy(
+            self,
+            'migration-manifest-policy',
+            managed_policy_name='MigrationManifestPolicy',
+            statements=[
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=['s3:GetObject'],
+                    resources=[f'arn:aws:s3:::{config.S3_BUCKET_NAME}/*'])
+            ]
+        )
+        
+        # Expands a list or manifest of tables into the inputs of the table executions and summarizes their results
+        migration_manifest_lambda = _lambda.Function(self,
+                                              'migration-manifest-lambda',
+                                              function_name='migration-manifest-lambda',
+                                              runtime=_lambda.Runtime.PYTHON_3_9,
+                                              code=_lambda.Code.from_asset('lambda'),
+                                              handler='migration-manifest.handler',
+                                              vpc=props['vpc'],
+                                              environment={
+                                                  'dynamodb_table': dynamodb_table.table_name,
+                                                  'migration_max_concurrency': str(config.MIGRATION_CONCURRENCY),
+                                              }
+                                            )
+        
+        migration_manifest_lambda.role.add_managed_policy(iam_policy_migrationmanifest)
+        dynamodb_table.grant_read_data(migration_manifest_lambda.role)
+        props['migration_manifest_lambda'] = migration_manifest_lambda
+        
+        iam_policy_cdcfileindexer = iam.ManagedPolicy(
+            self,
+            'cdc-file-indexer-policy',
+            managed_policy_name='CdcFileIndexerPolicy',
+            statements=[
+                iam.PolicyStatement(
+                    effect=iam.Effect.ALLOW,
+                    actions=['s3:ListBucket'],
+                    resources=[f'arn:aws:s3:::{config.S3_BUCKET_NAME}'])
+            ]
+        )
+        
+        # Indexes the CDC files written by DMS, the CDC processing reads the new files of a table from the
+        # index instead of listing the table prefix
+        cdc_file_indexer_lambda = _lambda.Function(self,
+                                              'cdc-file-indexer-lambda',
+                                              function_name='cdc-file-indexer-lambda',
+                                              runtime=_lambda.Runtime.PYTHON_3_9,
+                                              code=_lambda.Code.from_asset('lambda'),
+                                              handler='cdc-file-indexer.handler',
+                                              vpc=props['vpc'],
+                                              environment={
+                                                  'cdc_file_index_table': cdc_file_index_table.table_name,
+                                                  'cdc_file_index_ttl': str(config.CDC_FILE_INDEX_TTL),
+                                                  'dms_bucket_name': config.S3_BUCKET_NAME,
+                                                  'dms_folder': config.S3_BUCKET_FOLDER,
+                                              }
+                                            )
+        
+        cdc_file_index_table.grant_read_write_data(cdc_file_indexer_lambda.role)
+        cdc_file_indexer_lambda.role.add_managed_policy(iam_policy_cdcfileindexer)
+        props['cdc_file_indexer_lambda'] = cdc_file_indexer_lambda
+        
+        dms_bucket = s3.Bucket.from_bucket_name(self, 'dms-bucket', config.S3_BUCKET_NAME)
+        dms_bucket.add_event_notification(s3.EventType.OBJECT_CREATED,
+                                          s3n.LambdaDestination(cdc_file_indexer_lambda),
+                                          s3.NotificationKeyFilter(prefix=f'{config.S3_BUCKET_FOLDER}/'))
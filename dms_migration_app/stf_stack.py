@@ -14,8 +14,97 @@ from . import config
 
 class StfStack(NestedStack):
 
+    def event_wait(self, id, request, result_path, next_state):
+        # Waits for a DMS task or EMR Serverless job with a task token, the task-state Lambda sends it
+        # back when EventBridge reports the state change. When no event arrives before the timeout the
+        # state is polled and a new token is registered with a timeout growing after every poll, see
+        # task-state.py, so a load longer than the timeout is still resumed by its event.
+        register_token = _aws_stepfunctions_tasks.LambdaInvoke(
+            self,
+            f'{id} Register Token',
+            lambda_function=self.props['task_state_lambda'],
+            integration_pattern=_aws_stepfunctions.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+            payload=_aws_stepfunctions.TaskInput.from_object({
+                **request,
+                'action': 'register',
+                'token': _aws_stepfunctions.JsonPath.task_token,
+            }),
+            result_path=result_path,
+            timeout=Duration.seconds(config.EVENT_WAIT_TIMEOUT_SECONDS),
+        )
+        
+        # LambdaInvoke only takes a fixed timeout in this CDK version, TimeoutSecondsPath needs the raw state
+        register_token_again = _aws_stepfunctions.CustomState(
+            self, f'{id} Register Token Again',
+            state_json={
+                'Type': 'Task',
+                'Resource': 'arn:aws:states:::lambda:invoke.waitForTaskToken',
+                'Parameters': {
+                    'FunctionName': self.props['task_state_lambda'].function_arn,
+                    'Payload': {**request, 'action': 'register', 'token.$': '$$.Task.Token'},
+                },
+                'TimeoutSecondsPath': '$.poll.wait_seconds',
+                'ResultPath': result_path,
+                'Catch': [{'ErrorEquals': ['States.Timeout'], 'ResultPath': '$.WaitError', 'Next': f'{id} Poll State'}],
+            },
+        )
+        
+        start_polling = _aws_stepfunctions.Pass(
+            self, f'{id} Start Polling',
+            result=_aws_stepfunctions.Result.from_object({'wait_seconds': 0}),
+            result_path='$.poll',
+        )
+        
+        poll_state = _aws_stepfunctions_tasks.LambdaInvoke(
+            self,
+            f'{id} Poll State',
+            lambda_function=self.props['task_state_lambda'],
+            payload=_aws_stepfunctions.TaskInput.from_object({
+                **request,
+                'action': 'poll',
+                'wait_seconds.$': '$.poll.wait_seconds',
+            }),
+            payload_response_only=True,
+            result_path='$.poll',
+        )
+        
+        poll_result = _aws_stepfunctions.Pass(
+            self, f'{id} Poll Result',
+            input_path='$.poll.result',
+            result_path=result_path,
+        )
+        
+        check_poll = _aws_stepfunctions.Choice(self,
+                                                f'{id} Check Poll',
+                                                comment='Check if the polled state ends the wait',
+                                                )
+        check_poll.when(_aws_stepfunctions.Condition.boolean_equals('$.poll.done', True), poll_result)
+        check_poll.otherwise(register_token_again)
+        
+        register_token.add_catch(start_polling, errors=[_aws_stepfunctions.Errors.TIMEOUT], result_path='$.WaitError')
+        register_token.next(next_state)
+        start_polling.next(poll_state).next(check_poll)
+        register_token_again.next(next_state)
+        poll_result.next(next_state)
+        
+        return register_token
+
+    def default_input(self, id, field, value, next_state):
+        # A path to a field missing from the input fails the state, an optional field of the table input is
+        # set to its default before the states that read it
+        set_default = _aws_stepfunctions.Pass(
+            self, f'Default {id}',
+            result=_aws_stepfunctions.Result.from_string(value),
+            result_path=f'$.{field}',
+        )
+        check_field = _aws_stepfunctions.Choice(self, f'Check {id}', comment=f'Check if the input has {field}')
+        check_field.when(_aws_stepfunctions.Condition.is_not_present(f'$.{field}'), set_default.next(next_state))
+        check_field.otherwise(next_state)
+        return check_field
+
     def __init__(self, scope: Construct, id: str, props, **kwargs) -> None:
         super().__init__(scope, id, **kwargs)
+        self.props = props
         
                
         fail_job = _aws_stepfunctions.Fail(
@@ -108,58 +197,6 @@ class StfStack(NestedStack):
             output_path='$.Payload',
         )
         
-        describe_task = _aws_stepfunctions_tasks.CallAwsService(
-            self,
-            'DescribeTask',
-            service='databasemigration',
-            action='describeReplicationTasks',
-            parameters= {
-                   'Filters': [
-                       {
-                           'Name':'replication-task-arn',
-                           'Values.$':'States.Array($.ReplicationTaskArn)'
-                        }
-                    ],
-                   'MaxRecords':20,
-                   'Marker':""
-                },
-            iam_resources=['*'],
-            result_path='$.ReplicationDetails',
-            additional_iam_statements=[
-                    iam.PolicyStatement(
-                        actions=["dms:DescribeReplicationTasks"],
-                        resources=["*"]
-                    )
-                ],
-       
-        )
-        
-        check_task_status = _aws_stepfunctions_tasks.CallAwsService(
-            self,
-            'CheckTaskCreationStatus',
-            service='databasemigration',
-            action='describeReplicationTasks',
-            parameters= {
-                   'Filters': [
-                       {
-                           'Name':'replication-task-arn',
-                           'Values.$':'States.Array($.ReplicationTaskArn)'
-                        }
-                    ],
-                   'MaxRecords':20,
-                   'Marker':""
-                },
-            iam_resources=['*'],
-            result_path='$.ReplicationDetails',
-            additional_iam_statements=[
-                    iam.PolicyStatement(
-                        actions=["dms:DescribeReplicationTasks"],
-                        resources=["*"]
-                    )
-                ],
-       
-        )
-        
         describe_table_stats = _aws_stepfunctions_tasks.CallAwsService(
             self,
             'DescribeTableStatistics',
@@ -197,31 +234,6 @@ class StfStack(NestedStack):
                 ],
         )
         
-        wait_full_load_completion = _aws_stepfunctions.Wait(
-            self, "Wait 100s for task completion",
-            time=_aws_stepfunctions.WaitTime.duration(
-                Duration.seconds(100))
-        )
-        
-        wait_for_completion = _aws_stepfunctions.Wait(
-            self, "Wait for task completion",
-            time=_aws_stepfunctions.WaitTime.duration(
-                Duration.seconds(100))
-        )
-        
-        wait_for_job_creation = _aws_stepfunctions.Wait(
-            self, "Wait for job creation",
-            time=_aws_stepfunctions.WaitTime.duration(
-                Duration.seconds(100))
-        )        
-        
-        wait_task_creation = _aws_stepfunctions.Wait(
-            self, "Wait 100s Seconds for task creation",
-            time=_aws_stepfunctions.WaitTime.duration(
-                Duration.seconds(100))
-        )
-        
-        
         submit_fl_emr_step = _aws_stepfunctions_tasks.CallAwsService(
             self,
             'SubmitFlEmrServerlessStep',
@@ -243,7 +255,7 @@ class StfStack(NestedStack):
                             --conf spark.executor.instances=1 \
                             --conf spark.dynamicAllocation.maxExecutors=12 \
                             ",
-                        "EntryPointArguments.$": "States.Array('-src', $.src_schema_name, '-t', $.src_table_name, '-tgt', $.tgt_schema_name )",
+                        "EntryPointArguments.$": f"States.Array('-src', $.src_schema_name, '-t', $.src_table_name, '-tgt', $.tgt_schema_name, '-p', $.primary_key, '-e', '{config.ENV_NAME}', '--pk-buckets', '{config.CDC_PK_BUCKETS}')",
                         }
                     }
                 },
@@ -286,7 +298,7 @@ class StfStack(NestedStack):
                             --conf spark.executor.instances=1 \
                             --conf spark.dynamicAllocation.maxExecutors=12 \
                             ",
-                        "EntryPointArguments.$": "States.Array('-src', $.src_schema_name, '-t', $.src_table_name, '-tgt', $.tgt_schema_name )",
+                        "EntryPointArguments.$": f"States.Array('-s', $.src_schema_name, '-t', $.src_table_name, '-b', '{config.S3_BUCKET_NAME}', '-e', '{config.ENV_NAME}', '-p', $.primary_key, '--taskid', $.replication_task_id, '--file-index', '{props['cdc_file_index_table'].table_name}', '--index-settle-seconds', '{config.CDC_FILE_INDEX_SETTLE_SECONDS}', '--index-ttl', '{config.CDC_FILE_INDEX_TTL}', '--batch-table', '{props['cdc_batch_table'].table_name}', '--batch-ttl', '{config.CDC_BATCH_TTL}', '--pk-buckets', '{config.CDC_PK_BUCKETS}')",
                         }
                     }
                 },
@@ -309,28 +321,6 @@ class StfStack(NestedStack):
         )
         
 
-        check_emr_step_status = _aws_stepfunctions_tasks.CallAwsService(
-            self,
-            'CheckEmrServerlessStepStatus',
-            service='EMRServerless',
-            action='getJobRun',
-            iam_resources=["*"],
-            parameters={
-                "ApplicationId":props["emr_application_id"],
-                "JobRunId.$":"$.EmrStep['JobRunId']",
-            },
-            result_path="$.EmrStepStatus",
-
-        )
-        
-        wait_for_step_completion = _aws_stepfunctions.Wait(
-            self, "Wait 100s Seconds for EMR Step Completion",
-            time=_aws_stepfunctions.WaitTime.duration(
-                Duration.seconds(100))
-        )
-        
-        wait_for_step_completion.next(check_emr_step_status)
-        
         evaluate_step_status = _aws_stepfunctions.Choice(self,
                                                     'Evaluate EMR Step Status',
                                                     comment='Evaluate EMR Step Status',
@@ -348,7 +338,62 @@ class StfStack(NestedStack):
         
         evaluate_step_status.when(_aws_stepfunctions.Condition.or_(
             _aws_stepfunctions.Condition.string_equals("$.EmrStepStatus['JobRun']['State']", "FAILED"),
-            _aws_stepfunctions.Condition.string_equals("$.EmrStepStatus['JobRun']['State']", "CANCELLED")),send_failure_task).otherwise(wait_for_step_completion)
+            _aws_stepfunctions.Condition.string_equals("$.EmrStepStatus['JobRun']['State']", "CANCELLED")),send_failure_task)
+                
+        # Packed tables are processed by one job run, the tables run as concurrent Spark jobs of one session
+        # and every table reports its status in the results file
+        submit_multi_table_emr_step = _aws_stepfunctions_tasks.CallAwsService(
+            self,
+            'SubmitMultiTableEmrServerlessStep',
+            service='EMRServerless',
+            action='startJobRun',
+            parameters= {
+                    "ApplicationId": props["emr_application_id"],
+                    "ClientToken.$": "States.UUID()",
+                    "ExecutionRoleArn": props["emr_role_arn"],
+                    "Name": "fl-multi-table-step",
+                    "JobDriver": {
+                        "SparkSubmit": {
+                        "EntryPoint": f"s3://{config.S3_BUCKET_NAME}/scripts/{config.FL_ETL_FILE}",
+                        "SparkSubmitParameters":
+                            "--conf spark.executor.cores=2 \
+                            --conf spark.executor.memory=4g \
+                            --conf spark.driver.cores=2 \
+                            --conf spark.driver.memory=8g \
+                            --conf spark.executor.instances=1 \
+                            --conf spark.dynamicAllocation.maxExecutors=12 \
+                            ",
+                        "EntryPointArguments.$": f"States.Array('-tgt', $.tgt_schema_name, '--tables-json', States.JsonToString($.tables), '--max-workers', '{config.EMR_MAX_TABLE_WORKERS}', '-e', '{config.ENV_NAME}', '--pk-buckets', '{config.CDC_PK_BUCKETS}', '--results', States.Format('s3://{config.S3_BUCKET_NAME}/{config.EMR_RESULTS_FOLDER}/{{}}.json', $$.Execution.Name))",
+                        }
+                    }
+                },
+            iam_resources=['*'],
+            result_path="$.EmrStep",
+            additional_iam_statements=[
+                    iam.PolicyStatement(
+                        actions=["emr-serverless:*"],
+                        resources=["*"]
+                    ),
+                    iam.PolicyStatement(
+                        actions=["iam:PassRole"],
+                        resources=["*"]
+                    ),
+                    iam.PolicyStatement(
+                        actions=["s3:*"],
+                        resources=[f"arn:aws:s3:::{config.S3_BUCKET_NAME}"]
+                    ),
+                ],
+        )
+        
+        # the job run output has the shape of getJobRun so the Choice reads the state from the same path
+        emr_job_request = {
+            'resource_type': 'emr-job',
+            'wait_for': 'completion',
+            'resource_id.$': "$.EmrStep['JobRunId']",
+            'application_id': props["emr_application_id"],
+        }
+        wait_for_emr_job = self.event_wait('EMR Job Completion', emr_job_request, '$.EmrStepStatus', evaluate_step_status)
+        evaluate_step_status.otherwise(wait_for_emr_job)
                 
         task_completed_chain = describe_table_stats.next(delete_replication_task)
         task_failure_chain = fail_job
@@ -370,9 +415,24 @@ class StfStack(NestedStack):
         eval_task_status.when(_aws_stepfunctions.Condition.string_equals("$.ReplicationDetails['ReplicationTasks'][0]['Status']","stopped"), task_completed_chain)
         eval_task_status.when(_aws_stepfunctions.Condition.string_equals("$.ReplicationDetails['ReplicationTasks'][0]['Status']","failed"), task_failure_chain).otherwise(check_cdc_task)
         
-        start_full_load_task_chain = start_replciation_task.next(wait_full_load_completion).next(describe_task).next(eval_task_status)
-        
-        check_fl_completion_chain = wait_for_completion.next(describe_task)
+        # The DMS Choice states read the status from the describeReplicationTasks output, the task-state
+        # Lambda returns the same shape. A stop only ends the completion wait when the task was started
+        # after task_started_at, a reused task is still stopped from its last run right after the start.
+        dms_task_request = {
+            'resource_type': 'dms-task',
+            'resource_id.$': '$.ReplicationTaskArn',
+            'task_type.$': '$.task_type',
+            'started_at.$': '$.task_started_at',
+            'expected_seconds.$': '$.expected_seconds',
+        }
+        wait_task_creation = self.event_wait('Task Creation', {**dms_task_request, 'wait_for': 'creation'},
+                                             '$.ReplicationDetails', eval_task_status)
+        wait_task_completion = self.event_wait('Task Completion', {**dms_task_request, 'wait_for': 'completion'},
+                                               '$.ReplicationDetails', eval_task_status)
+        
+        start_full_load_task_chain = start_replciation_task.next(wait_task_completion)
+        
+        check_fl_completion_chain = wait_task_completion
         
        
         #check_cdc_task.when(_aws_stepfunctions.Condition.string_equals("$.ReplicationDetails['ReplicationTasks'][0]['Status']", "ready").and_(_aws_stepfunctions.Condition.string_equals('$.task_type','full-load')), start_full_load_task_chain)
@@ -388,12 +448,20 @@ class StfStack(NestedStack):
                                                     'check-fl-cdc-step',
                                                     comment='Check if the task is FL or CDC',
                                                     )
-        submit_cdc_emr_step.next(wait_for_job_creation).next(check_emr_step_status).next(evaluate_step_status)
-        submit_fl_emr_step.next(wait_for_job_creation)
+        submit_cdc_emr_step.next(wait_for_emr_job)
+        submit_fl_emr_step.next(wait_for_emr_job)
+        submit_multi_table_emr_step.next(wait_for_emr_job)
         
         check_fl_cdc_task.when(_aws_stepfunctions.Condition.string_equals("$.task_type", "cdc"), submit_cdc_emr_step).otherwise(submit_fl_emr_step)
         
-        definition_lake_processing = check_fl_cdc_task   
+        check_table_list = _aws_stepfunctions.Choice(self,
+                                                    'check-table-list',
+                                                    comment='Check if the job run processes a list of tables',
+                                                    )
+        check_table_list.when(_aws_stepfunctions.Condition.is_present('$.tables'), submit_multi_table_emr_step).otherwise(
+            self.default_input('Job Primary Key', 'primary_key', '', check_fl_cdc_task))
+        
+        definition_lake_processing = check_table_list   
         
         sm_lake_processing = _aws_stepfunctions.StateMachine(
             self, "StateMachineLakeProcessing",
@@ -414,6 +482,8 @@ class StfStack(NestedStack):
                                                                     "src_table_name.$": "$.table_name",
                                                                     "tgt_schema_name.$": "$.tgt_schema_name",
                                                                     "tgt_table_name.$": "$.tgt_table_name",
+                                                                    "primary_key.$": "$.primary_key",
+                                                                    "replication_task_id.$": "$.replication_task_id",
                                                                     "AWS_STEP_FUNCTIONS_STARTED_BY_EXECUTION_ID.$": "$$.Execution.Id"
                                                                 }),
                                                             result_path="$.FlStf",
@@ -421,8 +491,206 @@ class StfStack(NestedStack):
                                                             )
             
 
-        task_completed_chain.next(lake_processing_sm_state)
-        definition_fl = get_splits_task.next(create_replciation_task).next(wait_task_creation).next(check_task_status).next(eval_task_status)
+        task_completed_chain.next(self.default_input('Primary Key', 'primary_key', '', lake_processing_sm_state))
+        
+        # Fan-out of one table over a group of full-load tasks, each group task runs its own
+        # start/monitor loop inside the Map state and the group is deleted once all of them stopped
+        create_task_group = _aws_stepfunctions_tasks.LambdaInvoke(
+            self,
+            'Create Replication Task Group',
+            lambda_function=props['create_task_lambda'],
+            output_path='$.Payload',
+        )
+        
+        start_group_task = _aws_stepfunctions_tasks.LambdaInvoke(
+            self,
+            'Start Group Replication Task',
+            lambda_function=props['start_task_lambda'],
+            output_path='$.Payload',
+        )
+        
+        describe_group_table_stats = _aws_stepfunctions_tasks.CallAwsService(
+            self,
+            'DescribeGroupTableStatistics',
+            service='databasemigration',
+            action='describeTableStatistics',
+            parameters= {
+                'ReplicationTaskArn.$':'$.ReplicationTaskArn',
+                },
+            result_path='$.TableStatistics',
+            iam_resources=['*'],
+            additional_iam_statements=[
+                    iam.PolicyStatement(
+                        actions=["dms:DescribeTableStatistics"],
+                        resources=["*"]
+                    )
+                ],
+        )
+        
+        group_task_failed = _aws_stepfunctions.Fail(
+            self, "Group Task Failed",
+            cause='Replication task of the task group failed',
+            error='DescribeJob returned FAILED'
+        )
+        
+        group_task_succeeded = _aws_stepfunctions.Succeed(
+            self, "Group Task Succeeded",
+            comment='Replication task of the task group stopped'
+        )
+        
+        eval_group_task_status = _aws_stepfunctions.Choice(self,
+                                                    'evaluate-group-replication-task',
+                                                    comment='Evaluate Group Replication Task Status',
+                                                    )
+        
+        wait_group_task_creation = self.event_wait('Group Task Creation', {**dms_task_request, 'wait_for': 'creation'},
+                                                   '$.ReplicationDetails', eval_group_task_status)
+        wait_group_task = self.event_wait('Group Task Completion', {**dms_task_request, 'wait_for': 'completion'},
+                                          '$.ReplicationDetails', eval_group_task_status)
+        describe_group_table_stats.next(group_task_succeeded)
+        start_group_task.next(wait_group_task)
+        
+        eval_group_task_status.when(_aws_stepfunctions.Condition.string_equals("$.ReplicationDetails['ReplicationTasks'][0]['Status']","stopped"), describe_group_table_stats)
+        eval_group_task_status.when(_aws_stepfunctions.Condition.string_equals("$.ReplicationDetails['ReplicationTasks'][0]['Status']","failed"), group_task_failed)
+        eval_group_task_status.when(_aws_stepfunctions.Condition.string_equals("$.ReplicationDetails['ReplicationTasks'][0]['Status']","ready"), start_group_task).otherwise(wait_group_task)
+        
+        replicate_task_group = _aws_stepfunctions.Map(
+            self, 'Replicate Task Group',
+            items_path='$.task_group',
+            max_concurrency=0,
+            parameters={
+                'replication_task_id.$': '$$.Map.Item.Value.replication_task_id',
+                'ReplicationTaskArn.$': '$$.Map.Item.Value.ReplicationTaskArn',
+                'task_group_id.$': '$.replication_task_id',
+                'task_type.$': '$.task_type',
+                'tables.$': '$$.Map.Item.Value.tables',
+                'task_started_at.$': '$.task_started_at',
+                'expected_seconds.$': '$.expected_seconds',
+            },
+            result_path='$.TaskGroupResults',
+        )
+        replicate_task_group.iterator(wait_group_task_creation)
+        
+        delete_task_group = _aws_stepfunctions_tasks.LambdaInvoke(
+            self,
+            'Delete Replication Task Group',
+            lambda_function=props['delete_task_lambda'],
+            output_path='$.Payload',
+        )
+        
+        # Packed tasks load many small tables each, one lake processing run processes all of them
+        packed_lake_processing = _aws_stepfunctions_tasks.StepFunctionsStartExecution(self,
+                                                            'StartPackedLakeProcessingStf',
+                                                            state_machine=sm_lake_processing,
+                                                            integration_pattern=_aws_stepfunctions.IntegrationPattern.WAIT_FOR_TASK_TOKEN,
+                                                            input=_aws_stepfunctions.TaskInput.from_object({
+                                                                    "token": _aws_stepfunctions.JsonPath.task_token,
+                                                                    "StatePayload.$": "$.task_type",
+                                                                    "task_type.$": "$.task_type",
+                                                                    "tables.$": "$.tables",
+                                                                    "tgt_schema_name.$": "$.tgt_schema_name",
+                                                                    "AWS_STEP_FUNCTIONS_STARTED_BY_EXECUTION_ID.$": "$$.Execution.Id"
+                                                                }),
+                                                            result_path="$.FlStf",
+                                                            )
+        
+        check_packed_tables = _aws_stepfunctions.Choice(self,
+                                                    'check-packed-tables',
+                                                    comment='Check if the task group loaded packed tables',
+                                                    )
+        check_packed_tables.when(_aws_stepfunctions.Condition.is_present('$.pack_tables'), packed_lake_processing)
+        check_packed_tables.otherwise(lake_processing_sm_state)
+        
+        # a full instance pool queues the creation, the Lambda is called again after a wait
+        wait_group_placement = _aws_stepfunctions.Wait(
+            self, "Wait for group placement",
+            time=_aws_stepfunctions.WaitTime.duration(
+                Duration.seconds(config.PLACEMENT_RETRY_SECONDS))
+        )
+        check_group_placement = _aws_stepfunctions.Choice(self,
+                                                    'check-group-placement',
+                                                    comment='Check if the pool had room for the task group',
+                                                    )
+        wait_group_placement.next(create_task_group)
+        check_group_placement.when(_aws_stepfunctions.Condition.string_equals('$.placement_status', 'queued'), wait_group_placement)
+        check_group_placement.otherwise(replicate_task_group)
+        
+        create_task_group.next(check_group_placement)
+        replicate_task_group.next(delete_task_group).next(check_packed_tables)
+        
+        check_task_groups = _aws_stepfunctions.Choice(self,
+                                                    'check-task-groups',
+                                                    comment='Check if the load runs as a group of tasks',
+                                                    )
+        check_task_groups.when(_aws_stepfunctions.Condition.or_(
+            _aws_stepfunctions.Condition.is_present('$.task_groups'),
+            _aws_stepfunctions.Condition.is_present('$.pack_tables')), create_task_group)
+        
+        wait_task_placement = _aws_stepfunctions.Wait(
+            self, "Wait for task placement",
+            time=_aws_stepfunctions.WaitTime.duration(
+                Duration.seconds(config.PLACEMENT_RETRY_SECONDS))
+        )
+        check_task_placement = _aws_stepfunctions.Choice(self,
+                                                    'check-task-placement',
+                                                    comment='Check if the pool had room for the replication task',
+                                                    )
+        wait_task_placement.next(create_replciation_task)
+        check_task_placement.when(_aws_stepfunctions.Condition.string_equals('$.placement_status', 'queued'), wait_task_placement)
+        
+        # A reused task skips the creation wait and is started right away, after its modification
+        # finished when the mappings or settings changed since the last run
+        check_task_modification = _aws_stepfunctions_tasks.CallAwsService(
+            self,
+            'CheckTaskModificationStatus',
+            service='databasemigration',
+            action='describeReplicationTasks',
+            parameters= {
+                   'Filters': [
+                       {
+                           'Name':'replication-task-arn',
+                           'Values.$':'States.Array($.ReplicationTaskArn)'
+                        }
+                    ],
+                   'MaxRecords':20,
+                   'Marker':""
+                },
+            iam_resources=['*'],
+            result_path='$.ReplicationDetails',
+            additional_iam_statements=[
+                    iam.PolicyStatement(
+                        actions=["dms:DescribeReplicationTasks"],
+                        resources=["*"]
+                    )
+                ],
+        )
+        wait_task_modification = _aws_stepfunctions.Wait(
+            self, "Wait for task modification",
+            time=_aws_stepfunctions.WaitTime.duration(
+                Duration.seconds(config.TASK_MODIFY_WAIT_SECONDS))
+        )
+        eval_task_modification = _aws_stepfunctions.Choice(self,
+                                                    'evaluate-task-modification',
+                                                    comment='Evaluate if the reused task is still modifying',
+                                                    )
+        wait_task_modification.next(check_task_modification).next(eval_task_modification)
+        eval_task_modification.when(_aws_stepfunctions.Condition.string_equals("$.ReplicationDetails['ReplicationTasks'][0]['Status']","modifying"), wait_task_modification)
+        eval_task_modification.otherwise(start_replciation_task)
+        
+        check_task_reuse = _aws_stepfunctions.Choice(self,
+                                                    'check-task-reuse',
+                                                    comment='Check if an existing replication task is reused',
+                                                    )
+        check_task_reuse.when(_aws_stepfunctions.Condition.and_(
+            _aws_stepfunctions.Condition.boolean_equals('$.task_reused', True),
+            _aws_stepfunctions.Condition.boolean_equals('$.task_modified', True)), wait_task_modification)
+        check_task_reuse.when(_aws_stepfunctions.Condition.boolean_equals('$.task_reused', True), start_replciation_task)
+        check_task_reuse.otherwise(wait_task_creation)
+        check_task_placement.otherwise(check_task_reuse)
+        
+        check_task_groups.otherwise(create_replciation_task.next(check_task_placement))
+        
+        definition_fl = get_splits_task.next(check_task_groups)
         
         # Create state machine
         sm_fl = _aws_stepfunctions.StateMachine(
@@ -430,4 +698,72 @@ class StfStack(NestedStack):
             definition=definition_fl,
             state_machine_name='dms-app-load-dms-to-lake',
             timeout=Duration.minutes(180),
-        )    
\ No newline at end of file
+        )
+        
+        # Parent workflow for a list or manifest of tables. One load execution runs per table, at most
+        # MIGRATION_MAX_CONCURRENT_TABLES at once and never more than the pool can run together. The
+        # replication instance caps are enforced by the placement in create-dms-tasks. The waves run one
+        # after the other, the tables of a wave start in the order of the plan as slots free up.
+        plan_migration = _aws_stepfunctions_tasks.LambdaInvoke(
+            self,
+            'Plan Table Migration',
+            lambda_function=props['migration_manifest_lambda'],
+            payload_response_only=True,
+        )
+        
+        migrate_table = _aws_stepfunctions_tasks.StepFunctionsStartExecution(self,
+                                                            'StartTableLoadStf',
+                                                            state_machine=sm_fl,
+                                                            integration_pattern=_aws_stepfunctions.IntegrationPattern.RUN_JOB,
+                                                            input=_aws_stepfunctions.TaskInput.from_json_path_at('$'),
+                                                            result_selector={
+                                                                'Status.$': '$.Status',
+                                                                'ExecutionArn.$': '$.ExecutionArn',
+                                                                'StartDate.$': '$.StartDate',
+                                                                'StopDate.$': '$.StopDate',
+                                                            },
+                                                            result_path='$.Execution',
+                                                            )
+        # a failed table is reported in the summary and does not stop the other tables
+        migrate_table.add_catch(_aws_stepfunctions.Pass(self, 'Table Load Failed'),
+                                errors=[_aws_stepfunctions.Errors.ALL], result_path='$.ExecutionError')
+        
+        migrate_tables = _aws_stepfunctions.Map(
+            self, 'Migrate Tables',
+            items_path='$.tables',
+            max_concurrency=config.MIGRATION_CONCURRENCY,
+        )
+        migrate_tables.iterator(migrate_table)
+        
+        migrate_waves = _aws_stepfunctions.Map(
+            self, 'Migrate Waves',
+            items_path='$.waves',
+            max_concurrency=1,
+            result_selector={
+                'TableResults.$': '$',
+            },
+            result_path='$.MigrationResults',
+        )
+        migrate_waves.iterator(migrate_tables)
+        
+        summarize_migration = _aws_stepfunctions_tasks.LambdaInvoke(
+            self,
+            'Summarize Table Migration',
+            lambda_function=props['migration_manifest_lambda'],
+            payload=_aws_stepfunctions.TaskInput.from_object({
+                'action': 'summarize',
+                'TableResults.$': '$.MigrationResults.TableResults',
+                'schedule_estimate.$': '$.schedule_estimate',
+            }),
+            payload_response_only=True,
+        )
+        
+        definition_migration = plan_migration.next(migrate_waves).next(summarize_migration)
+        
+        sm_migration = _aws_stepfunctions.StateMachine(
+            self, "StateMachineMigration",
+            definition=definition_migration,
+            state_machine_name='dms-app-migrate-tables',
+            timeout=Duration.minutes(config.MIGRATION_TIMEOUT_MINUTES),
+        )
+        props['migration_state_machine'] = sm_migration
@@ -0,0 +1,29 @@
+import json
+import logging
+import os
+import boto3
+from cdc_file_index import index_records, list_records
+
+
+# Configure logging
+LOGFORMAT = '[%(asctime)s]: %(levelname)s: %(message)s'
+logging.basicConfig(format=LOGFORMAT, datefmt='%Y-%m-%d %H:%M:%S')
+logging.getLogger().setLevel(logging.INFO)
+
+
+def handler(event, context):
+    # S3 object created notifications of the DMS folder, or a backfill request
+    # {"action": "backfill", "prefix": "dmstarget/SCHEMA/TABLE", "start_after": "<LastIncrementalFile>"}
+    dyndb = boto3.resource('dynamodb')
+    table = dyndb.Table(os.environ['cdc_file_index_table'])
+
+    if event.get('action') == 'backfill':
+        logging.info('request: {}'.format(json.dumps(event)))
+        records = list_records(boto3.client('s3'), os.environ['dms_bucket_name'], event['prefix'].rstrip('/'),
+                               event.get('start_after'))
+    else:
+        records = event.get('Records', [])
+
+    result = index_records(records, table, os.environ['dms_folder'], os.environ['cdc_file_index_ttl'])
+    logging.info(f'CDC file index: {result}')
+    return result
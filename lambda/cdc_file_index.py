@@ -0,0 +1,85 @@
+import logging
+import time
+from datetime import datetime
+from urllib.parse import quote_plus, unquote_plus
+
+
+# sequencer of the rows written from a listing, any notification of the same key replaces them
+LISTED_SEQUENCER = '0' * 32
+
+# a row is only replaced by a later notification of the same key, notifications can arrive out of order
+NEWER_SEQUENCER = 'attribute_not_exists(file_key) OR sequencer < :sequencer'
+
+
+def get_sequencer(sequencer):
+    # S3 sequencers of the same key compare as hexadecimal numbers, padded they compare as strings
+    return (sequencer or '').upper().rjust(len(LISTED_SEQUENCER), '0')
+
+
+def get_written_at(record, now):
+    # epoch seconds of the S3 event, 2024-01-02T12:00:00.123Z, the index time when the record has none
+    event_time = record.get('eventTime')
+    if not event_time:
+        return now
+    return int(datetime.fromisoformat(event_time.replace('Z', '+00:00')).timestamp())
+
+
+def get_index_item(record, bucket_folder, ttl_seconds, now=None):
+    # One index row per CDC file: the table prefix dmstarget/SCHEMA/TABLE is the partition key and the key
+    # below it the sort key, so the files after the last processed one are a key range of the table.
+    # written_at is the time the file was written, the CDC processing only reads the rows written before
+    # its settle window, a notification delivered late can still index a file of an earlier key.
+    # Full load files, folders and objects outside of the DMS folder are not indexed.
+    s3_object = record['s3']['object']
+    key = unquote_plus(s3_object['key'])
+    parts = key.split('/')
+    if parts[0] != bucket_folder or len(parts) < 4 or not parts[-1] or parts[-1].upper().startswith('LOAD'):
+        return None
+
+    now = int(now if now is not None else time.time())
+    return {
+        'table_prefix': '/'.join(parts[:3]),
+        'file_key': '/'.join(parts[3:]),
+        'size': int(s3_object.get('size', 0)),
+        'sequencer': get_sequencer(s3_object.get('sequencer')),
+        'indexed_at': now,
+        'written_at': get_written_at(record, now),
+        'expires_at': now + int(ttl_seconds),
+    }
+
+
+def index_records(records, table, bucket_folder, ttl_seconds, now=None):
+    # table is the boto3 DynamoDB Table resource of the index
+    indexed, skipped = 0, 0
+    for record in records:
+        item = get_index_item(record, bucket_folder, ttl_seconds, now)
+        if item is None:
+            skipped += 1
+            continue
+        try:
+            table.put_item(Item=item,
+                           ConditionExpression=NEWER_SEQUENCER,
+                           ExpressionAttributeValues={':sequencer': item['sequencer']})
+            indexed += 1
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            logging.info(f'{item["table_prefix"]}/{item["file_key"]} is indexed by a later notification')
+            skipped += 1
+
+    return {'indexed': indexed, 'skipped': skipped}
+
+
+def list_records(s3conn, bucket, prefix, start_after=None):
+    # the objects of a table prefix in the shape of notification records, with URL encoded keys, to index
+    # the files written before the notifications were set up
+    paginator = s3conn.get_paginator('list_objects_v2')
+    params = {'Bucket': bucket, 'Prefix': prefix + '/'}
+    if start_after:
+        params['StartAfter'] = f'{prefix}/{start_after}'
+
+    for page in paginator.paginate(**params):
+        for obj in page.get('Contents', []):
+            record = {'s3': {'bucket': {'name': bucket},
+                             'object': {'key': quote_plus(obj['Key'], safe='/'), 'size': obj.get('Size', 0), 'sequencer': LISTED_SEQUENCER}}}
+            if obj.get('LastModified'):
+                record['eventTime'] = obj['LastModified'].isoformat()
+            yield record
@@ -1,6 +1,23 @@
 import os
+import json
+import hashlib
 import logging
+import time
 import boto3
+from datetime import datetime
+from dms_resolver import remember_arn, resolve_arn, resolver_stats
+from instance_placement import (
+    RESERVE_ATTEMPTS,
+    add_reservations,
+    get_active_tasks,
+    get_instance_loads,
+    get_reservations,
+    place_tasks,
+    release_reservations,
+    reserve_placements,
+)
+from task_packing import build_packed_mappings, pack_tables
+from task_settings import build_task_settings
 
 
 # Configure logging
@@ -8,67 +25,377 @@ LOGFORMAT = '[%(asctime)s]: %(levelname)s: %(message)s'
 logging.basicConfig(format=LOGFORMAT, datefmt='%Y-%m-%d %H:%M:%S')
 logging.getLogger().setLevel(logging.INFO)
 
+# keys of a table passed on to the lake processing of a packed task
+LAKE_TABLE_KEYS = ['schema_name', 'table_name', 'primary_key', 'pk_buckets']
+
 
 def handler(event, context):
     return main(event)
 
 
-def main(event):
-    source_endpoint_id = os.environ['source_endpoint_id']
-    destination_endpoint_id = os.environ['destination_endpoint_id']
-    replication_instance_id = os.environ['replication_instance_id']
-    replication_task_id = event['replication_task_id']
-    schema_name = event['schema_name']
-    table_name = event['table_name']
+def get_lower_bound_filters(col_name, lower, integer_key=False):
+    # DMS source filters have no strict greater than, integer keys use gte on the next value and
+    # other keys AND a gte with a noteq on the previous group upper bound, a NUMBER(p,s) key can
+    # hold values between the bound and the next integer
+    if integer_key:
+        return [{"filter-type": "source", "column-name": col_name,
+                 "filter-conditions": [{"filter-operator": "gte", "value": str(int(lower) + 1)}]}]
+    return [{"filter-type": "source", "column-name": col_name,
+             "filter-conditions": [{"filter-operator": "gte", "value": lower}]},
+            {"filter-type": "source", "column-name": col_name,
+             "filter-conditions": [{"filter-operator": "noteq", "value": lower}]}]
 
-    client = boto3.client('dms')
 
+def split_task_group(table_mappings, task_groups, integer_key=False):
+    # Divide the parallel-load range boundaries into task_groups contiguous key ranges. Each range becomes
+    # its own task with source filters on the key, so one table can be spread across replication instances.
+    # integer_key comes from the split plan of get-splits.
+    mappings = json.loads(table_mappings)
+    selection_rule = next(rule for rule in mappings['rules'] if rule['rule-type'] == 'selection')
+    settings_rule = next(rule for rule in mappings['rules'] if rule['rule-type'] == 'table-settings')
+    if settings_rule.get('parallel-load', {}).get('type') != 'ranges':
+        raise ValueError('task_groups needs a parallel-load ranges split from get-splits')
+
+    if len(settings_rule['parallel-load']['columns']) > 1:
+        raise ValueError('task_groups needs a single column split key, source filters cannot bound a composite key')
+    col_name = settings_rule['parallel-load']['columns'][0]
+    boundaries = settings_rule['parallel-load']['boundaries']
+    group_size = -(-len(boundaries) // int(task_groups))
+
+    group_mappings = []
+    lower = None
+    for start in range(0, len(boundaries), group_size):
+        group_boundaries = boundaries[start:start + group_size]
+        is_last_group = start + group_size >= len(boundaries)
+
+        filters = list(selection_rule.get('filters', []))
+        if lower is not None:
+            filters.extend(get_lower_bound_filters(col_name, lower, integer_key))
+        if not is_last_group:
+            # the group upper bound is a filter, the last boundary would only add an empty segment
+            upper = group_boundaries.pop()[0]
+            filters.append({"filter-type": "source", "column-name": col_name,
+                            "filter-conditions": [{"filter-operator": "ste", "value": upper}]})
+        else:
+            upper = None
+
+        group_selection_rule = dict(selection_rule, filters=filters)
+        group_settings_rule = dict(settings_rule, **{'parallel-load': dict(settings_rule['parallel-load'], boundaries=group_boundaries)})
+        if not group_boundaries:
+            del group_settings_rule['parallel-load']
+        group_mappings.append(json.dumps({"rules": [group_selection_rule, group_settings_rule]}))
+        lower = upper
+
+    return group_mappings
+
+
+def get_event_bytes(event):
+    # expected source bytes of the load, from the input or the split plan of get-splits
+    return int(event.get('size_bytes') or (event.get('split_plan') or {}).get('segment_bytes') or 0)
+
+
+def get_fan_out_tasks(event):
+    group_mappings = split_task_group(event['splits_json_data'], event['task_groups'],
+                                      (event.get('split_plan') or {}).get('integer_key', False))
+    table = {'schema_name': event['schema_name'], 'table_name': event['table_name']}
+    if get_event_bytes(event):
+        table['size_bytes'] = get_event_bytes(event) // len(group_mappings)
+    return [(f'{event["replication_task_id"]}-g{group_index}', table_mappings, [table])
+            for group_index, table_mappings in enumerate(group_mappings)]
+
+
+def get_packed_tasks(event):
+    # small tables share tasks so the per task create/start/delete overhead is paid once per pack
+    tables = [dict({'schema_name': event['schema_name']}, **table) for table in event['tables']]
+    event['tables'] = tables
+    packs = pack_tables(tables,
+                        event.get('max_task_bytes', os.environ.get('pack_max_task_bytes', 20 * 1024 ** 3)),
+                        event.get('max_tables_per_task', os.environ.get('pack_max_tables_per_task', 100)),
+                        event.get('default_table_bytes', os.environ.get('pack_default_table_bytes', 1024 ** 3)))
+    logging.info(f'{len(tables)} tables packed into {len(packs)} tasks')
+    return [(f'{event["replication_task_id"]}-p{pack_index}', build_packed_mappings(pack['tables'], event.get('table_splits')), pack['tables'])
+            for pack_index, pack in enumerate(packs)]
+
+
+def get_expected_bytes(task_ids):
+    placement_table_name = os.environ.get('placement_table')
+    if not placement_table_name or not task_ids:
+        return {}
+
+    dyndb = boto3.resource('dynamodb')
+    expected_bytes = {}
+    # keys left unprocessed by a throttled batch count as tasks of unknown size
+    for start in range(0, len(task_ids), 100):
+        resp = dyndb.batch_get_item(RequestItems={placement_table_name: {
+            'Keys': [{'replication_task_id': task_id} for task_id in task_ids[start:start + 100]]}})
+        for item in resp['Responses'].get(placement_table_name, []):
+            expected_bytes[item['replication_task_id']] = int(item['expected_bytes'])
+
+    return expected_bytes
+
+
+def get_placement_table():
+    placement_table_name = os.environ.get('placement_table')
+    if not placement_table_name:
+        return None
+    return boto3.resource('dynamodb').Table(placement_table_name)
+
+
+def record_placement(replication_task_id, replication_instance_arn, expected_bytes):
+    table = get_placement_table()
+    if table is None:
+        return
+
+    # the TTL removes the records of tasks that were never deleted by the Step Function
+    table.put_item(Item={
+        'replication_task_id': replication_task_id,
+        'replication_instance_arn': replication_instance_arn,
+        'expected_bytes': int(expected_bytes),
+        'expires_at': int(time.time()) + int(os.environ.get('placement_ttl', 172800)),
+    })
+    # the created task is counted from DMS from now on
+    release_reservations(table, replication_instance_arn, [replication_task_id], int(time.time()))
+
+
+def get_task_placements(client, event, task_ids, task_bytes, replication_instance_id, task_instance_arn=None):
+    # Explicit replication_instance_ids are used round robin. Otherwise every task is placed on the least
+    # loaded instance of the pool, None when the pool has no room for all of them yet. A reused task
+    # stays on its own instance and only waits for room there. The placements are reserved in the
+    # placement table with a conditional write, so concurrent executions cannot both take the last slot.
+    if task_instance_arn:
+        pool = [instance for instance in json.loads(os.environ.get('replication_instance_pool', '[]'))
+                if resolve_arn(client, 'replication-instance', instance['id']) == task_instance_arn]
+        if not pool:
+            return [task_instance_arn]
+    elif event.get('replication_instance_ids'):
+        instance_arns = [resolve_arn(client, 'replication-instance', instance_id) for instance_id in event['replication_instance_ids']]
+        return [instance_arns[index % len(instance_arns)] for index in range(len(task_bytes))]
+    else:
+        pool = json.loads(os.environ.get('replication_instance_pool', '[]'))
+    if not pool:
+        return [resolve_arn(client, 'replication-instance', replication_instance_id)] * len(task_bytes)
+
+    instances = [dict(instance, arn=resolve_arn(client, 'replication-instance', instance['id'])) for instance in pool]
+    instance_arns = [instance['arn'] for instance in instances]
+    placement_table = get_placement_table()
+    for _ in range(RESERVE_ATTEMPTS):
+        now = int(time.time())
+        reservations = get_reservations(placement_table, instance_arns, now) if placement_table is not None else {}
+        active_tasks = get_active_tasks(client, instance_arns)
+        loads = get_instance_loads(instances, active_tasks, get_expected_bytes([task['replication_task_id'] for task in active_tasks]))
+        loads = add_reservations(loads, reservations, active_tasks, task_ids)
+        event['instance_loads'] = {instance['id']: loads[instance['arn']] for instance in instances}
+        placements = place_tasks(instances, loads, task_bytes)
+        if placements is None or placement_table is None:
+            return placements
+        if reserve_placements(placement_table, reservations, task_ids, placements, task_bytes, now):
+            return placements
+
+    logging.info(f'Placement of {task_ids} lost {RESERVE_ATTEMPTS} reservation races, queueing the tasks')
+    return None
+
+
+def is_task_reuse_enabled(event):
+    # only recurring full loads of a single task keep their task between runs
+    reuse_task = event.get('reuse_task', os.environ.get('reuse_tasks', 'false').lower() == 'true')
+    return bool(reuse_task) and event['task_type'] == 'full-load' and not (event.get('pack_tables') or event.get('task_groups'))
+
+
+def get_config_hash(table_mappings, task_settings):
+    return hashlib.sha256(f'{table_mappings}{task_settings}'.encode()).hexdigest()
+
+
+def get_task_generation(replication_task_id):
+    generation_table_name = os.environ.get('task_generation_table')
+    if not generation_table_name:
+        return None
+
+    dyndb = boto3.resource('dynamodb')
+    resp = dyndb.Table(generation_table_name).get_item(Key={'replication_task_id': replication_task_id})
+    return resp.get('Item')
+
+
+def save_task_generation(replication_task_id, generation, runs, config_hash, replication_task_arn, replication_instance_arn, start_type):
+    generation_table_name = os.environ.get('task_generation_table')
+    if not generation_table_name:
+        return
+
+    dyndb = boto3.resource('dynamodb')
+    dyndb.Table(generation_table_name).put_item(Item={
+        'replication_task_id': replication_task_id,
+        'generation': generation,
+        'runs': runs,
+        'config_hash': config_hash,
+        'replication_task_arn': replication_task_arn,
+        'replication_instance_arn': replication_instance_arn,
+        'start_type': start_type,
+        'last_run_time': datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+    })
+
+
+def get_reusable_task(client, generation):
+    # the kept task can have been deleted outside the framework, it is then created again
     try:
-        # get the source identifier
-        source_identifier = client.describe_endpoints(
+        response = client.describe_replication_tasks(
             Filters=[
                 {
-                    'Name': 'endpoint-id',
+                    'Name': 'replication-task-arn',
                     'Values': [
-                        source_endpoint_id,
+                        generation['replication_task_arn'],
                     ]
                 },
-            ]
+            ],
+            WithoutSettings=True
         )
+    except Exception as ex:
+        if getattr(ex, 'response', {}).get('Error', {}).get('Code') == 'ResourceNotFoundFault':
+            return None
+        raise
 
-        source_endpoint_arn = source_identifier['Endpoints'][0]['EndpointArn']
+    if not response['ReplicationTasks']:
+        return None
+    replication_task = response['ReplicationTasks'][0]
+    if replication_task['Status'] not in ('ready', 'stopped', 'failed'):
+        raise ValueError(f'Replication task {replication_task["ReplicationTaskIdentifier"]} is {replication_task["Status"]}, '
+                         'it cannot be reused before it stops')
+    return replication_task
 
-        # get the target identifier
-        s3_identifier = client.describe_endpoints(
-            Filters=[
-                {
-                    'Name': 'endpoint-id',
-                    'Values': [
-                        destination_endpoint_id,
-                    ]
-                },
-            ]
+
+def reuse_replication_task(client, event, replication_task, generation, table_mappings, task_settings):
+    # The task is modified only when its mappings or settings changed since the last run. A task that
+    # already ran reloads the target, one that never started is started normally.
+    config_hash = get_config_hash(table_mappings, task_settings)
+    task_generation = int(generation['generation'])
+    if config_hash != generation['config_hash']:
+        client.modify_replication_task(
+            ReplicationTaskArn=replication_task['ReplicationTaskArn'],
+            MigrationType=event['task_type'],
+            TableMappings=table_mappings,
+            ReplicationTaskSettings=task_settings,
         )
+        task_generation += 1
+        logging.info(f'Replication task {event["replication_task_id"]} modified, generation {task_generation}')
 
-        s3_endpoint_arn = s3_identifier['Endpoints'][0]['EndpointArn']
+    start_type = 'reload-target' if replication_task.get('ReplicationTaskStartDate') else 'start-replication'
+    save_task_generation(event['replication_task_id'], task_generation, int(generation.get('runs', 0)) + 1, config_hash,
+                         replication_task['ReplicationTaskArn'], replication_task['ReplicationInstanceArn'], start_type)
 
-        # get replication instance
+    event['ReplicationTaskArn'] = replication_task['ReplicationTaskArn']
+    event['task_modified'] = config_hash != generation['config_hash']
+    event['task_generation'] = task_generation
+    event['start_type'] = start_type
 
-        replication_instances = client.describe_replication_instances(
-            Filters=[
+
+def create_task_group(client, event, group_tasks, instance_arns, source_endpoint_arn, s3_endpoint_arn, task_settings):
+    replication_task_id = event['replication_task_id']
+    dynamodb_table_name = os.environ['dynamodb_table']
+
+    dyndb = boto3.resource('dynamodb')
+    table = dyndb.Table(dynamodb_table_name)
+
+    task_group = []
+    for group_index, (group_task_id, table_mappings, tables) in enumerate(group_tasks):
+        replication_instance_arn = instance_arns[group_index]
+        resp = client.create_replication_task(
+            ReplicationTaskIdentifier=group_task_id,
+            SourceEndpointArn=source_endpoint_arn,
+            TargetEndpointArn=s3_endpoint_arn,
+            ReplicationInstanceArn=replication_instance_arn,
+            MigrationType=event['task_type'],
+            TableMappings=table_mappings,
+            ReplicationTaskSettings=task_settings,
+            Tags=[
                 {
-                    'Name': 'replication-instance-id',
-                    'Values': [
-                        replication_instance_id,
-                    ]
+                    'Key': 'Name',
+                    'Value': 'DMS replication task'
                 },
-            ]
+            ],
+            ResourceIdentifier=group_task_id
         )
+        remember_arn('replication-task', group_task_id, resp['ReplicationTask']['ReplicationTaskArn'])
+        record_placement(group_task_id, replication_instance_arn, sum(int(member.get('size_bytes') or 0) for member in tables))
+        task_group.append({
+            'replication_task_id': group_task_id,
+            'ReplicationTaskArn': resp['ReplicationTask']['ReplicationTaskArn'],
+            'replication_instance_arn': replication_instance_arn,
+            'group_index': group_index,
+            'tables': [{key: member[key] for key in LAKE_TABLE_KEYS if member.get(key)} for member in tables],
+        })
+        # one record per table of the task, so the task of any table can be looked up
+        for member in tables:
+            item = {
+                'taskid': group_task_id,
+                'tablename': member['table_name'],
+                'schema_name': member['schema_name'],
+                'task_type': event['task_type'],
+                'task_status': resp['ReplicationTask']['Status'],
+                'task_group_id': replication_task_id,
+                'group_index': group_index,
+                'replication_instance_arn': replication_instance_arn,
+            }
+            if member.get('size_bytes'):
+                item['size_bytes'] = int(member['size_bytes'])
+            table.put_item(Item=item)
+
+    logging.info(f'Task group {replication_task_id} created with {len(task_group)} tasks')
+    return task_group
 
-        replication_instance_arn = replication_instances['ReplicationInstances'][0]['ReplicationInstanceArn']
 
+def main(event):
+    source_endpoint_id = os.environ['source_endpoint_id']
+    destination_endpoint_id = os.environ['destination_endpoint_id']
+    replication_instance_id = os.environ['replication_instance_id']
+    replication_task_id = event['replication_task_id']
+    schema_name = event['schema_name']
+    table_name = event.get('table_name')
+
+    client = boto3.client('dms')
+
+    try:
+        # get the source and target identifiers and the replication instance, cached across invocations
+        source_endpoint_arn = resolve_arn(client, 'endpoint', source_endpoint_id)
+        s3_endpoint_arn = resolve_arn(client, 'endpoint', destination_endpoint_id)
         
         task_type = event['task_type']
+        # profile settings merged with the recommendations from earlier runs of the table
+        settings, event['task_settings_report'] = build_task_settings(event, os.environ['dynamodb_table'])
+        task_settings = json.dumps(settings)
+        # the duration of earlier runs caps the fallback polling interval of the Step Function
+        event['expected_seconds'] = event['task_settings_report'].get('expected_seconds')
+        event['task_started_at'] = None
+
+        group_tasks = None
+        if event.get('pack_tables') or event.get('task_groups'):
+            if task_type != 'full-load':
+                raise ValueError('task_groups and pack_tables are only supported for full-load tasks')
+            group_tasks = get_packed_tasks(event) if event.get('pack_tables') else get_fan_out_tasks(event)
+            task_ids = [group_task_id for group_task_id, _, _ in group_tasks]
+            task_bytes = [sum(int(member.get('size_bytes') or 0) for member in tables) for _, _, tables in group_tasks]
+        else:
+            task_ids = [replication_task_id]
+            task_bytes = [get_event_bytes(event)]
+
+        reuse_task = is_task_reuse_enabled(event)
+        generation = get_task_generation(replication_task_id) if reuse_task else None
+        replication_task = get_reusable_task(client, generation) if generation else None
+        event['reuse_task'] = reuse_task
+        event['task_reused'] = replication_task is not None
+
+        instance_arns = get_task_placements(client, event, task_ids, task_bytes, replication_instance_id,
+                                            replication_task['ReplicationInstanceArn'] if replication_task else None)
+        if instance_arns is None:
+            # the Step Function waits and calls the Lambda again until running tasks free the pool
+            event['placement_status'] = 'queued'
+            event['arn_resolver_stats'] = dict(resolver_stats)
+            return event
+        event['placement_status'] = 'placed'
+
+        if group_tasks is not None:
+            event['task_group'] = create_task_group(client, event, group_tasks, instance_arns, source_endpoint_arn,
+                                                    s3_endpoint_arn, task_settings)
+            event['arn_resolver_stats'] = dict(resolver_stats)
+            return event
+        replication_instance_arn = instance_arns[0]
         
         if event['splits_json_data']:
             table_mappings = event['splits_json_data']
@@ -76,6 +403,15 @@ def main(event):
             table_mappings = "{\"rules\":[{\"rule-type\":\"selection\",\"rule-id\":\"1\",\"rule-name\":\"1\",\"object-locator\":{\"schema-name\":\"" + schema_name + \
                             "\",\"table-name\":\"" + table_name +"\"},\"rule-action\":\"include\"}]}"
         
+        if replication_task:
+            # the kept task skips the creation and its wait
+            reuse_replication_task(client, event, replication_task, generation, table_mappings, task_settings)
+            record_placement(replication_task_id, replication_instance_arn, task_bytes[0])
+            remember_arn('replication-task', replication_task_id, event['ReplicationTaskArn'])
+            event['replication_instance_arn'] = replication_instance_arn
+            event['arn_resolver_stats'] = dict(resolver_stats)
+            return event
+        
         # create the replication task
         resp = client.create_replication_task(
             ReplicationTaskIdentifier=f'{replication_task_id}',
@@ -84,7 +420,7 @@ def main(event):
             ReplicationInstanceArn=replication_instance_arn,
             MigrationType= task_type,
             TableMappings=table_mappings,
-            ReplicationTaskSettings= "{\"FullLoadSettings\":{\"MaxFullLoadSubTasks\": 49}, \"Logging\": {\"EnableLogging\": true}}",
+            ReplicationTaskSettings= task_settings,
             
             Tags=[
                 {
@@ -97,6 +433,15 @@ def main(event):
 
         event['ReplicationTaskArn'] = resp['ReplicationTask']['ReplicationTaskArn']
         event['replication_task_id'] = replication_task_id
+        # start and delete find the new task without a describe call
+        remember_arn('replication-task', replication_task_id, event['ReplicationTaskArn'])
+        record_placement(replication_task_id, replication_instance_arn, task_bytes[0])
+        event['replication_instance_arn'] = replication_instance_arn
+        if reuse_task:
+            event['task_generation'] = int(generation['generation']) + 1 if generation else 1
+            save_task_generation(replication_task_id, event['task_generation'], 1, get_config_hash(table_mappings, task_settings),
+                                 event['ReplicationTaskArn'], replication_instance_arn, 'start-replication')
+        event['arn_resolver_stats'] = dict(resolver_stats)
 
         logging.info("Task created")
 
@@ -2,6 +2,7 @@ from datetime import datetime
 import os
 import logging
 import boto3
+from dms_resolver import call_with_arn, invalidate_arn, resolver_stats
 
 
 # Configure logging
@@ -20,51 +21,69 @@ def main(event):
     dynamodb_table_name = os.environ['dynamodb_table']
     try:
         client = boto3.client('dms')
-        replication_task_id = event['replication_task_id']
         
-        task_arn = get_replication_task_arn(client, replication_task_id)
-        task_type = event['task_type'].lower()
-        
-        if task_type == 'full-load':
-            response = client.delete_replication_task(
-                ReplicationTaskArn=task_arn
-            )
-        update_task_status(event, dynamodb_table_name, dms_bucket)
+        if 'TaskGroupResults' in event:
+            # every task of a fanned out table comes back from the Map state with its own details
+            for group_result in event['TaskGroupResults']:
+                delete_task(client, group_result, dynamodb_table_name, dms_bucket)
+        else:
+            delete_task(client, event, dynamodb_table_name, dms_bucket)
+        event['arn_resolver_stats'] = dict(resolver_stats)
         
     except Exception as ex:
         raise ex
     
-    logging.info(f'replication task {task_arn} deleted')
     return event
 
-def get_replication_task_arn(client, replication_task_id):
-    try:
-        response = client.describe_replication_tasks(
-        Filters=[
-            {
-                'Name': 'replication-task-id',
-                'Values': [
-                    replication_task_id
-                ]
-            }
-        ]
-    )
-    
-    except Exception as ex:
-        raise ex
+
+def delete_task(client, event, dynamodb_table_name, dms_bucket):
+    replication_task_id = event['replication_task_id']
     
-    task_arn = response['ReplicationTasks'][0]['ReplicationTaskArn']
+    task_type = event['task_type'].lower()
     
-    return task_arn
+    if task_type == 'full-load' and event.get('reuse_task'):
+        # a recurring full load keeps its task, the next run modifies and restarts it
+        logging.info(f'replication task {replication_task_id} kept for reuse')
+        delete_placement(replication_task_id)
+    elif task_type == 'full-load':
+        response = call_with_arn(client, 'replication-task', replication_task_id,
+                                 lambda task_arn: client.delete_replication_task(ReplicationTaskArn=task_arn))
+        # the next run recreates the task under the same id with a new ARN
+        invalidate_arn('replication-task', replication_task_id)
+        delete_placement(replication_task_id)
+        logging.info(f'replication task {replication_task_id} deleted')
+    update_task_status(event, dynamodb_table_name, dms_bucket)
+
+def delete_placement(replication_task_id):
+    # frees the expected bytes of the task on its replication instance for the placement of new tasks
+    placement_table_name = os.environ.get('placement_table')
+    if placement_table_name:
+        dyndb = boto3.resource('dynamodb')
+        dyndb.Table(placement_table_name).delete_item(Key={'replication_task_id': replication_task_id})
+
+
+def get_table_statistics(event, schema, table_name):
+    # a packed task reports the statistics of all its tables
+    for table_statistics in event['TableStatistics']['TableStatistics']:
+        if table_statistics['SchemaName'].lower() == schema.lower() and table_statistics['TableName'].lower() == table_name.lower():
+            return table_statistics
+    if len(event['TableStatistics']['TableStatistics']) == 1:
+        return event['TableStatistics']['TableStatistics'][0]
+    return None
+
 
 def update_task_status(event, dynamodb_table_name, dms_bucket):
+    tables = event.get('tables') or [{'schema_name': event['schema_name'], 'table_name': event['table_name']}]
+    for member in tables:
+        update_table_status(event, member['schema_name'], member['table_name'], dynamodb_table_name, dms_bucket)
+
+
+def update_table_status(event, schema, table_name, dynamodb_table_name, dms_bucket):
     now = datetime.now()
     current_time = now.strftime("%d/%m/%Y %H:%M:%S")
     try:
         dyndb = boto3.resource('dynamodb')
         table = dyndb.Table(dynamodb_table_name)
-        schema = event['schema_name']
-        table_name = event['table_name']
         path = f's3://{dms_bucket}/{schema}/{table_name}'
         
         resp = table.update_item(
@@ -80,7 +99,7 @@ def update_task_status(event, dynamodb_table_name, dms_bucket):
                     ExpressionAttributeValues={
                         ':val1': event['ReplicationDetails']['ReplicationTasks'][0]['Status'], 
                         ':val2': event['ReplicationDetails']['ReplicationTasks'][0]['ReplicationTaskStats'],
-                        ':val3': event['TableStatistics']['TableStatistics'][0],
+                        ':val3': get_table_statistics(event, schema, table_name),
                         ':val4': event['task_type'],
                         ':val5': current_time
                     },
@@ -0,0 +1,123 @@
+import logging
+import os
+import time
+import boto3
+from botocore.exceptions import ClientError
+
+
+# describe call, filter name, response list and ARN field per DMS resource type
+RESOURCE_TYPES = {
+    'endpoint': ('describe_endpoints', 'endpoint-id', 'Endpoints', 'EndpointArn'),
+    'replication-instance': ('describe_replication_instances', 'replication-instance-id', 'ReplicationInstances', 'ReplicationInstanceArn'),
+    'replication-task': ('describe_replication_tasks', 'replication-task-id', 'ReplicationTasks', 'ReplicationTaskArn'),
+}
+
+# Module level state survives warm invocations of the Lambda container
+ARN_CACHE_TTL = int(os.environ.get('arn_cache_ttl', 86400))
+arn_cache = {}
+resolver_stats = {'describe_calls': 0, 'describe_calls_saved': 0, 'dynamodb_hits': 0, 'invalidations': 0}
+
+
+def get_cache_table():
+    # the DynamoDB cache is shared by all the DMS Lambdas, without it only the in-process cache is used
+    cache_table_name = os.environ.get('arn_cache_table')
+    if not cache_table_name:
+        return None
+    return boto3.resource('dynamodb').Table(cache_table_name)
+
+
+def get_cache_key(resource_type, resource_id):
+    return f'{resource_type}:{resource_id}'
+
+
+def remember_arn(resource_type, resource_id, arn):
+    cache_key = get_cache_key(resource_type, resource_id)
+    expires_at = int(time.time()) + ARN_CACHE_TTL
+    arn_cache[cache_key] = (arn, expires_at)
+
+    cache_table = get_cache_table()
+    if cache_table is not None:
+        try:
+            cache_table.put_item(Item={'resource_key': cache_key, 'arn': arn, 'expires_at': expires_at})
+        except ClientError as e:
+            # a failed cache write only costs a describe call on the next lookup
+            logging.error(f'Error writing the ARN cache for {cache_key}: {e}')
+
+
+def invalidate_arn(resource_type, resource_id):
+    cache_key = get_cache_key(resource_type, resource_id)
+    arn_cache.pop(cache_key, None)
+    resolver_stats['invalidations'] += 1
+
+    cache_table = get_cache_table()
+    if cache_table is not None:
+        try:
+            cache_table.delete_item(Key={'resource_key': cache_key})
+        except ClientError as e:
+            logging.error(f'Error invalidating the ARN cache for {cache_key}: {e}')
+
+
+def describe_arn(client, resource_type, resource_id):
+    describe_call, filter_name, list_key, arn_key = RESOURCE_TYPES[resource_type]
+    response = getattr(client, describe_call)(
+        Filters=[
+            {
+                'Name': filter_name,
+                'Values': [
+                    resource_id,
+                ]
+            },
+        ]
+    )
+    resolver_stats['describe_calls'] += 1
+
+    if not response[list_key]:
+        raise ValueError(f'DMS {resource_type} {resource_id} not found')
+    return response[list_key][0][arn_key]
+
+
+def resolve_arn(client, resource_type, resource_id, refresh=False):
+    # in-process cache first, then the DynamoDB cache, the describe call only runs when both miss
+    cache_key = get_cache_key(resource_type, resource_id)
+    now = int(time.time())
+    if not refresh:
+        cached_arn = arn_cache.get(cache_key)
+        if cached_arn and cached_arn[1] > now:
+            resolver_stats['describe_calls_saved'] += 1
+            return cached_arn[0]
+
+        cache_table = get_cache_table()
+        if cache_table is not None:
+            try:
+                item = cache_table.get_item(Key={'resource_key': cache_key}).get('Item')
+            except ClientError as e:
+                logging.error(f'Error reading the ARN cache for {cache_key}: {e}')
+                item = None
+            # DynamoDB TTL deletes are lazy, expired items can still be returned
+            if item and int(item['expires_at']) > now:
+                arn_cache[cache_key] = (item['arn'], int(item['expires_at']))
+                resolver_stats['describe_calls_saved'] += 1
+                resolver_stats['dynamodb_hits'] += 1
+                return item['arn']
+
+    try:
+        arn = describe_arn(client, resource_type, resource_id)
+    except Exception:
+        invalidate_arn(resource_type, resource_id)
+        raise
+
+    remember_arn(resource_type, resource_id, arn)
+    return arn
+
+
+def call_with_arn(client, resource_type, resource_id, action):
+    # A cached ARN can point to a resource deleted and recreated since it was cached, e.g. a task
+    # recreated by the next run. The entry is then dropped and the call retried once with a fresh ARN.
+    try:
+        return action(resolve_arn(client, resource_type, resource_id))
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ResourceNotFoundFault':
+            raise
+        logging.info(f'Cached ARN for {resource_type} {resource_id} is stale, resolving it again')
+        invalidate_arn(resource_type, resource_id)
+        return action(resolve_arn(client, resource_type, resource_id, refresh=True))
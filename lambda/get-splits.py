@@ -1,31 +1,60 @@
 import json
 import logging
-import logging
+import math
 import os
-import cx_Oracle
+import time
 import boto3
-import csv
 from datetime import datetime
+from decimal import Decimal
 from botocore.exceptions import ClientError
+from split_estimators import (
+    NTILE_COLUMNS,
+    SPLIT_METHODS,
+    estimate_skew,
+    format_key_value,
+    get_composite_ntile_splits,
+    get_split_cache_key,
+    get_key_family,
+    is_integer_type,
+    get_segment_stats,
+    merge_duplicate_boundaries,
+    get_histogram_splits,
+    get_interpolated_splits,
+    plan_num_segments,
+    resplit_heavy_segments,
+)
+from split_dialects import get_dialect
 
 
-cx_Oracle.init_oracle_client(lib_dir="/opt/lib")
 logging.getLogger().setLevel(logging.INFO)
 
+# Module level state survives warm invocations of the Lambda container
+SECRET_CACHE_TTL = int(os.environ.get('secret_cache_ttl', 300))
+secrets_client = None
+secret_cache = {}
+connection_cache = {}
+connection_stats = {'secret_calls': 0, 'secret_calls_saved': 0, 'connects': 0, 'connects_saved': 0}
+
+
+def get_secret(secret_name, refresh=False):
+    global secrets_client
+    cached_secret = secret_cache.get(secret_name)
+    if cached_secret and not refresh and time.time() - cached_secret[1] < SECRET_CACHE_TTL:
+        connection_stats['secret_calls_saved'] += 1
+        return cached_secret[0]
 
-def get_secret():
-    secret_name = f"oracle_creds"
-    region_name = "us-east-1"
+    region_name = os.environ.get('secret_region') or os.environ.get('AWS_REGION')
  
     # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=region_name
-    )
+    if secrets_client is None:
+        session = boto3.session.Session()
+        secrets_client = session.client(
+            service_name='secretsmanager',
+            region_name=region_name
+        )
    
     try:
-        get_secret_value_response = client.get_secret_value(
+        get_secret_value_response = secrets_client.get_secret_value(
             SecretId=secret_name
         )
     except ClientError as e:
@@ -34,127 +63,330 @@ def get_secret():
     # Decrypts secret
     secret_response = get_secret_value_response['SecretString']
     secret = json.loads(secret_response)
+    connection_stats['secret_calls'] += 1
+    secret_cache[secret_name] = (secret, time.time())
     return secret
 
 
+def get_connection(dialect, secret_name):
+    # One connection per source is kept warm, it is health checked before reuse and reopened when stale
+    cache_key = f'{dialect.source_type}:{secret_name}'
+    connection = connection_cache.get(cache_key)
+    if connection is not None:
+        if dialect.ping(connection):
+            connection_stats['connects_saved'] += 1
+            return connection
+        logging.info(f'Cached {dialect.source_type} connection failed the health check, reconnecting')
+        try:
+            connection.close()
+        except Exception:
+            pass
+        del connection_cache[cache_key]
+
+    try:
+        connection = dialect.connect(get_secret(secret_name))
+    except Exception as ex:
+        # the cached secret may have been rotated, retry once with a fresh one
+        logging.warning(f'Connection failed with the cached secret, refreshing it: {ex}')
+        connection = dialect.connect(get_secret(secret_name, refresh=True))
+
+    connection_stats['connects'] += 1
+    connection_cache[cache_key] = connection
+    return connection
+
 
 def roundUpToMultiple(number, multiple):
     num = number + (multiple - 1)
     return num - (num % multiple)
+
+def get_cached_splits(cache_table_name, split_key):
+    try:
+        dyndb = boto3.resource('dynamodb')
+        table = dyndb.Table(cache_table_name)
+        resp = table.get_item(Key={'split_key': split_key})
+    except ClientError as e:
+        logging.error(f'Error reading the split cache for {split_key}: {e}')
+        return None
+
+    return resp.get('Item')
+
+
+def save_cached_splits(cache_table_name, split_key, boundaries, col_max, row_count):
+    now = datetime.now()
+    current_time = now.strftime("%d/%m/%Y %H:%M:%S")
+    try:
+        dyndb = boto3.resource('dynamodb')
+        table = dyndb.Table(cache_table_name)
+        table.put_item(Item={
+            'split_key': split_key,
+            'boundaries': boundaries,
+            'col_max': col_max,
+            'row_count': row_count,
+            'last_refresh_time': current_time
+        })
+    except ClientError as e:
+        # a failed cache write only costs a full scan on the next run
+        logging.error(f'Error writing the split cache for {split_key}: {e}')
+
+
+def get_tail_splits(dialect, cursor, edp_owner, table_name, partition_key, cached_splits, max_segments):
+    # Only the rows above the cached max key are scanned. The tail gets its own segments once it
+    # holds at least one segment worth of rows, until then it stays in the open-ended last range.
+    # Returns None when the new segments would not fit under max_segments and a full recompute is needed.
+    cached_max = cached_splits['col_max']
+    rows_per_segment = max(int(cached_splits['row_count']) // max(len(cached_splits['boundaries']), 1), 1)
+
+    cursor.execute(dialect.tail_count_sql(edp_owner, table_name, partition_key), {'lower_bound': cached_max})
+    tail_rows = cursor.fetchone()[0]
+    tail_segments = tail_rows // rows_per_segment
+    logging.info(f'{tail_rows} rows above the cached max key {cached_max}, {tail_segments} new segments')
+
+    if tail_segments == 0:
+        return []
+    if len(cached_splits['boundaries']) + tail_segments > max_segments:
+        logging.info(f'{tail_segments} new segments exceed the cap of {max_segments}, recomputing all boundaries')
+        return None
+
+    cursor.execute(dialect.ntile_sql(edp_owner, table_name, partition_key, tail_segments, lower_bound=True),
+                   {'lower_bound': cached_max})
+    return cursor.fetchall()
+
+
+def fetch_rows(cursor, batch_size=100):
+    # rows are pulled from the cursor in batches instead of a single fetchall
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        yield from rows
+
+
+def convert2json(schema_name, table_name, key_columns, rows, cached_boundaries=None, round_multiple=100000, numeric_key=True):
    
-def convert2json():
- 
-    #Read schema mapping csv, and split on "," the line
-    csv_file = csv.DictReader(open(input_file, "r"), delimiter=",")
-   
-    dict_boundaries=[]
+    dict_boundaries=[[boundary] for boundary in cached_boundaries or []]
+    col_max = dict_boundaries[-1][0] if dict_boundaries else '0'
  
-    #Loop through the csv
-    for row in csv_file:
-        #Lookup schema and table name based on schema mapping
-        schema_name=row['SCHEMANAME']
-        table_name=row['TABLENAME']
-        col_name=row['COLUMNNAME']
-        col_min=row['COL_MIN']
-        col_max=row['COL_MAX']
-        dict_boundaries.append([col_max])
-
-    dict_boundaries.append([str(roundUpToMultiple(int(col_max),100000))])
-    output_file=output_dir_path+table_name.lower()+".json"
+    # COL_MAX is the 5th column of the ntile query, a tuple with one value per column for composite keys
+    for row in rows:
+        key_values = row[4] if isinstance(row[4], tuple) else (row[4],)
+        dict_boundaries.append([format_key_value(value) for value in key_values])
+        col_max = dict_boundaries[-1][0]
+
+    selection_rule = { "rule-type": "selection", "rule-id": "1", "rule-name": "1", "object-locator": {"schema-name": schema_name,"table-name": table_name},  "rule-action": "include"}
+    if numeric_key:
+        # the max of a DECIMAL or FLOAT key can be fractional
+        key_max = Decimal(col_max)
+        rounded_max = roundUpToMultiple(math.ceil(key_max),int(round_multiple))
+        # boundaries must be strictly increasing, a max already on the multiple needs no extra boundary
+        if rounded_max > key_max:
+            dict_boundaries.append([str(rounded_max)])
+        selection_rule["filters"] = [{ "filter-type": "source", "column-name": key_columns[0], "filter-conditions": [{"filter-operator": "gte","value": "0"}]}]
     
-    with open(output_file, 'w') as f:
-        #json_data={"rules":[{ "rule-type": "selection", "rule-id": "1", "rule-name": "1", "object-locator": {"schema-name": schema_name,"table-name": table_name},  "rule-action": "include"}, {"rule-type": "table-settings", "rule-id": "2", "rule-name": "2","object-locator": {"schema-name": schema_name, "table-name": table_name},"parallel-load":{"type": "ranges","columns": [col_name],"boundaries": dict_boundaries}}]}
-        json_data={"rules":[{ "rule-type": "selection", "rule-id": "1", "rule-name": "1", "object-locator": {"schema-name": schema_name,"table-name": table_name},  "rule-action": "include","filters": [{ "filter-type": "source", "column-name": col_name, "filter-conditions": [{"filter-operator": "gte","value": "0"}]}]}, {"rule-type": "table-settings", "rule-id": "2", "rule-name": "2","object-locator": {"schema-name": schema_name, "table-name": table_name},"parallel-load":{"type": "ranges","columns": [col_name],"boundaries": dict_boundaries}}]}
-        json.dump(json_data, f,indent=4)
-       
-    with open(output_file, 'r') as file:
-        contents = file.read()
+    json_data={"rules":[selection_rule, {"rule-type": "table-settings", "rule-id": "2", "rule-name": "2","object-locator": {"schema-name": schema_name, "table-name": table_name},"parallel-load":{"type": "ranges","columns": key_columns,"boundaries": dict_boundaries}}]}
+    contents = json.dumps(json_data, indent=4)
     
     logging.info(contents)
     
     return contents
     
+def build_partition_rules(schema_name, table_name, partitioning, partition_names=None, max_segments=49):
+    # Segments follow the native partitions so every DMS subtask reads a single partition with partition pruning.
+    # Subpartitions are only used when the partitions alone cannot fill the parallel subtasks.
+    if partition_names:
+        parallel_load = {"type": "partitions-list", "partitions": partition_names}
+    elif partitioning['subpartitioning_type'] and len(partitioning['partitions']) < max_segments:
+        parallel_load = {"type": "subpartitions-auto"}
+    else:
+        parallel_load = {"type": "partitions-auto"}
+
+    json_data={"rules":[{ "rule-type": "selection", "rule-id": "1", "rule-name": "1", "object-locator": {"schema-name": schema_name,"table-name": table_name},  "rule-action": "include"}, {"rule-type": "table-settings", "rule-id": "2", "rule-name": "2","object-locator": {"schema-name": schema_name, "table-name": table_name},"parallel-load": parallel_load}]}
+    contents = json.dumps(json_data, indent=4)
+
+    logging.info(contents)
+
+    return contents
+
+
+def is_split_requested(request):
+    return bool(request.get('edp_owner') and (request.get('use_partitions') or (request.get('partition_key') and (
+        request.get('num_segments') or request.get('target_rows_per_segment') or request.get('target_bytes_per_segment')))))
+
+
+def get_key_columns(dialect, partition_key):
+    # a composite key is a list or a comma separated string, in DMS boundary order
+    if not partition_key:
+        return []
+    if isinstance(partition_key, str):
+        partition_key = partition_key.split(',')
+    return [dialect.normalize_identifier(column.strip()) for column in partition_key]
+
+
+def get_table_splits(dialect, cursor, request):
+    edp_owner = dialect.normalize_identifier(request['edp_owner'])
+    table_name = dialect.normalize_identifier(request['table_name'])
+    key_columns = get_key_columns(dialect, request.get('partition_key'))
+    partition_key = ','.join(key_columns) or None
+    num_segments = request.get('num_segments')
+    # a segment target without an explicit count sizes the split from the table
+    if num_segments is None and (request.get('target_rows_per_segment') or request.get('target_bytes_per_segment')):
+        num_segments = 'auto'
+    use_partitions = request.get('use_partitions', False)
+
+    refresh_splits = request.get('refresh_splits', False)
+    split_method = request.get('split_method', 'ntile').lower()
+    sample_percent = request.get('sample_percent', 1)
+    if split_method not in SPLIT_METHODS:
+        raise ValueError(f'split_method must be one of {SPLIT_METHODS}, got {split_method}')
+    cache_table_name = os.environ.get('split_cache_table')
+    max_segments = int(os.environ.get('max_full_load_subtasks', 49))
+    round_multiple = request.get('boundary_round_multiple', os.environ.get('boundary_round_multiple', 100000))
+    target_rows_per_segment = request.get('target_rows_per_segment', os.environ.get('target_rows_per_segment', 10000000))
+    target_bytes_per_segment = request.get('target_bytes_per_segment')
+    skew_threshold = request.get('skew_threshold', os.environ.get('skew_threshold'))
+
+    if use_partitions:
+        partitioning = dialect.get_partitioning(cursor, edp_owner, table_name)
+        if partitioning:
+            logging.info(f'{edp_owner}.{table_name} is {partitioning["partitioning_type"]} partitioned, '
+                         f'{len(partitioning["partitions"])} partitions')
+            return {
+                'splits_json_data': build_partition_rules(edp_owner, table_name, partitioning,
+                                                          request.get('partition_names'), max_segments),
+                'split_plan': partitioning,
+            }
+        logging.info(f'{edp_owner}.{table_name} is not partitioned')
+
+    if not (num_segments and partition_key):
+        logging.info(f'{edp_owner}.{table_name} not partitioned and no range split requested for the DMS job')
+        return {'splits_json_data': None}
+
+    # rounding, the gte filter, estimators and the tail cache work on key arithmetic and need a single numeric key
+    key_type = dialect.get_column_type(cursor, edp_owner, table_name, key_columns[0]) if len(key_columns) == 1 else None
+    key_family = get_key_family(key_type) if len(key_columns) == 1 else 'composite'
+    numeric_key = key_family == 'numeric'
+    integer_key = is_integer_type(key_type)
+    if not numeric_key and split_method in ('histogram', 'interpolate'):
+        logging.info(f'{split_method} needs a single numeric key, {partition_key} is {key_family}, using ntile')
+        split_method = 'ntile'
+
+    split_key = get_split_cache_key(edp_owner, table_name, partition_key, num_segments, split_method, sample_percent,
+                                    skew_threshold, target_bytes_per_segment or target_rows_per_segment)
+    cached_splits = None
+    if cache_table_name and not refresh_splits and numeric_key:
+        cached_splits = get_cached_splits(cache_table_name, split_key)
+
+    if cached_splits:
+        logging.info(f'Reusing {len(cached_splits["boundaries"])} cached boundaries for {split_key}')
+        res = get_tail_splits(dialect, cursor, edp_owner, table_name, partition_key, cached_splits, max_segments)
+        if res is None:
+            cached_splits = None
+
+    split_plan = {'num_segments': num_segments, 'max_segments': max_segments}
+    # the row counts of interpolate come from the same uniform min/max distribution as its boundaries,
+    # they always look balanced
+    measures_skew = split_method != 'interpolate'
+    if cached_splits:
+        cached_boundaries = cached_splits['boundaries']
+        row_count = int(cached_splits['row_count'])
+        split_method = 'cache'
+        split_plan['num_segments'] = len(cached_boundaries) + len(res)
+    else:
+        if num_segments == 'auto':
+            split_plan = plan_num_segments(dialect, cursor, edp_owner, table_name, target_rows_per_segment,
+                                           target_bytes_per_segment, max_segments)
+        num_segments = split_plan['num_segments']
+        logging.info(f'Split plan: {split_plan}')
+        if split_method == 'histogram':
+            res = get_histogram_splits(dialect, cursor, edp_owner, table_name, partition_key, num_segments, integer_key)
+        elif split_method == 'interpolate':
+            res = get_interpolated_splits(dialect, cursor, edp_owner, table_name, partition_key, num_segments, integer_key)
+        elif len(key_columns) > 1:
+            res = merge_duplicate_boundaries(get_composite_ntile_splits(
+                dialect, cursor, edp_owner, table_name, key_columns, num_segments,
+                sample_percent=sample_percent if split_method == 'sample' else None))
+        else:
+            ntile_sql = dialect.ntile_sql(edp_owner, table_name, partition_key, num_segments,
+                                          sample_percent=sample_percent if split_method == 'sample' else None)
+            cursor.execute(ntile_sql)
+            res = merge_duplicate_boundaries(fetch_rows(cursor))
+        estimated_skew = estimate_skew(res) if measures_skew else None
+        if skew_threshold and estimated_skew and estimated_skew > float(skew_threshold) and len(key_columns) == 1:
+            res = resplit_heavy_segments(dialect, cursor, edp_owner, table_name, partition_key, res,
+                                         skew_threshold, max(max_segments, len(res)))
+        cached_boundaries = []
+        row_count = 0
+
+    logging.info(NTILE_COLUMNS)
+    for row in res:
+        logging.info(row)
+
+    contents = convert2json(edp_owner, table_name, key_columns, res, cached_boundaries, round_multiple, numeric_key)
+    logging.info(f'Completed Succesfully at {str(datetime.now())}')
+
+    if cache_table_name and numeric_key and (res or not cached_splits):
+        # COL_MAX and ROW_COUNT are the 5th and 6th columns of the ntile query
+        boundaries = cached_boundaries + [format_key_value(row[4]) for row in res]
+        row_count += sum(int(row[5]) for row in res)
+        if boundaries:
+            save_cached_splits(cache_table_name, split_key, boundaries, boundaries[-1], row_count)
+
+    split_plan['key_columns'] = key_columns
+    split_plan['key_family'] = key_family
+    split_plan['integer_key'] = integer_key
+    if numeric_key:
+        split_plan['boundary_round_multiple'] = int(round_multiple)
+    split_estimate = {
+        'method': split_method,
+        'estimated_skew': estimate_skew(res) if measures_skew else None,
+    }
+    logging.info(f'Split estimate: {split_estimate}')
+
+    return {
+        'splits_json_data': contents,
+        'splits_cache_hit': bool(cached_splits),
+        'split_plan': split_plan,
+        'split_estimate': split_estimate,
+        'segment_stats': get_segment_stats(res),
+    }
+
+
 def handler(event, context):
     logging.info('request: {}'.format(json.dumps(event)))
     
-    try:
-        partition_key = event['partition_key'].upper()
-    except KeyError:
-        partition_key = None
-    try:
-        edp_owner = event['edp_owner'].upper()
-    except KeyError:
-        edp_owner = None     
-    try:
-        num_segments = event['num_segments']
-    except KeyError:
-        num_segments = None 
-    
-    if num_segments and edp_owner and partition_key:
-        global input_file,output_dir_path 
-        secrets = get_secret()
-        input_file = "/tmp/query_output.csv"
-        output_dir_path = "/tmp/"
-        host = secrets['host']
-        port = secrets['port']
-        service_name = secrets['db_name']
-        password = secrets['password']
-        username = secrets['username']
-        
-        table_name = event['table_name'].upper()
-
+    # the source engine comes from the deployment config, an execution can override it
+    dialect = get_dialect(event.get('source_type', os.environ.get('source_type', 'oracle')))
     
-        cols = []
-        tns = f'(DESCRIPTION=(enable=broken)(ADDRESS=(PROTOCOL=TCP)(HOST={host})(PORT={port}))(LOAD_BALANCE=YES)(CONNECT_DATA=(SERVER=DEDICATED)(SERVICE_NAME={service_name})(FAILOVER_MODE=(TYPE=SELECT)(METHOD=BASIC))))'
-        cx_connection = cx_Oracle.Connection(user=username, password=password, dsn=tns, encoding="UTF-8", nencoding="UTF-8")
-        cx_cursor = cx_connection.cursor()
-        logging.info('Connection Success')
-        
-        ntile_sql = f"SELECT '{edp_owner}' schemaname,'{table_name}' TABLENAME,'{partition_key}' COLUMNNAME,MIN({partition_key}) COL_MIN,MAX({partition_key}) COL_MAX,COUNT(*) ROW_COUNT, NT BATCH \
-            FROM  (SELECT /*+ FULL(A) PARALLEL(A,12) */ {partition_key},NTILE({num_segments}) OVER (ORDER BY {partition_key}) NT \
-                FROM {edp_owner}.{table_name} A) \
-                    GROUP BY NT \
-                        ORDER BY NT"
-            
-        cx_cursor.execute(ntile_sql)
-        res = cx_cursor.fetchall()
-    
-        col_names = []
-        for i in range(0, len(cx_cursor.description)):
-            col_names.append(cx_cursor.description[i][0])
+    # a batch call carries a list of tables, each entry overrides the execution level inputs
+    if 'tables' in event:
+        requests = [dict({key: value for key, value in event.items() if key != 'tables'}, **table) for table in event['tables']]
+    else:
+        requests = [event]
     
-        logging.info(col_names)
+    if not any(is_split_requested(request) for request in requests):
+        event['splits_json_data'] = None
+        logging.info('Splits not requested for the DMS job')
+        return event
     
-        for row in res:
-            logging.info(row)
+    connection = get_connection(dialect, os.environ.get('source_secret_name') or dialect.secret_name)
+    cursor = connection.cursor()
+    logging.info(f'Connection Success to {dialect.source_type} source')
     
-        
-        # Write query output to a CSV file
-        csv_filename = "/tmp/query_output.csv"
-        with open(csv_filename, "w", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([i[0] for i in cx_cursor.description])  # Write column headers
-            writer.writerows(res)
-        
-        
-        if input_file is None:
-            logging.error(f'input_file is None')
-            exit()
-        try:
-            contents = convert2json()
-            logging.info(f'Completed Succesfully at {str(datetime.now())}')
+    table_splits = {}
+    try:
+        for request in requests:
+            if is_split_requested(request):
+                table_splits[request['table_name']] = get_table_splits(dialect, cursor, request)
+            else:
+                table_splits[request['table_name']] = {'splits_json_data': None}
+    finally:
+        cursor.close()
     
-        except Exception as err:
-            logging.error(f'Error {err} at {str(datetime.now())}')
-            exit()
-        
-
-        cx_cursor.close() 
-        
-        event['splits_json_data'] = contents
+    event['split_connection_stats'] = dict(connection_stats)
+    logging.info(f'Connection stats: {connection_stats}')
     
+    if 'tables' in event:
+        event['table_splits'] = table_splits
     else:
-        event['splits_json_data'] = None
-        logging.info('Splits not requested for the DMS job')
+        event.update(table_splits[event['table_name']])
     
     return event
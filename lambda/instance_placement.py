@@ -0,0 +1,171 @@
+import copy
+import logging
+
+
+# tasks in these states hold a slot on their replication instance, created tasks are started right away
+ACTIVE_TASK_STATUSES = ['creating', 'ready', 'starting', 'running', 'modifying', 'stopping', 'moving']
+# a reservation holds its slot until the task shows in DMS, a reservation older than a Lambda run was never created
+RESERVATION_SECONDS = 900
+RESERVATION_VERSION = 'attribute_not_exists(version) OR version = :version'
+# placements computed again after losing a reservation race, then the task is queued
+RESERVE_ATTEMPTS = 5
+
+
+def get_active_tasks(client, instance_arns):
+    active_tasks = []
+    marker = ''
+    while True:
+        try:
+            response = client.describe_replication_tasks(
+                Filters=[
+                    {
+                        'Name': 'replication-instance-arn',
+                        'Values': instance_arns
+                    },
+                ],
+                MaxRecords=100,
+                Marker=marker,
+                WithoutSettings=True
+            )
+        except Exception as ex:
+            # DMS answers a describe without any match with ResourceNotFoundFault
+            if getattr(ex, 'response', {}).get('Error', {}).get('Code') == 'ResourceNotFoundFault':
+                break
+            raise
+
+        active_tasks.extend({'replication_task_id': task['ReplicationTaskIdentifier'],
+                             'replication_instance_arn': task['ReplicationInstanceArn']}
+                            for task in response['ReplicationTasks'] if task['Status'] in ACTIVE_TASK_STATUSES)
+        marker = response.get('Marker')
+        if not marker:
+            break
+
+    return active_tasks
+
+
+def get_instance_loads(instances, active_tasks, expected_bytes):
+    # expected_bytes maps the task ids placed earlier to the source bytes they load
+    loads = {instance['arn']: {'tasks': 0, 'bytes': 0} for instance in instances}
+    for task in active_tasks:
+        load = loads.get(task['replication_instance_arn'])
+        if load is not None:
+            load['tasks'] += 1
+            load['bytes'] += int(expected_bytes.get(task['replication_task_id'], 0))
+
+    return loads
+
+
+def get_load_score(instance, load, task_bytes):
+    # fraction of the tighter of the two caps the instance would use with the new task
+    score = (load['tasks'] + 1) / int(instance['max_tasks'])
+    if instance.get('max_bytes'):
+        score = max(score, (load['bytes'] + task_bytes) / int(instance['max_bytes']))
+    return score
+
+
+def place_tasks(instances, loads, task_bytes):
+    # Every task goes to the instance left least loaded relative to its caps. All the tasks are placed
+    # or none: None means the pool is full and the caller has to wait for running tasks to finish.
+    loads = copy.deepcopy(loads)
+    placements = []
+    for size_bytes in task_bytes:
+        best = None
+        for instance in instances:
+            load = loads[instance['arn']]
+            if load['tasks'] >= int(instance['max_tasks']):
+                continue
+            # a task larger than the byte cap still runs on an idle instance
+            if instance.get('max_bytes') and load['tasks'] and load['bytes'] + size_bytes > int(instance['max_bytes']):
+                continue
+            # ties go to the instance with fewer tasks, then fewer bytes
+            score = (get_load_score(instance, load, size_bytes), load['tasks'], load['bytes'])
+            if best is None or score < best[0]:
+                best = (score, instance)
+
+        if best is None:
+            logging.info(f'No instance of the pool has room for a task of {size_bytes} bytes, loads {loads}')
+            return None
+
+        loads[best[1]['arn']]['tasks'] += 1
+        loads[best[1]['arn']]['bytes'] += size_bytes
+        placements.append(best[1]['arn'])
+
+    return placements
+
+
+def get_reservation_key(instance_arn):
+    # the reservations share the placement table with the task records, under one item per instance
+    return {'replication_task_id': f'instance#{instance_arn}'}
+
+
+def get_reservations(table, instance_arns, now):
+    # version and live reservations of every instance, read before the loads are computed
+    reservations = {}
+    for instance_arn in instance_arns:
+        item = table.get_item(Key=get_reservation_key(instance_arn)).get('Item') or {}
+        reservations[instance_arn] = {
+            'version': int(item.get('version', 0)),
+            'reserved': {task_id: reservation for task_id, reservation in item.get('reserved', {}).items()
+                         if int(reservation['reserved_at']) + RESERVATION_SECONDS > now},
+        }
+    return reservations
+
+
+def add_reservations(loads, reservations, active_tasks, placing_task_ids=()):
+    # tasks placed by other executions and not created yet count like active tasks, the reservations
+    # of the tasks being placed again are replaced
+    active_task_ids = {task['replication_task_id'] for task in active_tasks} | set(placing_task_ids)
+    loads = copy.deepcopy(loads)
+    for instance_arn, record in reservations.items():
+        for task_id, reservation in record['reserved'].items():
+            if task_id not in active_task_ids and instance_arn in loads:
+                loads[instance_arn]['tasks'] += 1
+                loads[instance_arn]['bytes'] += int(reservation['bytes'])
+    return loads
+
+
+def write_reservations(table, instance_arn, record, reserved, now):
+    # the write only succeeds when no other execution changed the reservations of the instance since they were read
+    table.put_item(
+        Item=dict(get_reservation_key(instance_arn), version=record['version'] + 1, reserved=reserved,
+                  expires_at=now + RESERVATION_SECONDS),
+        ConditionExpression=RESERVATION_VERSION,
+        ExpressionAttributeValues={':version': record['version']})
+
+
+def reserve_placements(table, reservations, task_ids, placements, task_bytes, now):
+    # One conditional write per instance. When another execution placed a task on one of the instances
+    # meanwhile, the reservations already written are released and False asks the caller to place again.
+    tasks_by_instance = {}
+    for task_id, instance_arn, size_bytes in zip(task_ids, placements, task_bytes):
+        tasks_by_instance.setdefault(instance_arn, {})[task_id] = {'bytes': int(size_bytes), 'reserved_at': now}
+
+    reserved_instances = []
+    for instance_arn, tasks in tasks_by_instance.items():
+        record = reservations[instance_arn]
+        try:
+            write_reservations(table, instance_arn, record, dict(record['reserved'], **tasks), now)
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            logging.info(f'Reservations of {instance_arn} changed since they were read, placing the tasks again')
+            for reserved_arn in reserved_instances:
+                release_reservations(table, reserved_arn, list(tasks_by_instance[reserved_arn]), now)
+            return False
+        reserved_instances.append(instance_arn)
+
+    return True
+
+
+def release_reservations(table, instance_arn, task_ids, now, attempts=5):
+    # created or abandoned tasks give their reservation back, retried like the placement on a conflict
+    for _ in range(attempts):
+        record = get_reservations(table, [instance_arn], now)[instance_arn]
+        if not any(task_id in record['reserved'] for task_id in task_ids):
+            return
+        reserved = {task_id: reservation for task_id, reservation in record['reserved'].items() if task_id not in task_ids}
+        try:
+            write_reservations(table, instance_arn, record, reserved, now)
+            return
+        except table.meta.client.exceptions.ConditionalCheckFailedException:
+            continue
+    # the reservation expires after RESERVATION_SECONDS
+    logging.info(f'Reservations of {task_ids} on {instance_arn} left to expire')
@@ -0,0 +1,129 @@
+import csv
+import io
+import json
+import logging
+import os
+import re
+import boto3
+from task_settings import get_table_history, recommend_settings
+from wave_scheduler import build_waves, simulate, simulate_fifo
+
+
+# Configure logging
+LOGFORMAT = '[%(asctime)s]: %(levelname)s: %(message)s'
+logging.basicConfig(format=LOGFORMAT, datefmt='%Y-%m-%d %H:%M:%S')
+logging.getLogger().setLevel(logging.INFO)
+
+# inputs of the parent execution that are not passed on to the table executions
+PARENT_KEYS = ['action', 'tables', 'manifest', 'TableResults', 'schedule_estimate']
+
+
+def handler(event, context):
+    logging.info('request: {}'.format(json.dumps(event, default=str)))
+    if event.get('action') == 'summarize':
+        return summarize(event)
+    return plan(event)
+
+
+def load_manifest(manifest):
+    # s3://bucket/key of a JSON list of tables, or a CSV file with a header line
+    bucket, _, key = manifest.replace('s3://', '', 1).partition('/')
+    response = boto3.client('s3').get_object(Bucket=bucket, Key=key)
+    body = response['Body'].read().decode('utf-8')
+    if key.lower().endswith('.csv'):
+        return [{column: value for column, value in row.items() if value} for row in csv.DictReader(io.StringIO(body))]
+
+    tables = json.loads(body)
+    return tables['tables'] if isinstance(tables, dict) else tables
+
+
+def get_replication_task_id(table):
+    # DMS task identifiers only take letters, digits and single hyphens and start with a letter
+    task_id = re.sub('[^a-z0-9]+', '-', f'{table["schema_name"]}-{table["table_name"]}-{table["task_type"]}'.lower()).strip('-')
+    return task_id if task_id[:1].isalpha() else f'task-{task_id}'
+
+
+def get_expected_seconds(table_input):
+    # average duration of the earlier full loads of the table, as recorded by delete-dms-tasks
+    if table_input.get('expected_seconds') or not os.environ.get('dynamodb_table'):
+        return table_input.get('expected_seconds')
+    history = get_table_history(os.environ['dynamodb_table'], table_input['schema_name'], table_input['table_name'])
+    return recommend_settings(history)[1].get('expected_seconds')
+
+
+def plan(event):
+    # Every table becomes the input of one dms-app-load-dms-to-lake execution, the parent inputs are the
+    # defaults of each table. The tables are released in waves, see wave_scheduler.py.
+    tables = event['tables'] if event.get('tables') else load_manifest(event['manifest'])
+    defaults = {key: value for key, value in event.items() if key not in PARENT_KEYS}
+
+    table_inputs = []
+    for table in tables:
+        if isinstance(table, str):
+            schema_name, _, table_name = table.rpartition('.')
+            table = {'table_name': table_name, 'schema_name': schema_name} if schema_name else {'table_name': table_name}
+        table_input = dict(defaults, **table)
+        table_input.setdefault('task_type', 'full-load')
+        table_input.setdefault('tgt_schema_name', table_input['schema_name'])
+        table_input.setdefault('tgt_table_name', table_input['table_name'])
+        table_input.setdefault('replication_task_id', get_replication_task_id(table_input))
+        table_input['expected_seconds'] = get_expected_seconds(table_input)
+        table_inputs.append(table_input)
+
+    task_ids = [table_input['replication_task_id'] for table_input in table_inputs]
+    duplicates = sorted({task_id for task_id in task_ids if task_ids.count(task_id) > 1})
+    if duplicates:
+        raise ValueError(f'Tables listed more than once, replication task ids {duplicates}')
+
+    concurrency = int(os.environ.get('migration_max_concurrency', 8))
+    waves = build_waves(table_inputs)
+    estimate = simulate(waves, concurrency)
+    schedule_estimate = {
+        'wave_count': len(waves),
+        'concurrency': concurrency,
+        'makespan_seconds': estimate['makespan_seconds'],
+        'fifo_makespan_seconds': simulate_fifo(table_inputs, concurrency)['makespan_seconds'],
+        'sla_misses': estimate['sla_misses'],
+    }
+    logging.info(f'Migrating {len(table_inputs)} tables, schedule estimate {schedule_estimate}')
+    return {'waves': waves, 'table_count': len(table_inputs), 'schedule_estimate': schedule_estimate}
+
+
+def summarize(event):
+    # one entry per table execution from the results of every wave, failed executions carry the error
+    # caught by the Map state
+    table_results = [table_result for wave_results in event['TableResults'] for table_result in wave_results]
+    results = []
+    for table_result in table_results:
+        result = {
+            'schema_name': table_result['schema_name'],
+            'table_name': table_result['table_name'],
+            'replication_task_id': table_result['replication_task_id'],
+        }
+        if 'Execution' in table_result:
+            execution = table_result['Execution']
+            result.update({
+                'status': execution['Status'],
+                'execution_arn': execution['ExecutionArn'],
+                'duration_seconds': round((int(execution['StopDate']) - int(execution['StartDate'])) / 1000),
+            })
+        else:
+            error = table_result.get('ExecutionError', {})
+            result.update({'status': 'FAILED', 'error': error.get('Error'), 'cause': error.get('Cause')})
+        results.append(result)
+
+    status_counts = {}
+    for result in results:
+        status_counts[result['status']] = status_counts.get(result['status'], 0) + 1
+    durations = [result['duration_seconds'] for result in results if 'duration_seconds' in result]
+
+    summary = {
+        'table_count': len(results),
+        'status_counts': status_counts,
+        'failed_tables': [f'{result["schema_name"]}.{result["table_name"]}' for result in results if result['status'] != 'SUCCEEDED'],
+        'longest_table_seconds': max(durations) if durations else None,
+        'schedule_estimate': event.get('schedule_estimate'),
+        'tables': results,
+    }
+    logging.info(f'Migration summary: {json.dumps({key: value for key, value in summary.items() if key != "tables"})}')
+    return summary
@@ -0,0 +1,376 @@
+import json
+import logging
+
+
+class SplitDialect:
+    """SQL and connection backend used by get-splits for one source engine."""
+
+    source_type = None
+    secret_name = None
+    paramstyle = 'named'
+    block_sample = False
+
+    def connect(self, secrets):
+        raise NotImplementedError
+
+    def ping(self, connection):
+        try:
+            cursor = connection.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchall()
+            cursor.close()
+        except Exception:
+            return False
+        return True
+
+    def normalize_identifier(self, name):
+        return name
+
+    def param(self, name):
+        if self.paramstyle == 'pyformat':
+            return f'%({name})s'
+        return f':{name}'
+
+    def table_source(self, schema_name, table_name, sample_percent=None):
+        return f'{schema_name}.{table_name} A'
+
+    def sample_predicate(self, sample_percent):
+        # row level sampling for engines without block sampling, it still reads the table but sorts less
+        return f'RAND() * 100 < {sample_percent}'
+
+    def scan_hint(self):
+        return ''
+
+    def ntile_sql(self, schema_name, table_name, partition_key, num_segments, lower_bound=False, sample_percent=None,
+                  upper_bound=False):
+        # lower_bound and upper_bound restrict the scan to (:lower_bound, :upper_bound]
+        predicates = []
+        if lower_bound:
+            predicates.append(f"{partition_key} > {self.param('lower_bound')}")
+        if upper_bound:
+            predicates.append(f"{partition_key} <= {self.param('upper_bound')}")
+        if sample_percent and not self.block_sample:
+            predicates.append(self.sample_predicate(sample_percent))
+        where_clause = f"WHERE {' AND '.join(predicates)}" if predicates else ""
+        row_count = f"ROUND(COUNT(*) * 100 / {sample_percent})" if sample_percent else "COUNT(*)"
+
+        return f"SELECT '{schema_name}' SCHEMANAME,'{table_name}' TABLENAME,'{partition_key}' COLUMNNAME,MIN({partition_key}) COL_MIN,MAX({partition_key}) COL_MAX,{row_count} ROW_COUNT, NT BATCH \
+            FROM  (SELECT {self.scan_hint()} {partition_key},NTILE({num_segments}) OVER (ORDER BY {partition_key}) NT \
+                FROM {self.table_source(schema_name, table_name, sample_percent)} {where_clause}) S \
+                    GROUP BY NT \
+                        ORDER BY NT"
+
+    def composite_ntile_sql(self, schema_name, table_name, key_columns, num_segments, sample_percent=None):
+        # MAX per column is not the last key of a batch when there are several key columns, the batch
+        # boundary is the last row of each batch in key order instead
+        key_list = ', '.join(key_columns)
+        key_desc = ', '.join(f'{column} DESC' for column in key_columns)
+        where_clause = f"WHERE {self.sample_predicate(sample_percent)}" if sample_percent and not self.block_sample else ""
+        row_count = f"ROUND(COUNT(*) OVER (PARTITION BY NT) * 100 / {sample_percent})" if sample_percent else "COUNT(*) OVER (PARTITION BY NT)"
+
+        return f"SELECT '{schema_name}' SCHEMANAME,'{table_name}' TABLENAME,'{','.join(key_columns)}' COLUMNNAME,ROW_COUNT, NT BATCH, {key_list} \
+            FROM (SELECT {key_list}, NT, {row_count} ROW_COUNT, ROW_NUMBER() OVER (PARTITION BY NT ORDER BY {key_desc}) RN \
+                FROM (SELECT {self.scan_hint()} {key_list},NTILE({num_segments}) OVER (ORDER BY {key_list}) NT \
+                    FROM {self.table_source(schema_name, table_name, sample_percent)} {where_clause}) S) Q \
+                        WHERE RN = 1 \
+                            ORDER BY NT"
+
+    def get_column_type(self, cursor, schema_name, table_name, column_name):
+        cursor.execute(f"SELECT DATA_TYPE FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = {self.param('schema_name')} \
+            AND TABLE_NAME = {self.param('table_name')} AND COLUMN_NAME = {self.param('column_name')}",
+                       {'schema_name': schema_name, 'table_name': table_name, 'column_name': column_name})
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def tail_count_sql(self, schema_name, table_name, partition_key):
+        return f"SELECT COUNT(*) FROM {schema_name}.{table_name} WHERE {partition_key} > {self.param('lower_bound')}"
+
+    def min_max_sql(self, schema_name, table_name, partition_key):
+        # separate scalar subqueries so both ends are read with a MIN/MAX index probe
+        return f"SELECT (SELECT MIN({partition_key}) FROM {schema_name}.{table_name}), \
+            (SELECT MAX({partition_key}) FROM {schema_name}.{table_name})"
+
+    def get_num_rows(self, cursor, schema_name, table_name):
+        """Row count from the optimizer statistics, None when there are none."""
+        return None
+
+    def get_histogram(self, cursor, schema_name, table_name, partition_key):
+        """Key histogram as a list of (key value, cumulative fraction of rows), None when there is none."""
+        return None
+
+    def get_segment_bytes(self, cursor, schema_name, table_name):
+        """Allocated table size in bytes, None when it cannot be read."""
+        return None
+
+    def get_partitioning(self, cursor, schema_name, table_name):
+        """Native partitioning as a dict of partitioning_type, subpartitioning_type and partitions, None when not partitioned."""
+        return None
+
+
+class OracleDialect(SplitDialect):
+
+    source_type = 'oracle'
+    secret_name = 'oracle_creds'
+    block_sample = True
+    _client_initialized = False
+
+    def connect(self, secrets):
+        import cx_Oracle
+
+        if not OracleDialect._client_initialized:
+            cx_Oracle.init_oracle_client(lib_dir="/opt/lib")
+            OracleDialect._client_initialized = True
+
+        tns = f"(DESCRIPTION=(enable=broken)(ADDRESS=(PROTOCOL=TCP)(HOST={secrets['host']})(PORT={secrets['port']}))(LOAD_BALANCE=YES)(CONNECT_DATA=(SERVER=DEDICATED)(SERVICE_NAME={secrets['db_name']})(FAILOVER_MODE=(TYPE=SELECT)(METHOD=BASIC))))"
+        return cx_Oracle.Connection(user=secrets['username'], password=secrets['password'], dsn=tns, encoding="UTF-8", nencoding="UTF-8")
+
+    def ping(self, connection):
+        try:
+            connection.ping()
+        except Exception:
+            return False
+        return True
+
+    def normalize_identifier(self, name):
+        return name.upper()
+
+    def table_source(self, schema_name, table_name, sample_percent=None):
+        sample_clause = f'SAMPLE BLOCK ({sample_percent})' if sample_percent else ''
+        return f'{schema_name}.{table_name} {sample_clause} A'
+
+    def scan_hint(self):
+        return '/*+ FULL(A) PARALLEL(A,12) */'
+
+    def min_max_sql(self, schema_name, table_name, partition_key):
+        return super().min_max_sql(schema_name, table_name, partition_key) + " FROM DUAL"
+
+    def get_column_type(self, cursor, schema_name, table_name, column_name):
+        cursor.execute("SELECT CASE WHEN DATA_TYPE = 'NUMBER' AND DATA_SCALE = 0 THEN 'INTEGER' ELSE DATA_TYPE END \
+            FROM ALL_TAB_COLUMNS WHERE OWNER = :owner AND TABLE_NAME = :table_name AND COLUMN_NAME = :column_name",
+                       {'owner': schema_name, 'table_name': table_name, 'column_name': column_name})
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_num_rows(self, cursor, schema_name, table_name):
+        cursor.execute("SELECT NUM_ROWS FROM ALL_TABLES WHERE OWNER = :owner AND TABLE_NAME = :table_name",
+                       {'owner': schema_name, 'table_name': table_name})
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_histogram(self, cursor, schema_name, table_name, partition_key):
+        cursor.execute("SELECT ENDPOINT_NUMBER, ENDPOINT_VALUE FROM ALL_TAB_HISTOGRAMS H \
+            JOIN ALL_TAB_COL_STATISTICS S ON S.OWNER = H.OWNER AND S.TABLE_NAME = H.TABLE_NAME AND S.COLUMN_NAME = H.COLUMN_NAME \
+                WHERE H.OWNER = :owner AND H.TABLE_NAME = :table_name AND H.COLUMN_NAME = :column_name AND S.HISTOGRAM <> 'NONE' \
+                    ORDER BY ENDPOINT_NUMBER",
+                       {'owner': schema_name, 'table_name': table_name, 'column_name': partition_key})
+        endpoints = cursor.fetchall()
+        if not endpoints:
+            return None
+
+        # ENDPOINT_NUMBER is cumulative, a row count for frequency/hybrid histograms and
+        # a bucket number for height balanced ones, either way it normalizes to a CDF
+        total = endpoints[-1][0]
+        points = [(endpoints[0][1], 0.0)]
+        points.extend((value, number / total) for number, value in endpoints)
+        return points
+
+    def get_segment_bytes(self, cursor, schema_name, table_name):
+        # DBA_SEGMENTS needs SELECT_CATALOG_ROLE, without it the plan falls back to row counts
+        try:
+            cursor.execute("SELECT SUM(BYTES) FROM DBA_SEGMENTS WHERE OWNER = :owner AND SEGMENT_NAME = :table_name",
+                           {'owner': schema_name, 'table_name': table_name})
+        except Exception as ex:
+            logging.warning(f'Unable to read DBA_SEGMENTS for {schema_name}.{table_name}: {ex}')
+            return None
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_partitioning(self, cursor, schema_name, table_name):
+        cursor.execute("SELECT PARTITIONING_TYPE, SUBPARTITIONING_TYPE FROM ALL_PART_TABLES \
+            WHERE OWNER = :owner AND TABLE_NAME = :table_name",
+                       {'owner': schema_name, 'table_name': table_name})
+        row = cursor.fetchone()
+        if not row:
+            return None
+
+        cursor.execute("SELECT PARTITION_NAME FROM ALL_TAB_PARTITIONS \
+            WHERE TABLE_OWNER = :owner AND TABLE_NAME = :table_name ORDER BY PARTITION_POSITION",
+                       {'owner': schema_name, 'table_name': table_name})
+        return {
+            'partitioning_type': row[0],
+            'subpartitioning_type': None if row[1] in (None, 'NONE') else row[1],
+            'partitions': [partition[0] for partition in cursor.fetchall()],
+        }
+
+
+class PostgresDialect(SplitDialect):
+
+    source_type = 'postgres'
+    secret_name = 'postgres_creds'
+    paramstyle = 'pyformat'
+    block_sample = True
+
+    def connect(self, secrets):
+        import psycopg2
+
+        connection = psycopg2.connect(host=secrets['host'], port=secrets['port'], dbname=secrets['db_name'],
+                                      user=secrets['username'], password=secrets['password'])
+        # the connection is kept open between invocations, it must not sit idle in a transaction
+        connection.autocommit = True
+        return connection
+
+    def normalize_identifier(self, name):
+        return name.lower()
+
+    def table_source(self, schema_name, table_name, sample_percent=None):
+        sample_clause = f'TABLESAMPLE SYSTEM ({sample_percent})' if sample_percent else ''
+        return f'{schema_name}.{table_name} A {sample_clause}'
+
+    def get_num_rows(self, cursor, schema_name, table_name):
+        cursor.execute("SELECT C.RELTUPLES::BIGINT FROM PG_CLASS C JOIN PG_NAMESPACE N ON N.OID = C.RELNAMESPACE \
+            WHERE N.NSPNAME = %(schema_name)s AND C.RELNAME = %(table_name)s",
+                       {'schema_name': schema_name, 'table_name': table_name})
+        row = cursor.fetchone()
+        # reltuples is -1 until the table is analyzed
+        return row[0] if row and row[0] >= 0 else None
+
+    def get_histogram(self, cursor, schema_name, table_name, partition_key):
+        cursor.execute("SELECT HISTOGRAM_BOUNDS::TEXT::NUMERIC[] FROM PG_STATS \
+            WHERE SCHEMANAME = %(schema_name)s AND TABLENAME = %(table_name)s AND ATTNAME = %(column_name)s",
+                       {'schema_name': schema_name, 'table_name': table_name, 'column_name': partition_key})
+        row = cursor.fetchone()
+        if not row or not row[0]:
+            return None
+
+        # histogram_bounds are equi-depth, each bucket holds the same share of the rows
+        bounds = [float(value) for value in row[0]]
+        return [(value, index / (len(bounds) - 1)) for index, value in enumerate(bounds)]
+
+    def get_segment_bytes(self, cursor, schema_name, table_name):
+        cursor.execute("SELECT PG_TABLE_SIZE(C.OID) FROM PG_CLASS C JOIN PG_NAMESPACE N ON N.OID = C.RELNAMESPACE \
+            WHERE N.NSPNAME = %(schema_name)s AND C.RELNAME = %(table_name)s",
+                       {'schema_name': schema_name, 'table_name': table_name})
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_partitioning(self, cursor, schema_name, table_name):
+        cursor.execute("SELECT PT.PARTSTRAT, CHILD.RELNAME FROM PG_PARTITIONED_TABLE PT \
+            JOIN PG_CLASS C ON C.OID = PT.PARTRELID JOIN PG_NAMESPACE N ON N.OID = C.RELNAMESPACE \
+                LEFT JOIN PG_INHERITS I ON I.INHPARENT = C.OID LEFT JOIN PG_CLASS CHILD ON CHILD.OID = I.INHRELID \
+                    WHERE N.NSPNAME = %(schema_name)s AND C.RELNAME = %(table_name)s ORDER BY CHILD.RELNAME",
+                       {'schema_name': schema_name, 'table_name': table_name})
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+
+        partition_types = {'r': 'RANGE', 'l': 'LIST', 'h': 'HASH'}
+        return {
+            'partitioning_type': partition_types.get(rows[0][0], rows[0][0]),
+            'subpartitioning_type': None,
+            'partitions': [row[1] for row in rows if row[1]],
+        }
+
+
+class MySqlDialect(SplitDialect):
+
+    source_type = 'mysql'
+    secret_name = 'mysql_creds'
+    paramstyle = 'pyformat'
+
+    def connect(self, secrets):
+        import pymysql
+
+        return pymysql.connect(host=secrets['host'], port=int(secrets['port']), database=secrets['db_name'],
+                               user=secrets['username'], password=secrets['password'], autocommit=True)
+
+    def get_num_rows(self, cursor, schema_name, table_name):
+        cursor.execute("SELECT TABLE_ROWS FROM INFORMATION_SCHEMA.TABLES \
+            WHERE TABLE_SCHEMA = %(schema_name)s AND TABLE_NAME = %(table_name)s",
+                       {'schema_name': schema_name, 'table_name': table_name})
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_histogram(self, cursor, schema_name, table_name, partition_key):
+        cursor.execute("SELECT HISTOGRAM FROM INFORMATION_SCHEMA.COLUMN_STATISTICS \
+            WHERE SCHEMA_NAME = %(schema_name)s AND TABLE_NAME = %(table_name)s AND COLUMN_NAME = %(column_name)s",
+                       {'schema_name': schema_name, 'table_name': table_name, 'column_name': partition_key})
+        row = cursor.fetchone()
+        if not row:
+            return None
+
+        histogram = json.loads(row[0]) if isinstance(row[0], str) else row[0]
+        points = []
+        for bucket in histogram['buckets']:
+            if histogram['histogram-type'] == 'singleton':
+                # [value, cumulative frequency]
+                points.append((bucket[0], bucket[1]))
+            else:
+                # [lower value, upper value, cumulative frequency, distinct values]
+                points.append((bucket[0], points[-1][1] if points else 0.0))
+                points.append((bucket[1], bucket[2]))
+        if not points:
+            return None
+
+        # the frequencies leave out NULL keys, rescale so the CDF ends at 1
+        total = points[-1][1]
+        return [(points[0][0], 0.0)] + [(value, fraction / total) for value, fraction in points]
+
+    def get_segment_bytes(self, cursor, schema_name, table_name):
+        cursor.execute("SELECT DATA_LENGTH FROM INFORMATION_SCHEMA.TABLES \
+            WHERE TABLE_SCHEMA = %(schema_name)s AND TABLE_NAME = %(table_name)s",
+                       {'schema_name': schema_name, 'table_name': table_name})
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_partitioning(self, cursor, schema_name, table_name):
+        cursor.execute("SELECT PARTITION_METHOD, SUBPARTITION_METHOD, PARTITION_NAME FROM INFORMATION_SCHEMA.PARTITIONS \
+            WHERE TABLE_SCHEMA = %(schema_name)s AND TABLE_NAME = %(table_name)s AND PARTITION_NAME IS NOT NULL \
+                ORDER BY PARTITION_ORDINAL_POSITION",
+                       {'schema_name': schema_name, 'table_name': table_name})
+        rows = cursor.fetchall()
+        if not rows:
+            return None
+
+        partitions = []
+        for row in rows:
+            # one row per subpartition
+            if row[2] not in partitions:
+                partitions.append(row[2])
+        return {
+            'partitioning_type': rows[0][0],
+            'subpartitioning_type': rows[0][1],
+            'partitions': partitions,
+        }
+
+
+class SqliteDialect(SplitDialect):
+    """Local stand-in used to exercise the split engine without a source database."""
+
+    source_type = 'sqlite'
+
+    def connect(self, secrets):
+        import sqlite3
+
+        return sqlite3.connect(secrets['db_name'])
+
+    def sample_predicate(self, sample_percent):
+        return f'ABS(RANDOM()) % 100 < {sample_percent}'
+
+    def get_column_type(self, cursor, schema_name, table_name, column_name):
+        cursor.execute(f"PRAGMA {schema_name}.TABLE_INFO({table_name})")
+        for column in cursor.fetchall():
+            if column[1].lower() == column_name.lower():
+                return column[2]
+        return None
+
+
+DIALECTS = {
+    dialect.source_type: dialect for dialect in (OracleDialect, PostgresDialect, MySqlDialect, SqliteDialect)
+}
+
+
+def get_dialect(source_type):
+    try:
+        return DIALECTS[source_type.lower()]()
+    except KeyError:
+        raise ValueError(f'Unsupported source type {source_type}, expected one of {list(DIALECTS)}')
@@ -0,0 +1,234 @@
+import logging
+import math
+import statistics
+from datetime import date, datetime
+from decimal import Decimal
+
+
+# Columns returned by the ntile query, the estimators return rows in the same layout
+NTILE_COLUMNS = ['SCHEMANAME', 'TABLENAME', 'COLUMNNAME', 'COL_MIN', 'COL_MAX', 'ROW_COUNT', 'BATCH']
+
+SPLIT_METHODS = ['ntile', 'histogram', 'sample', 'interpolate']
+
+# Integer types of the dialects, Oracle reports a NUMBER of scale 0 as INTEGER
+INTEGER_TYPES = ('INTEGER', 'INT', 'BIGINT', 'SMALLINT', 'TINYINT', 'MEDIUMINT', 'INT2', 'INT4', 'INT8')
+
+
+def get_key_family(data_type):
+    # unknown types keep the historical numeric handling
+    data_type = (data_type or 'NUMBER').upper()
+    if 'DATE' in data_type or 'TIME' in data_type:
+        return 'datetime'
+    if any(name in data_type for name in ('NUMBER', 'INT', 'NUMERIC', 'DECIMAL', 'FLOAT', 'DOUBLE', 'REAL')):
+        return 'numeric'
+    return 'string'
+
+
+def is_integer_type(data_type):
+    # a numeric key of another type can hold values between two integers
+    return (data_type or '').upper().split('(')[0].split(' ')[0] in INTEGER_TYPES
+
+
+def get_split_cache_key(edp_owner, table_name, partition_key, num_segments, split_method, sample_percent=None,
+                        skew_threshold=None, segment_target=None):
+    # Boundaries are only reused for a request computing them the same way: estimated boundaries are not
+    # returned for an exact ntile request and the other way around
+    split_key = f'{edp_owner}.{table_name}.{partition_key}.{num_segments}'
+    if num_segments == 'auto':
+        split_key += f'.{segment_target}'
+    split_key += f'.{split_method}'
+    if split_method == 'sample':
+        split_key += f'.{sample_percent}'
+    if skew_threshold:
+        split_key += f'.skew{skew_threshold}'
+    return split_key
+
+
+def format_key_value(value):
+    # DMS takes boundaries as strings, dates and timestamps in ISO format and numbers without a trailing .0
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S.%f' if value.microsecond else '%Y-%m-%d %H:%M:%S')
+    if isinstance(value, date):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, (float, Decimal)) and value == int(value):
+        return str(int(value))
+    return str(value)
+
+
+def get_composite_ntile_splits(dialect, cursor, edp_owner, table_name, key_columns, num_segments, sample_percent=None):
+    cursor.execute(dialect.composite_ntile_sql(edp_owner, table_name, key_columns, num_segments, sample_percent))
+    # same layout as the ntile query with the key tuple of the last row as COL_MAX
+    return [(row[0], row[1], row[2], None, tuple(row[5:]), row[3], row[4]) for row in cursor.fetchall()]
+
+
+def cdf_quantile(points, fraction):
+    # points is a list of (key value, cumulative fraction of rows) sorted by key
+    prev_value, prev_fraction = points[0]
+    for value, cum_fraction in points:
+        if cum_fraction >= fraction:
+            if cum_fraction == prev_fraction:
+                return value
+            return prev_value + (value - prev_value) * (fraction - prev_fraction) / (cum_fraction - prev_fraction)
+        prev_value, prev_fraction = value, cum_fraction
+
+    return points[-1][0]
+
+
+def cdf_fraction(points, key_value):
+    if key_value >= points[-1][0]:
+        return 1.0
+
+    prev_value, prev_fraction = points[0]
+    for value, cum_fraction in points:
+        if value > key_value:
+            if value == prev_value:
+                return prev_fraction
+            return prev_fraction + (cum_fraction - prev_fraction) * (key_value - prev_value) / (value - prev_value)
+        prev_value, prev_fraction = value, cum_fraction
+
+    return 1.0
+
+
+def build_estimated_rows(edp_owner, table_name, partition_key, points, num_rows, num_segments, integer_key=True):
+    # NUMBER, NUMERIC and DECIMAL keys come back as Decimal, which does not mix with the float fractions.
+    # An integer key is split on whole values and the next segment starts at the next integer, other keys
+    # keep the fractional boundary and the next segment starts above it, as the gte/noteq filters of create-dms-tasks
+    # fractional boundaries are rounded to the scale of the key values, a finer boundary splits no rows
+    scale = max(max(-Decimal(str(value)).as_tuple().exponent, 0) for value, _ in points)
+    points = [(float(value), float(cum_fraction)) for value, cum_fraction in points]
+    boundaries = []
+    for segment in range(1, int(num_segments) + 1):
+        boundary = cdf_quantile(points, segment / int(num_segments))
+        boundary = int(boundary) if integer_key else round(boundary, scale)
+        # a single heavy key value can map several quantiles to the same boundary
+        if boundaries and boundary <= boundaries[-1]:
+            continue
+        boundaries.append(boundary)
+
+    rows = []
+    col_min, prev_fraction = int(points[0][0]) if integer_key else points[0][0], 0.0
+    for batch, boundary in enumerate(boundaries, start=1):
+        fraction = cdf_fraction(points, boundary)
+        rows.append((edp_owner, table_name, partition_key, col_min, boundary,
+                     int(round((fraction - prev_fraction) * num_rows)), batch))
+        col_min, prev_fraction = boundary + 1 if integer_key else boundary, fraction
+
+    return rows
+
+
+def estimate_skew(rows):
+    # ratio of the heaviest segment to the mean segment, 1.0 is a perfect balance
+    row_counts = [int(row[5]) for row in rows]
+    if not row_counts or sum(row_counts) == 0:
+        return None
+
+    mean_rows = sum(row_counts) / len(row_counts)
+    return round(max(row_counts) / mean_rows, 2)
+
+
+def get_segment_stats(rows):
+    return [{'batch': int(row[6]),
+             'col_min': None if row[3] is None else format_key_value(row[3]),
+             'col_max': ','.join(format_key_value(value) for value in row[4]) if isinstance(row[4], tuple) else format_key_value(row[4]),
+             'row_count': int(row[5])}
+            for row in rows]
+
+
+def merge_duplicate_boundaries(rows):
+    # a single key value heavier than a segment comes back from NTILE as several batches with the same
+    # COL_MAX, DMS needs strictly increasing boundaries so those batches are folded into one
+    merged = []
+    for row in rows:
+        if merged and merged[-1][4] == row[4]:
+            merged[-1] = merged[-1][:5] + (int(merged[-1][5]) + int(row[5]), merged[-1][6])
+        else:
+            merged.append(tuple(row))
+
+    return [row[:6] + (batch,) for batch, row in enumerate(merged, start=1)]
+
+
+def resplit_heavy_segments(dialect, cursor, edp_owner, table_name, partition_key, rows, skew_threshold, max_segments):
+    # Segments holding more than skew_threshold times the median rows get a second NTILE inside their
+    # own key range, so a hot range no longer sets the wall-clock time of the whole full load.
+    if len(rows) < 2:
+        return rows
+
+    median_rows = statistics.median(int(row[5]) for row in rows)
+    if median_rows == 0:
+        return rows
+
+    spare_segments = int(max_segments) - len(rows)
+    resplit_rows = []
+    prev_max = None
+    for row in rows:
+        row_count = int(row[5])
+        if row_count > float(skew_threshold) * median_rows and spare_segments > 0:
+            pieces = min(math.ceil(row_count / median_rows), spare_segments + 1)
+            params = {'upper_bound': row[4]}
+            if prev_max is not None:
+                params['lower_bound'] = prev_max
+            cursor.execute(dialect.ntile_sql(edp_owner, table_name, partition_key, pieces,
+                                             lower_bound=prev_max is not None, upper_bound=True), params)
+            sub_rows = merge_duplicate_boundaries(cursor.fetchall())
+            logging.info(f'Segment {row[6]} with {row_count} rows (median {median_rows}) split into {len(sub_rows)}')
+            spare_segments -= len(sub_rows) - 1
+            resplit_rows.extend(sub_rows)
+        else:
+            resplit_rows.append(row)
+        prev_max = row[4]
+
+    return merge_duplicate_boundaries(resplit_rows)
+
+
+def get_num_rows(dialect, cursor, edp_owner, table_name):
+    num_rows = dialect.get_num_rows(cursor, edp_owner, table_name)
+    if num_rows is None:
+        logging.warning(f'No optimizer statistics for {edp_owner}.{table_name}, counting rows')
+        cursor.execute(f"SELECT COUNT(*) FROM {edp_owner}.{table_name}")
+        num_rows = cursor.fetchone()[0]
+
+    return num_rows
+
+
+def plan_num_segments(dialect, cursor, edp_owner, table_name, target_rows_per_segment=None,
+                      target_bytes_per_segment=None, max_segments=49):
+    # Size the split from the table instead of a hand-picked count. Bytes win over rows when a byte
+    # target is given and the source reports the segment size, the count is capped by MaxFullLoadSubTasks.
+    segment_bytes = dialect.get_segment_bytes(cursor, edp_owner, table_name) if target_bytes_per_segment else None
+    if segment_bytes:
+        num_rows = None
+        num_segments = math.ceil(int(segment_bytes) / int(target_bytes_per_segment))
+    else:
+        num_rows = get_num_rows(dialect, cursor, edp_owner, table_name)
+        num_segments = math.ceil(int(num_rows) / int(target_rows_per_segment))
+
+    return {
+        'num_segments': min(max(num_segments, 1), int(max_segments)),
+        'row_count': int(num_rows) if num_rows is not None else None,
+        'segment_bytes': int(segment_bytes) if segment_bytes else None,
+        'target_rows_per_segment': target_rows_per_segment,
+        'target_bytes_per_segment': target_bytes_per_segment,
+        'max_segments': int(max_segments),
+    }
+
+
+def get_interpolated_splits(dialect, cursor, edp_owner, table_name, partition_key, num_segments, integer_key=True):
+    cursor.execute(dialect.min_max_sql(edp_owner, table_name, partition_key))
+    col_min, col_max = cursor.fetchone()
+    if col_min is None:
+        return []
+
+    num_rows = get_num_rows(dialect, cursor, edp_owner, table_name)
+    points = [(col_min, 0.0), (col_max, 1.0)]
+    return build_estimated_rows(edp_owner, table_name, partition_key, points, num_rows, num_segments, integer_key)
+
+
+def get_histogram_splits(dialect, cursor, edp_owner, table_name, partition_key, num_segments, integer_key=True):
+    points = dialect.get_histogram(cursor, edp_owner, table_name, partition_key)
+    if not points:
+        logging.warning(f'No histogram on {edp_owner}.{table_name}.{partition_key}, using min/max interpolation')
+        return get_interpolated_splits(dialect, cursor, edp_owner, table_name, partition_key, num_segments, integer_key)
+
+    logging.info(f'Histogram with {len(points)} points on {edp_owner}.{table_name}.{partition_key}')
+    num_rows = get_num_rows(dialect, cursor, edp_owner, table_name)
+    return build_estimated_rows(edp_owner, table_name, partition_key, points, num_rows, num_segments, integer_key)
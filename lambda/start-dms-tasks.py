@@ -2,6 +2,8 @@ from importlib.resources import path
 import os
 import logging
 import boto3
+from datetime import datetime, timezone
+from dms_resolver import call_with_arn, resolver_stats
 
 # Configure logging
 logformat = f'[%(asctime)s]: %(levelname)s: %(message)s'
@@ -16,55 +18,41 @@ def handler(event, context):
 
 def main(event):
     replication_task_id = event['replication_task_id']
-    schema_name = event['schema_name']
-    table_name = event['table_name']
+    # tasks of a task group carry their tables, a packed task loads several
+    tables = event.get('tables') or [{'schema_name': event['schema_name'], 'table_name': event['table_name']}]
     task_type = event['task_type']
     dynamodb_table = os.environ['dynamodb_table']
     s3_bucket_name = os.environ['dms_bucket_name']
     try:
         client = boto3.client('dms')
-        start_replication_task = client.start_replication_task(
-            ReplicationTaskArn= get_replication_task_arn(client, replication_task_id),
-            StartReplicationTaskType='start-replication',
-        )
+        # a stop of the task only ends the wait of the execution when the task started after this call
+        event['task_started_at'] = datetime.now(timezone.utc).isoformat()
+        start_replication_task = call_with_arn(client, 'replication-task', replication_task_id,
+                                               lambda task_arn: client.start_replication_task(
+                                                   ReplicationTaskArn=task_arn,
+                                                   # a reused task reloads the target of its earlier run
+                                                   StartReplicationTaskType=event.get('start_type', 'start-replication'),
+                                               ))
    
         response = start_replication_task['ReplicationTask']
         
-        update_task_status(response, schema_name,table_name, dynamodb_table, task_type)
+        for table in tables:
+            update_task_status(response, table['schema_name'], table['table_name'], dynamodb_table, task_type, event.get('task_group_id'))
+        event['arn_resolver_stats'] = dict(resolver_stats)
     
     except Exception as ex:
         raise ex
     return event
 
 
-def get_replication_task_arn(client, replication_task_id):
-    try:
-        response = client.describe_replication_tasks(
-        Filters=[
-            {
-                'Name': 'replication-task-id',
-                'Values': [
-                    replication_task_id
-                ]
-            }
-        ]
-    )
-    
-    except Exception as ex:
-        raise ex
-    
-    task_arn = response['ReplicationTasks'][0]['ReplicationTaskArn']
-    
-    return task_arn
-
-def update_task_status(response, schema_name, table_name, dynamodb_table_name, task_type):
+def update_task_status(response, schema_name, table_name, dynamodb_table_name, task_type, task_group_id=None):
     
     #path = f"s3://{dms_bucket}/dmstarget/{schema_name}/{table_name}"
     
+    # the item written by create-dms-tasks is updated and keeps its group_index and size_bytes, the
+    # settings recommendation of the next run reads the size
     dynamodb_record = {
-        "taskid" : response['ReplicationTaskIdentifier'],
         "schema_name": schema_name,
-        'tablename': table_name,
         'task_type': task_type,
         "task_status" : response['Status'],
         "source_endpoint_arn" : response['SourceEndpointArn'],
@@ -72,11 +60,18 @@ def update_task_status(response, schema_name, table_name, dynamodb_table_name, t
         "replication_instance_arn" : response['ReplicationInstanceArn'],
         "task_start_time" : str(response['ReplicationTaskStartDate'])
     }
+    if task_group_id:
+        dynamodb_record['task_group_id'] = task_group_id
 
     try:
         dyndb = boto3.resource('dynamodb')
         table = dyndb.Table(dynamodb_table_name)
-        resp = table.put_item(TableName=dynamodb_table_name, Item=dynamodb_record)
+        resp = table.update_item(
+                    Key={'taskid': response['ReplicationTaskIdentifier'], 'tablename': table_name},
+                    UpdateExpression='SET ' + ', '.join(f'#{name} = :{name}' for name in dynamodb_record),
+                    ExpressionAttributeNames={f'#{name}': name for name in dynamodb_record},
+                    ExpressionAttributeValues={f':{name}': value for name, value in dynamodb_record.items()},
+                )
         
     except Exception as ex:
         raise ex
\ No newline at end of file
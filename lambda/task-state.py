@@ -0,0 +1,152 @@
+import json
+import logging
+import os
+import time
+import boto3
+from datetime import datetime
+from botocore.exceptions import ClientError
+
+
+# Configure logging
+LOGFORMAT = '[%(asctime)s]: %(levelname)s: %(message)s'
+logging.basicConfig(format=LOGFORMAT, datefmt='%Y-%m-%d %H:%M:%S')
+logging.getLogger().setLevel(logging.INFO)
+
+# states that end a wait, per resource type and what the execution waits for
+TARGET_STATUSES = {
+    ('dms-task', 'creation'): ['ready', 'failed'],
+    ('dms-task', 'completion'): ['stopped', 'failed'],
+    ('dms-task', 'cdc-start'): ['running', 'failed', 'stopped'],
+    ('emr-job', 'completion'): ['SUCCESS', 'FAILED', 'CANCELLED'],
+}
+
+
+def handler(event, context):
+    # EventBridge state change events, fallback polls and token registrations share one function
+    if 'detail-type' in event:
+        return on_state_change(event)
+    if event.get('action') == 'poll':
+        return poll(event)
+    return register(event)
+
+
+def get_token_table():
+    dyndb = boto3.resource('dynamodb')
+    return dyndb.Table(os.environ['task_token_table'])
+
+
+def get_wait_for(request):
+    if request['resource_type'] == 'dms-task' and request['wait_for'] == 'completion' and request.get('task_type') == 'cdc':
+        return 'cdc-start'
+    return request['wait_for']
+
+
+def describe_resource(request):
+    # the output has the shape of the describe call the state machine used before, so the
+    # Choice states read the status from the same path
+    if request['resource_type'] == 'emr-job':
+        client = boto3.client('emr-serverless')
+        response = client.get_job_run(applicationId=request['application_id'], jobRunId=request['resource_id'])
+        return response['jobRun']['state'], {'JobRun': {'State': response['jobRun']['state'],
+                                                        'StateDetails': response['jobRun'].get('stateDetails')}}
+
+    client = boto3.client('dms')
+    response = client.describe_replication_tasks(
+        Filters=[
+            {
+                'Name': 'replication-task-arn',
+                'Values': [
+                    request['resource_id'],
+                ]
+            },
+        ],
+        WithoutSettings=True
+    )
+    replication_task = response['ReplicationTasks'][0]
+    return replication_task['Status'], json.loads(json.dumps({'ReplicationTasks': response['ReplicationTasks']}, default=str))
+
+
+def is_target_status(request, status, details):
+    if status not in TARGET_STATUSES[(request['resource_type'], get_wait_for(request))]:
+        return False
+    # A restarted task is still stopped from its earlier run until DMS picks up the start, a stop only
+    # counts when the task was started after the start call of this execution.
+    if request['resource_type'] == 'dms-task' and status == 'stopped' and request.get('started_at'):
+        start_date = details['ReplicationTasks'][0].get('ReplicationTaskStartDate')
+        return bool(start_date) and datetime.fromisoformat(start_date) >= datetime.fromisoformat(request['started_at'])
+    return True
+
+
+def send_task_success(token, details):
+    try:
+        boto3.client('stepfunctions').send_task_success(taskToken=token, output=json.dumps(details))
+        return True
+    except ClientError as e:
+        # the wait timed out and the execution moved on to polling
+        logging.warning(f'Task token no longer valid: {e}')
+        return False
+
+
+def register(event):
+    # Stores the task token of a waiting execution under the resource it waits for. The resource can
+    # have reached the target state before the token was stored, so the state is checked once here.
+    table = get_token_table()
+    table.put_item(Item={
+        'resource_id': event['resource_id'],
+        'token': event['token'],
+        'request': json.dumps({key: value for key, value in event.items() if key != 'token'}),
+        'expires_at': int(time.time()) + int(os.environ.get('task_token_ttl', 86400)),
+    })
+
+    status, details = describe_resource(event)
+    if is_target_status(event, status, details):
+        logging.info(f'{event["resource_id"]} already {status}')
+        table.delete_item(Key={'resource_id': event['resource_id']})
+        send_task_success(event['token'], details)
+
+    return {'resource_id': event['resource_id'], 'status': status}
+
+
+def on_state_change(event):
+    if event['source'] == 'aws.emr-serverless':
+        resource_id = event['detail']['jobRunId']
+    else:
+        resource_id = event['resources'][0]
+
+    table = get_token_table()
+    item = table.get_item(Key={'resource_id': resource_id}).get('Item')
+    if not item:
+        return {'resource_id': resource_id, 'waiting': False}
+
+    request = json.loads(item['request'])
+    status, details = describe_resource(request)
+    logging.info(f'{event["detail-type"]} for {resource_id}, status {status}')
+    if is_target_status(request, status, details):
+        # the conditional delete makes sure only one event resumes the execution
+        try:
+            table.delete_item(Key={'resource_id': resource_id}, ConditionExpression='#token = :token',
+                              ExpressionAttributeNames={'#token': 'token'}, ExpressionAttributeValues={':token': item['token']})
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return {'resource_id': resource_id, 'waiting': False}
+            raise
+        send_task_success(item['token'], details)
+
+    return {'resource_id': resource_id, 'waiting': True, 'status': status}
+
+
+def poll(event):
+    # Fallback when no event resumed the execution in time, the state machine then registers a new token
+    # timing out after wait_seconds. The wait doubles after every poll and is capped by a quarter of the
+    # expected duration of the load, within the configured bounds.
+    status, details = describe_resource(event)
+    done = is_target_status(event, status, details)
+    if done:
+        get_token_table().delete_item(Key={'resource_id': event['resource_id']})
+
+    min_wait = int(os.environ.get('poll_min_seconds', 15))
+    max_wait = int(os.environ.get('poll_max_seconds', 300))
+    max_wait = min(max(int(event['expected_seconds'] or 0) // 4, min_wait), max_wait) if event.get('expected_seconds') else max_wait
+    wait_seconds = min(max(int(event.get('wait_seconds') or 0) * 2, min_wait), max_wait)
+
+    return {'done': done, 'status': status, 'wait_seconds': wait_seconds, 'result': details}
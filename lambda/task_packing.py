@@ -0,0 +1,42 @@
+import json
+import logging
+
+
+def pack_tables(tables, max_task_bytes, max_tables_per_task, default_table_bytes=0):
+    # First fit decreasing: the largest tables are placed first, each into the first task with room left
+    # for its size and one more table. A table larger than max_task_bytes gets a task of its own.
+    tasks = []
+    for table in sorted(tables, key=lambda table: int(table.get('size_bytes') or default_table_bytes), reverse=True):
+        size_bytes = int(table.get('size_bytes') or default_table_bytes)
+        if size_bytes > int(max_task_bytes):
+            logging.warning(f'{table["schema_name"]}.{table["table_name"]} is larger than {max_task_bytes} bytes, '
+                            'it is loaded by a task of its own')
+        for task in tasks:
+            if len(task['tables']) < int(max_tables_per_task) and task['size_bytes'] + size_bytes <= int(max_task_bytes):
+                task['tables'].append(table)
+                task['size_bytes'] += size_bytes
+                break
+        else:
+            tasks.append({'tables': [table], 'size_bytes': size_bytes})
+
+    return tasks
+
+
+def build_packed_mappings(tables, table_splits=None):
+    # One selection rule per table, tables with a parallel-load split from get-splits keep their own
+    # rules. Rule ids and names must be unique within the task so they are numbered again.
+    rules = []
+    for table in tables:
+        splits_json_data = (table_splits or {}).get(table['table_name'], {}).get('splits_json_data')
+        if splits_json_data:
+            rules.extend(json.loads(splits_json_data)['rules'])
+        else:
+            rules.append({"rule-type": "selection", "rule-id": "1", "rule-name": "1",
+                          "object-locator": {"schema-name": table['schema_name'], "table-name": table['table_name']},
+                          "rule-action": "include"})
+
+    for rule_id, rule in enumerate(rules, start=1):
+        rule['rule-id'] = str(rule_id)
+        rule['rule-name'] = str(rule_id)
+
+    return json.dumps({"rules": rules})
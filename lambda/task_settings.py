@@ -0,0 +1,113 @@
+import copy
+import json
+import logging
+import os
+from datetime import datetime
+import boto3
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+
+# Bytes of source rows DMS commits to the target at once, 10000 rows of 1 KB with the DMS defaults.
+# Narrow rows get a larger CommitRate and buffer and wide rows a smaller one to avoid swapping.
+TARGET_COMMIT_BYTES = 10 * 1024 ** 2
+COMMIT_RATE_RANGE = (1000, 50000)
+PARALLEL_LOAD_BUFFER_RANGE = (5, 1000)
+HISTORY_RUNS = 5
+
+
+def merge_settings(base, override):
+    # nested sections are merged key by key, the override wins on conflicts
+    merged = copy.deepcopy(base)
+    for key, value in (override or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge_settings(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def clamp(value, value_range):
+    return int(min(max(value, value_range[0]), value_range[1]))
+
+
+def get_table_history(dynamodb_table_name, schema_name, table_name, max_runs=HISTORY_RUNS):
+    # earlier full loads of the table with the statistics stored by delete-dms-tasks, latest first
+    try:
+        dyndb = boto3.resource('dynamodb')
+        table = dyndb.Table(dynamodb_table_name)
+        resp = table.query(IndexName='tablename-index', KeyConditionExpression=Key('tablename').eq(table_name))
+    except ClientError as e:
+        logging.error(f'Error reading the run history of {schema_name}.{table_name}: {e}')
+        return []
+
+    runs = [item for item in resp['Items']
+            if item.get('table_statistics') and item.get('last_full_load_date')
+            and item.get('schema_name', schema_name).lower() == schema_name.lower()]
+    runs.sort(key=lambda item: datetime.strptime(item['last_full_load_date'], "%d/%m/%Y %H:%M:%S"), reverse=True)
+    return runs[:max_runs]
+
+
+def recommend_settings(history, size_bytes=None):
+    # Row width drives CommitRate and ParallelLoadBufferSize, it comes from the table size and the
+    # rows loaded by the latest run. The throughput of earlier runs is only reported.
+    recommendation = {}
+    report = {'history_runs': len(history)}
+    if not history:
+        return recommendation, report
+
+    full_load_rows = int(history[0]['table_statistics'].get('FullLoadRows', 0))
+    size_bytes = size_bytes or history[0].get('size_bytes')
+    elapsed_millis = [int(run['replication_details']['ElapsedTimeMillis']) for run in history
+                      if run.get('replication_details', {}).get('ElapsedTimeMillis')]
+    if elapsed_millis:
+        report['expected_seconds'] = round(sum(elapsed_millis) / len(elapsed_millis) / 1000)
+    if elapsed_millis and full_load_rows:
+        report['rows_per_second'] = round(full_load_rows * 1000 / max(sum(elapsed_millis) / len(elapsed_millis), 1))
+
+    if size_bytes and full_load_rows:
+        avg_row_bytes = max(int(size_bytes) / full_load_rows, 1)
+        commit_rate = clamp(TARGET_COMMIT_BYTES / avg_row_bytes, COMMIT_RATE_RANGE)
+        report['avg_row_bytes'] = round(avg_row_bytes)
+        recommendation = {
+            'FullLoadSettings': {'CommitRate': commit_rate},
+            'TargetMetadata': {'ParallelLoadBufferSize': clamp(commit_rate / 200, PARALLEL_LOAD_BUFFER_RANGE)},
+        }
+
+    return recommendation, report
+
+
+def get_profile_name(event, table_profiles):
+    if event.get('settings_profile'):
+        return event['settings_profile']
+    if event.get('table_name'):
+        return table_profiles.get(f'{event["schema_name"]}.{event["table_name"]}'.upper())
+    return None
+
+
+def build_task_settings(event, dynamodb_table_name):
+    # default < recommendations from earlier runs < CDC profile < table or class profile < execution overrides
+    profiles = json.loads(os.environ.get('task_settings_profiles', '{}'))
+    table_profiles = {name.upper(): profile for name, profile in json.loads(os.environ.get('table_settings_profiles', '{}')).items()}
+    max_full_load_subtasks = int(os.environ.get('max_full_load_subtasks', 49))
+
+    settings = merge_settings({"FullLoadSettings": {"MaxFullLoadSubTasks": max_full_load_subtasks},
+                               "Logging": {"EnableLogging": True}}, profiles.get('default'))
+
+    history = get_table_history(dynamodb_table_name, event['schema_name'], event['table_name']) if event.get('table_name') else []
+    recommendation, report = recommend_settings(history, event.get('size_bytes') or event.get('split_plan', {}).get('segment_bytes'))
+    settings = merge_settings(settings, recommendation)
+
+    if event['task_type'] != 'full-load':
+        settings = merge_settings(settings, profiles.get('cdc'))
+
+    profile_name = get_profile_name(event, table_profiles)
+    if profile_name:
+        if profile_name not in profiles:
+            raise ValueError(f'Unknown task settings profile {profile_name}, configured profiles are {list(profiles)}')
+        settings = merge_settings(settings, profiles[profile_name])
+    settings = merge_settings(settings, event.get('task_settings'))
+
+    report.update({'profile': profile_name, 'recommendation': recommendation})
+    logging.info(f'Task settings {settings} from {report}')
+    return settings, report
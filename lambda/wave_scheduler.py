@@ -0,0 +1,106 @@
+import heapq
+import logging
+
+
+# tables without any history are expected to take this long
+DEFAULT_EXPECTED_SECONDS = 600
+
+
+def get_table_key(table):
+    return f'{table["schema_name"]}.{table["table_name"]}'.upper()
+
+
+def get_expected_seconds(table, default_seconds=DEFAULT_EXPECTED_SECONDS):
+    return int(table.get('expected_seconds') or default_seconds)
+
+
+def get_slack_seconds(table, default_seconds=DEFAULT_EXPECTED_SECONDS):
+    # latest start that still meets the SLA, tables without an SLA sort after the others
+    if table.get('sla_seconds') is None:
+        return float('inf')
+    return int(table['sla_seconds']) - get_expected_seconds(table, default_seconds)
+
+
+def get_wave_numbers(tables):
+    # A table runs one wave after the last of the tables it depends on. Dependencies outside of the batch
+    # are assumed to be loaded already.
+    tables_by_key = {get_table_key(table): table for table in tables}
+    wave_numbers = {}
+    visiting = set()
+
+    def visit(key, path):
+        if key in wave_numbers:
+            return wave_numbers[key]
+        if key in visiting:
+            raise ValueError(f'Circular table dependencies: {" -> ".join(path + [key])}')
+        visiting.add(key)
+        wave_number = 0
+        for dependency in tables_by_key[key].get('depends_on') or []:
+            if dependency.upper() not in tables_by_key:
+                logging.info(f'{key} depends on {dependency} which is not part of the batch')
+                continue
+            wave_number = max(wave_number, visit(dependency.upper(), path + [key]) + 1)
+        visiting.discard(key)
+        wave_numbers[key] = wave_number
+        return wave_number
+
+    for key in tables_by_key:
+        visit(key, [])
+    return wave_numbers
+
+
+def order_wave(tables, default_seconds=DEFAULT_EXPECTED_SECONDS):
+    # higher priority first, then the least slack to the SLA, then the longest expected duration so a
+    # long table does not start last and set the length of the wave
+    return sorted(tables, key=lambda table: (-int(table.get('priority') or 0),
+                                             get_slack_seconds(table, default_seconds),
+                                             -get_expected_seconds(table, default_seconds),
+                                             -int(table.get('size_bytes') or 0)))
+
+
+def build_waves(tables, default_seconds=DEFAULT_EXPECTED_SECONDS):
+    if len({get_table_key(table) for table in tables}) != len(tables):
+        raise ValueError('Tables listed more than once')
+
+    wave_numbers = get_wave_numbers(tables)
+    waves = [[] for _ in range(max(wave_numbers.values(), default=-1) + 1)]
+    for table in tables:
+        waves[wave_numbers[get_table_key(table)]].append(table)
+
+    return [{'wave': wave_number, 'tables': order_wave(wave_tables, default_seconds)}
+            for wave_number, wave_tables in enumerate(waves)]
+
+
+def simulate(waves, concurrency, default_seconds=DEFAULT_EXPECTED_SECONDS):
+    # Replays the schedule the way the Map states run it: the tables of a wave start in order as soon as
+    # one of the concurrency slots is free, and the next wave starts when the last table of the wave ended.
+    wave_start = 0
+    schedule = []
+    for wave in waves:
+        slots = [wave_start] * max(min(int(concurrency), len(wave['tables'])), 1)
+        heapq.heapify(slots)
+        wave_end = wave_start
+        for table in wave['tables']:
+            start = heapq.heappop(slots)
+            end = start + get_expected_seconds(table, default_seconds)
+            heapq.heappush(slots, end)
+            wave_end = max(wave_end, end)
+            schedule.append({
+                'table': get_table_key(table),
+                'wave': wave['wave'],
+                'start_seconds': start,
+                'end_seconds': end,
+                'sla_missed': table.get('sla_seconds') is not None and end > int(table['sla_seconds']),
+            })
+        wave_start = wave_end
+
+    return {
+        'makespan_seconds': wave_start,
+        'sla_misses': [entry['table'] for entry in schedule if entry['sla_missed']],
+        'schedule': schedule,
+    }
+
+
+def simulate_fifo(tables, concurrency, default_seconds=DEFAULT_EXPECTED_SECONDS):
+    # baseline of the tables started in the order they were listed, dependencies aside
+    return simulate([{'wave': 0, 'tables': list(tables)}], concurrency, default_seconds)
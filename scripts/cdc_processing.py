@@ -1,14 +1,21 @@
 import logging
+import sys
+import json
 import boto3
 import argparse
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 from pyspark import SparkConf
 from pyspark.sql import SparkSession
 from pyspark.sql import Row
+from pyspark.sql import functions as F
 
 '''
 To run on EMR as a Step:
 /usr/bin/spark-submit --master yarn --deploy-mode client --driver-memory 1G --name runSparkSQL s3://blogstaging-${env}/scripts/dms/process-deltas.py --s dms_service --t emp_details
+/usr/bin/spark-submit --name runSparkSQL s3://blogstaging-${env}/scripts/dms/process-deltas.py -b bucket -e env --tables-json '[{"schema_name": "dms_service", "table_name": "emp_details", "primary_key": "id", "task_id": "task"}]' --max-workers 4
 
 '''
 # Configure logging
@@ -16,65 +23,131 @@ logformat = f'[%(asctime)s]: %(levelname)s: %(message)s'
 logging.basicConfig(format=logformat, datefmt='%Y-%m-%d %H:%M:%S')
 logging.getLogger().setLevel(logging.INFO)
 
-get_last_modified = lambda obj: int(obj['LastModified'].strftime('%Y%m%d%H%M%S'))
+# CDC key sets estimated below spark.sql.autoBroadcastJoinThreshold are broadcast to the executors for the merge,
+# larger ones are joined with a shuffle hash join. --conf spark.dms.cdc.mergeStrategy (auto, broadcast, shuffle_hash
+# or not_in) forces a strategy for a job run.
+SIZE_UNITS = {'b': 1, 'k': 1 << 10, 'kb': 1 << 10, 'm': 1 << 20, 'mb': 1 << 20, 'g': 1 << 30, 'gb': 1 << 30}
+MERGE_STRATEGIES = ['broadcast', 'shuffle_hash', 'not_in']
 
-# Get all the new incremental files loaded by DMS except the last processed incremental file
-# TODO: Improve the listing of S3 objects by changing prefix.
+# Tables partitioned by a hash bucket of the primary key, with the number of buckets in a table property. The CDC
+# merge only reads and overwrites the buckets holding a key of the batch.
+PK_BUCKET_COLUMN = 'pk_bucket'
+PK_BUCKETS_PROPERTY = 'pk_buckets'
 
+# DMS names the CDC files after the time they are written (20230412-153021456.parquet), with date
+# partitioning enabled they are in YYYY/MM/DD folders below the table prefix. The keys sort in the order
+# the files were written, the key of the last processed file is the watermark of the next listing.
 
-def get_files_to_process(last_incremental_file, bucket, prefix):
+
+def list_level(s3conn, bucket, level_prefix, start_after):
+    # objects and sub-prefixes directly below level_prefix that sort after start_after
+    paginator = s3conn.get_paginator('list_objects_v2')
+    params = {'Bucket': bucket, 'Prefix': level_prefix, 'Delimiter': '/'}
+    if start_after:
+        params['StartAfter'] = start_after
+
+    keys, sub_prefixes = [], []
+    for page in paginator.paginate(**params):
+        keys.extend(obj['Key'] for obj in page.get('Contents', []))
+        sub_prefixes.extend(common_prefix['Prefix'] for common_prefix in page.get('CommonPrefixes', []))
+    return keys, sub_prefixes
+
+
+def list_prefix(s3conn, bucket, sub_prefix):
+    paginator = s3conn.get_paginator('list_objects_v2')
+    return [obj['Key'] for page in paginator.paginate(Bucket=bucket, Prefix=sub_prefix) for obj in page.get('Contents', [])]
+
+
+# Get all the new incremental files loaded by DMS after the last processed incremental file
+def get_files_to_process(last_incremental_file, bucket, prefix, max_workers=8):
     try:
         s3conn = boto3.client('s3')
     except Exception as e:
-        logging.ERROR(f'Error getting the S3 client: {e}')
+        logging.error(f'Error getting the S3 client: {e}')
+        raise
 
-    input_file_list = []
-    if last_incremental_file != None:
-        '''
-        results = s3conn.list_objects_v2(
-            Bucket = bucket,
-            Prefix = prefix
-        ).get('Contents')
-
-        # get the last modified of the last_incremental file
-        for obj in results:
-            if (obj['Key'] == prefix +'/'+ last_incremental_file):
-                modified=obj['LastModified']
-        '''
-        paginator = s3conn.get_paginator('list_objects_v2')
-        pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
-        
-        for page in pages:
-            for obj in page['Contents']:
-                    if (obj['Key'] == prefix +'/'+ last_incremental_file):
-                            modified=obj['LastModified']
-
-        if modified != None:
-            pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
-            
-            for page in pages:
-                for obj in page['Contents']:
-                    # for all objects in that bucket, append to the list all the files where LastModified is greater \
-                    # than LastModified of the incremental file
-                    if ('load' not in obj['Key'].lower()) and \
-                            (obj['LastModified'] >= modified):
-                                
-                        input_file_list.append('s3://' + bucket + '/' + obj['Key'])
-            
-    else:
-        try:
-            paginator = s3conn.get_paginator('list_objects_v2')
-            pages = paginator.paginate(Bucket=bucket, Prefix=prefix)
-            
-            for page in pages:
-                for obj in page['Contents']:
-                    if ('load' not in obj['Key'].lower()):
-                        input_file_list.append('s3://' + bucket + '/' + obj['Key'])
-        
-        except Exception as e:
-            logging.error(f'exception in getting listing the objects in S3 location : s3://{bucket}/{prefix}')
+    # last_incremental_file is relative to the table prefix, the file name or YYYY/MM/DD/file name
+    watermark = f'{prefix}/{last_incremental_file}' if last_incremental_file else None
+
+    # Walk down the folders holding the watermark. At every level the listing starts at the folder of the
+    # watermark, the folders sorting after it only hold newer files and are listed in full, in parallel.
+    keys, newer_prefixes = [], []
+    level_prefix = prefix + '/'
+    try:
+        while level_prefix is not None:
+            folder, separator, _ = watermark[len(level_prefix):].partition('/') if watermark else ('', '', '')
+            start_after = level_prefix + folder if separator else watermark
+            level_keys, sub_prefixes = list_level(s3conn, bucket, level_prefix, start_after)
+            keys.extend(key for key in level_keys if watermark is None or key > watermark)
+
+            level_prefix = None
+            for sub_prefix in sub_prefixes:
+                if watermark and separator and watermark.startswith(sub_prefix):
+                    level_prefix = sub_prefix
+                else:
+                    newer_prefixes.append(sub_prefix)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for sub_prefix_keys in executor.map(lambda sub_prefix: list_prefix(s3conn, bucket, sub_prefix), newer_prefixes):
+                keys.extend(sub_prefix_keys)
+    except Exception as e:
+        logging.error(f'exception in getting listing the objects in S3 location : s3://{bucket}/{prefix}')
+        raise
 
-    return input_file_list
+    logging.info(f'Listed {len(keys)} new objects in {len(newer_prefixes)} sub-prefixes after {watermark}')
+    return ['s3://' + bucket + '/' + key for key in sorted(keys) if 'load' not in key.lower()]
+
+# Get the new incremental files of the table from the CDC file index fed by the S3 notifications, a key
+# range read after the last processed file instead of a listing of the table prefix. The notifications of
+# a file can arrive after the ones of a later file, the files are only read up to the first one written
+# within the last settle_seconds, the high-water mark never moves past a file that can still be indexed.
+def get_indexed_files(file_index_table, last_incremental_file, bucket, prefix, settle_seconds=0, now=None):
+    try:
+        dyndb = boto3.resource('dynamodb')
+    except Exception as e:
+        logging.error(f'Error connecting to Dynamo DB: {e}')
+        raise
+
+    table = dyndb.Table(file_index_table)
+    params = {'KeyConditionExpression': 'table_prefix = :prefix', 'ExpressionAttributeValues': {':prefix': prefix},
+              'ProjectionExpression': 'file_key, written_at'}
+    if last_incremental_file:
+        params['KeyConditionExpression'] += ' AND file_key > :watermark'
+        params['ExpressionAttributeValues'][':watermark'] = last_incremental_file
+
+    settled_before = (now if now is not None else time.time()) - settle_seconds
+    file_keys, unsettled = [], 0
+    while True:
+        response = table.query(**params)
+        for item in response['Items']:
+            # rows indexed before written_at was recorded are older than any settle window
+            if unsettled or int(item.get('written_at', 0)) > settled_before:
+                unsettled += 1
+            else:
+                file_keys.append(item['file_key'])
+        if 'LastEvaluatedKey' not in response:
+            break
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    logging.info(f'{len(file_keys)} new files of {prefix} in the CDC file index {file_index_table}, '
+                 f'{unsettled} written in the last {settle_seconds}s are left to the next run')
+    return ['s3://' + bucket + '/' + prefix + '/' + file_key for file_key in file_keys]
+
+# Rows of the CDC file index expire index_ttl seconds after they are written. When the table was last
+# processed longer ago than that, files after the high-water mark may have expired before they were read:
+# the S3 listing after the mark is checked against the index and the run fails when the index misses files.
+def check_index_gap(file_index_table, last_incremental_file, last_batch_at, bucket, prefix, index_ttl, settle_seconds=0, now=None):
+    now = now if now is not None else time.time()
+    if last_batch_at is not None and now - last_batch_at <= index_ttl - settle_seconds:
+        return
+
+    listed_files = get_files_to_process(last_incremental_file, bucket, prefix)
+    indexed_files = set(get_indexed_files(file_index_table, last_incremental_file, bucket, prefix))
+    missing_files = [file for file in listed_files if file not in indexed_files]
+    if missing_files:
+        raise RuntimeError(f'{len(missing_files)} files of {prefix} after {last_incremental_file} are missing from the '
+                           f'CDC file index {file_index_table}, last processed at {last_batch_at}, first {missing_files[0]}. '
+                           f'Index them with the backfill action of the cdc-file-indexer Lambda and run again.')
 
 # Read the dyn db for the last incremental file that was processed
 def get_last_incremental_file(bucket, prefix, dyn_db_table_name, task_id):
@@ -85,20 +158,25 @@ def get_last_incremental_file(bucket, prefix, dyn_db_table_name, task_id):
     except Exception as e:
         logging.error(f'Error reading the dynDB file {e}')
 
+    # only the high-water mark and the time of the last batch, items of earlier versions also hold the list
+    # of every processed file
     resp = dyndb.get_item(
             TableName=dyn_db_table_name,
             Key={'path': {'S':path},
                  'task_id': {'S':task_id}
-                 }
+                 },
+            ProjectionExpression='LastIncrementalFile, LastBatchAt'
             )
 
-    if 'LastIncrementalFile' in resp['Item']:
-        lastIncrementalFile = resp['Item']['LastIncrementalFile']['S']
-        if lastIncrementalFile is not '':
-            return lastIncrementalFile, path
+    item = resp.get('Item', {})
+    last_batch_at = int(item['LastBatchAt']['N']) if 'LastBatchAt' in item else None
+    if 'LastIncrementalFile' in item:
+        lastIncrementalFile = item['LastIncrementalFile']['S']
+        if lastIncrementalFile != '':
+            return lastIncrementalFile, path, last_batch_at
 
     logging.info('lastIncrementalFile is null')
-    return None, path
+    return None, path, last_batch_at
 
 # Read and de-dup CDC data
 def read_cdc_data(spark, list_input_files, primary_key):
@@ -115,64 +193,59 @@ def read_cdc_data(spark, list_input_files, primary_key):
     return cdc_data
 
 
-def update_processed_files(list_of_files, path, dynamodb_table_name, task_id):
-    # split file to get only the timestamp info
-    new_file_list = []
-    for file in list_of_files:
-        new_file_list.append(file.split('/')[-1])
-    logging.info(f'List of files processed in this execution : {new_file_list}')
+def update_processed_files(list_of_files, path, dynamodb_table_name, task_id, last_incremental_file, batch_table=None, batch_ttl=0):
+    # The state of a table is its high-water mark, the key below the table prefix of the last processed file.
+    # The files of a batch are the keys after the previous mark up to the new one, the batch record keeps the
+    # range and expires after batch_ttl seconds.
+    new_file_list = sorted(file[len(path) + 1:] for file in list_of_files)
+    logging.info(f'Processed {len(new_file_list)} files from {new_file_list[0]} to {new_file_list[-1]}')
 
-    # get the list of last_processsed_files
     try:
         dyndb = boto3.client('dynamodb')
     except Exception as e:
-        logging.error(f'Error reading the dynDB file {e}')
-
-    get_list_resp = dyndb.get_item(
-            TableName=dynamodb_table_name,
-            Key={'path': {'S':path},
-                 'task_id': {'S':task_id}
-                 }
-            )
-
-    all_files = []
-    if 'ListOfProcessedFiles' in get_list_resp['Item']:
-        list_of_processed_files = get_list_resp['Item']['ListOfProcessedFiles']['S']
-        all_files.append(list_of_processed_files)
-        for file in new_file_list:
-            all_files.append(file)
-    else:
-        all_files = new_file_list
-
-    logging.info(f'List of all the files processed till now: {all_files}')
-
-    # append the new list to the retrieved list of files that were processed
-    if len(all_files) > 0:
-        files = ",".join(all_files)
+        logging.error(f'Error connecting to Dynamo DB: {e}')
+        raise
+
+    # Another run that advanced the mark since it was read fails the condition, the files are not recorded twice.
+    # The list of processed files of earlier versions is removed from the item.
+    now = int(time.time())
+    state_update = {
+        'TableName': dynamodb_table_name,
+        'Key': {'path': {'S': path}, 'task_id': {'S': task_id}},
+        'UpdateExpression': 'SET LastIncrementalFile = :last, LastBatchAt = :now, '
+                            'BatchCount = if_not_exists(BatchCount, :zero) + :one REMOVE ListOfProcessedFiles',
+        'ConditionExpression': 'LastIncrementalFile = :previous',
+        'ExpressionAttributeValues': {':last': {'S': new_file_list[-1]}, ':now': {'N': str(now)},
+                                      ':zero': {'N': '0'}, ':one': {'N': '1'},
+                                      ':previous': {'S': last_incremental_file or ''}},
+    }
+    if last_incremental_file is None:
+        state_update['ConditionExpression'] = 'attribute_not_exists(LastIncrementalFile) OR LastIncrementalFile = :previous'
 
     try:
-        dyndb = boto3.resource('dynamodb')
-    except Exception as e:
-        logging.ERROR(f'Error connecting to Dynamo DB: {e}')
-
-    table = dyndb.Table(dynamodb_table_name)
-
-    # update the dyn db with the new list
-    update_response = table.update_item(
-         Key={'path': path,
-              'task_id': task_id},
-            UpdateExpression="SET \
-                ListOfProcessedFiles = :val1, \
-                LastIncrementalFile = :val2",
-            ExpressionAttributeValues={
-                ':val1': files.rstrip(','), \
-                ':val2': all_files[-1]
-            },
-            ReturnValues="UPDATED_NEW"
-        )
-    logging.info(f'Updated the Dynamo Db table with newly processed files')
-    if update_response is None:
-        return None
+        if batch_table:
+            batch = {
+                'path': {'S': path},
+                'batch_end': {'S': new_file_list[-1]},
+                'task_id': {'S': task_id},
+                'batch_start_after': {'S': last_incremental_file or ''},
+                'first_file': {'S': new_file_list[0]},
+                'file_count': {'N': str(len(new_file_list))},
+                'processed_at': {'N': str(now)},
+                'expires_at': {'N': str(now + int(batch_ttl))},
+            }
+            dyndb.transact_write_items(TransactItems=[
+                {'Update': state_update},
+                {'Put': {'TableName': batch_table, 'Item': batch, 'ConditionExpression': 'attribute_not_exists(batch_end)'}},
+            ])
+        else:
+            dyndb.update_item(**state_update)
+    except (dyndb.exceptions.ConditionalCheckFailedException, dyndb.exceptions.TransactionCanceledException) as e:
+        logging.error(f'The high-water mark of {path} moved from {last_incremental_file} during this run: {e}')
+        raise
+
+    logging.info(f'Updated the Dynamo Db table with the high-water mark {new_file_list[-1]}')
+    return new_file_list[-1]
 
 
 def insert_stg_table(spark, updated_data, table_name):
@@ -236,14 +309,66 @@ def load_stg_to_dm_bckup(spark, schema_name, table_name, primary_key):
     return True
 
 
+def get_primary_keys(primary_key):
+    return [column.strip() for column in primary_key.split(',')]
+
+
+def get_size_bytes(size):
+    # a Spark size setting, 10485760, 10485760b or 10m
+    match = re.fullmatch(r'\s*(-?\d+)\s*([a-z]*)\s*', size.lower())
+    if not match or (match.group(2) and match.group(2) not in SIZE_UNITS):
+        raise ValueError(f'Unsupported size {size}')
+    return int(match.group(1)) * SIZE_UNITS.get(match.group(2), 1)
+
+
+def get_key_bytes(data, primary_key):
+    # estimated bytes of a key row, from the default size Spark plans with for the types of the key columns
+    fields = {field.name.lower(): field for field in data.schema.fields}
+    return sum(fields[key.lower()].dataType.defaultSize() for key in get_primary_keys(primary_key))
+
+
+def get_merge_strategy(spark, cdc_key_count, key_bytes):
+    strategy = spark.conf.get('spark.dms.cdc.mergeStrategy', 'auto')
+    if strategy in MERGE_STRATEGIES:
+        return strategy
+
+    # the keys are broadcast when Spark would broadcast a relation of their estimated size, -1 disables it
+    threshold = get_size_bytes(spark.conf.get('spark.sql.autoBroadcastJoinThreshold', '10485760'))
+    return 'broadcast' if cdc_key_count * key_bytes <= threshold else 'shuffle_hash'
+
+
+def get_unchanged_rows(spark, stg_data, cdc_data, primary_key, strategy):
+    # The rows of the staging table without a change in the CDC batch, a left anti join on the primary key.
+    # NOT IN is planned as a null aware anti join, which ends up as a broadcast nested loop join on large
+    # batches, it is kept for comparison in merge_benchmark.py.
+    primary_keys = get_primary_keys(primary_key)
+    cdc_keys = cdc_data.select(*primary_keys)
+
+    if strategy == 'not_in':
+        stg_data.createOrReplaceTempView('merge_stg_vw')
+        cdc_keys.createOrReplaceTempView('merge_cdc_keys_vw')
+        # a composite key is compared as a row, (a, b) NOT IN (SELECT a, b ...)
+        key_columns = ', '.join(primary_keys)
+        return spark.sql(f'SELECT * FROM merge_stg_vw WHERE ({key_columns}) NOT IN (SELECT {key_columns} FROM merge_cdc_keys_vw)')
+
+    if strategy == 'broadcast':
+        cdc_keys = F.broadcast(cdc_keys)
+    else:
+        cdc_keys = cdc_keys.hint('shuffle_hash')
+    return stg_data.join(cdc_keys, on=primary_keys, how='left_anti')
+
+
 def load_stg_to_dm(spark, schema_name, updated_data, table_name, primary_key, env):
 
     ## Step 1: Prepare the stg data where all records are eliminated which are part of CDC
+    # the CDC batch has one row per key, it is read for the key count and again for the writes
+    updated_data.persist()
+    cdc_key_count = updated_data.count()
     updated_data.createOrReplaceTempView("raw_updated_data_vw")
 
-    stg_sql = f"SELECT * FROM blog_staging.{table_name} WHERE {primary_key} NOT IN (SELECT {primary_key} FROM raw_updated_data_vw)"
-    stg_data = spark.sql(stg_sql)
-    logging.info('Prepared stg_data in lazy evaluation')
+    strategy = get_merge_strategy(spark, cdc_key_count, get_key_bytes(updated_data, primary_key))
+    stg_data = get_unchanged_rows(spark, spark.table(f'blog_staging.{table_name}'), updated_data, primary_key, strategy)
+    logging.info(f'Prepared stg_data in lazy evaluation, {cdc_key_count} CDC keys merged with a {strategy} join')
    
     ## Step 2: Drop the op and rn columns from cdc data
     upsert_data_sql = "SELECT * from raw_updated_data_vw where op != 'D'"
@@ -286,9 +411,141 @@ def load_stg_to_dm(spark, schema_name, updated_data, table_name, primary_key, en
     except Exception as e:
         print(f'Error inserting data into dm/dwh table : {e}')
         exit(1)
-    
- 
 
+    updated_data.unpersist()
+    return True
+
+
+def add_pk_bucket(data, primary_key, buckets):
+    return data.withColumn(PK_BUCKET_COLUMN, F.pmod(F.xxhash64(*get_primary_keys(primary_key)), F.lit(buckets)).cast('int'))
+
+
+def get_pk_buckets(spark, table):
+    # number of buckets of a table partitioned by pk_bucket, None for the other tables
+    database, _, table_name = table.rpartition('.')
+    partition_columns = [column.name for column in spark.catalog.listColumns(table_name, database or None) if column.isPartition]
+    if PK_BUCKET_COLUMN not in partition_columns:
+        return None
+
+    properties = {row[0]: row[1] for row in spark.sql(f'SHOW TBLPROPERTIES {table}').collect()}
+    return int(properties[PK_BUCKETS_PROPERTY]) if PK_BUCKETS_PROPERTY in properties else None
+
+
+def get_staging_path(env, path):
+    return f"s3://blogstaging-{env}/hive/{path}"
+
+
+def get_data_columns(spark, table):
+    # the columns of a table without pk_bucket, the dm/dwh inserts and the merge select them by name
+    return [column for column in spark.table(table).columns if column != PK_BUCKET_COLUMN]
+
+
+def swap_tables(spark, table, new_table, old_table):
+    # the table is only missing between the two renames, the new table is ready with its partitions before
+    spark.sql(f'ALTER TABLE {table} RENAME TO {old_table}')
+    try:
+        spark.sql(f'ALTER TABLE {new_table} RENAME TO {table}')
+    except Exception:
+        spark.sql(f'ALTER TABLE {old_table} RENAME TO {table}')
+        raise
+
+
+def bucket_staging_table(spark, table_name, primary_key, buckets, env):
+    # One time rewrite of the staging table partitioned by pk_bucket, at a new location. The bucketed table is
+    # created with its partitions under a temporary name and then takes the name of the staging table, the
+    # earlier table is kept with its files as <table>__unbucketed_<time>.
+    stg_table = f'blog_staging.{table_name}'
+    bucketed_table = f'{stg_table}__pk_buckets'
+    unbucketed_table = f"{stg_table}__unbucketed_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+    location = get_staging_path(env, f'bucketed/{table_name}')
+    logging.info(f'Rewriting {stg_table} in {buckets} primary key buckets to {location}')
+
+    stg_data = spark.table(stg_table).select(*get_data_columns(spark, stg_table))
+    add_pk_bucket(stg_data, primary_key, buckets).write.mode('overwrite').partitionBy(PK_BUCKET_COLUMN).parquet(location)
+    # a table left by an earlier attempt only holds metadata, its location is the one written above
+    spark.sql(f'DROP TABLE IF EXISTS {bucketed_table}')
+    spark.sql(f"CREATE TABLE {bucketed_table} USING PARQUET PARTITIONED BY ({PK_BUCKET_COLUMN}) LOCATION '{location}' "
+              f"TBLPROPERTIES ('{PK_BUCKETS_PROPERTY}'='{buckets}')")
+    spark.sql(f'ALTER TABLE {bucketed_table} RECOVER PARTITIONS')
+    swap_tables(spark, stg_table, bucketed_table, unbucketed_table)
+    logging.info(f'{stg_table} is partitioned by {PK_BUCKET_COLUMN}, the earlier table is {unbucketed_table}')
+    return buckets
+
+
+def drop_empty_buckets(spark, table, touched_buckets, written_buckets):
+    # a bucket left without rows is not overwritten by the dynamic partition overwrite
+    for bucket in sorted(set(touched_buckets) - set(written_buckets)):
+        logging.info(f'Dropping the empty bucket {bucket} of {table}')
+        spark.sql(f'ALTER TABLE {table} DROP IF EXISTS PARTITION ({PK_BUCKET_COLUMN}={bucket})')
+
+
+def get_insert_target(insert_sql):
+    match = re.search(r'insert\s+overwrite\s+(?:table\s+)?([\w.]+)', insert_sql, re.IGNORECASE)
+    return match.group(1) if match else None
+
+
+def load_stg_to_dm_buckets(spark, schema_name, updated_data, table_name, primary_key, env, buckets):
+    # Copy on write of the buckets touched by the CDC batch: the unchanged rows and the upserts of these buckets
+    # replace them with a dynamic partition overwrite, the other buckets are not read or written
+    stg_table = f'blog_staging.{table_name}'
+
+    ## Step 1: Find the buckets of the CDC keys
+    updated_data = add_pk_bucket(updated_data, primary_key, buckets).persist()
+    cdc_key_count = updated_data.count()
+    touched_buckets = sorted(row[0] for row in updated_data.select(PK_BUCKET_COLUMN).distinct().collect())
+    logging.info(f'{cdc_key_count} CDC keys touch {len(touched_buckets)} of {buckets} buckets of {stg_table}')
+
+    ## Step 2: Merge the stg data of the touched buckets with the cdc data
+    data_columns = get_data_columns(spark, stg_table)
+    stg_columns = data_columns + [PK_BUCKET_COLUMN]
+    stg_data = spark.table(stg_table).where(F.col(PK_BUCKET_COLUMN).isin(touched_buckets))
+    strategy = get_merge_strategy(spark, cdc_key_count, get_key_bytes(updated_data, primary_key))
+    kept_data = get_unchanged_rows(spark, stg_data, updated_data, primary_key, strategy)
+    cdc_data = updated_data.where("op != 'D'").drop('op').drop('rn')
+    merged_data = kept_data.select(*stg_columns).unionByName(cdc_data.select(*stg_columns))
+    logging.info(f'Prepared the touched buckets in lazy evaluation with a {strategy} join')
+
+    ## Step 3: Writing the merged buckets to temp for persistence, the stg table is read and overwritten
+    temp_path = get_staging_path(env, f'temp_persist/{table_name}_buckets')
+    merged_data.write.mode('overwrite').parquet(temp_path)
+    merged_tmp_data = spark.read.parquet(temp_path)
+    written_buckets = [row[0] for row in merged_tmp_data.select(PK_BUCKET_COLUMN).distinct().collect()]
+
+    # Step 4: Overwrite the touched buckets of the staging table
+    try:
+        logging.info(f'overwriting {len(touched_buckets)} buckets of the stg table: {stg_table}')
+        merged_tmp_data.select(*stg_columns).write.insertInto(stg_table, overwrite=True)
+        drop_empty_buckets(spark, stg_table, touched_buckets, written_buckets)
+
+    except Exception as e:
+        print(f'Error inserting data into STG table : {e}')
+        exit(1)
+
+    # Step 5: Overwrite the touched buckets of the dm/dwh table when it has the same buckets, the whole table otherwise
+    try:
+        insert_dm_sql = get_insert_stmt(spark, schema_name, table_name, env)
+        target_table = get_insert_target(insert_dm_sql)
+        stg_table_pattern = re.compile(rf'\bblog_staging\.{re.escape(table_name)}\b', re.IGNORECASE)
+        if target_table and get_pk_buckets(spark, target_table) == buckets and stg_table_pattern.search(insert_dm_sql):
+            spark.table(stg_table).where(F.col(PK_BUCKET_COLUMN).isin(touched_buckets)).createOrReplaceTempView('stg_buckets_vw')
+            insert_dm_sql = stg_table_pattern.sub('stg_buckets_vw', insert_dm_sql)
+            logging.info(f'insert overwriting {len(touched_buckets)} buckets of the dm/dwh table: {target_table}')
+        else:
+            # the other dm/dwh tables read the staging table without pk_bucket
+            target_table = None
+            spark.table(stg_table).select(*data_columns).createOrReplaceTempView('stg_data_columns_vw')
+            insert_dm_sql = stg_table_pattern.sub('stg_data_columns_vw', insert_dm_sql)
+            logging.info(f'insert overwriting staging data into to dm/dwh table: {table_name}')
+        logging.info(f'Insert SQL : {insert_dm_sql}')
+        spark.sql(insert_dm_sql)
+        if target_table:
+            drop_empty_buckets(spark, target_table, touched_buckets, written_buckets)
+
+    except Exception as e:
+        print(f'Error inserting data into dm/dwh table : {e}')
+        exit(1)
+
+    updated_data.unpersist()
     return True
 
 
@@ -326,14 +583,25 @@ def process_new_files(args_map):
     cdc_data = read_cdc_data(spark, list_of_files, primary_key)
 
 
-    if(load_stg_to_dm(args_map['spark'], args_map['schema'], cdc_data, args_map['table'], args_map['primary_key'], env)):
+    # tables partitioned by primary key bucket only rewrite the buckets of the batch, see load_stg_to_dm_buckets
+    buckets = get_pk_buckets(spark, f"blog_staging.{args_map['table']}")
+    if buckets is None and args_map['pk_buckets']:
+        buckets = bucket_staging_table(spark, args_map['table'], primary_key, args_map['pk_buckets'], env)
+
+    if buckets:
+        loaded = load_stg_to_dm_buckets(spark, args_map['schema'], cdc_data, args_map['table'], primary_key, env, buckets)
+    else:
+        loaded = load_stg_to_dm(spark, args_map['schema'], cdc_data, args_map['table'], primary_key, env)
+
+    if(loaded):
         logging.info(f'Full refresh on DM table with CDC data completed successfully')
     else:
         logging.info(f'Full refresh on table DM with CDC data not completed')
 
     logging.info('Updating the Dynamo DB table records')
-    # update the list of processed files on dyndb
-    if update_processed_files(list_of_files, path, dyn_db_table_name, args_map['task_id']) is not None:
+    # move the high-water mark of the table on dyndb and record the batch
+    if update_processed_files(list_of_files, path, dyn_db_table_name, args_map['task_id'], last_incremental_file,
+                              args_map['batch_table'], args_map['batch_ttl']) is not None:
         logging.info('CDC pre-processing completed!')
 
 
@@ -354,59 +622,77 @@ def process_new_files(args_map):
     return None
 
 
-def main():
-    logging.info('CDC pre-processing step started')
-
-    spark = SparkSession\
-        .builder\
-        .appName("CrudDMSApp") \
-        .enableHiveSupport() \
-        .getOrCreate()
-
+def configure_session(spark):
     spark.conf.set('spark.sql.sources.partitionOverwriteMode', 'dynamic')
+    spark.conf.set('hive.exec.dynamic.partition.mode', 'nonstrict')
     spark.conf.set('spark.sql.parquet.fs.optimized.committer.optimization-enabled', 'true')
     spark.conf.set('spark.sql.parquet.output.committer.class', 'com.amazon.emr.committer.EmrOptimizedSparkSqlParquetOutputCommitter')
-    parser = argparse.ArgumentParser()
-
-    parser.add_argument("-s", "--schema", help="< Input Schema Name >")
-    parser.add_argument("-t", "--table", help="< Input Table Name >")
-    parser.add_argument("-b", "--bucket", help="< Input DMS target S3 Bucket Name >")
-    parser.add_argument("-p", "--pk", help="< Input Primary Key Name >")
-    parser.add_argument("-e", "--env", help="< Input Env Name >")
-    parser.add_argument("-taskid", "--taskid", help="< Input DMS Task ID >")
-
-
-    args = parser.parse_args()
-    schema_name = args.schema
-    table_name = args.table
-    bucket_name = args.bucket
-    primary_key = args.pk
-    env = args.env
-    task_id = args.taskid
 
+def read_manifest(manifest_path):
+    # s3://bucket/key of a JSON list of tables
+    bucket, _, key = manifest_path.replace('s3://', '', 1).partition('/')
+    body = boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    tables = json.loads(body)
+    return tables['tables'] if isinstance(tables, dict) else tables
+
+def get_tables(args):
+    # a single table from -s/-t/-p/-taskid, or a list of tables from --tables-json or --manifest
+    if args.tables_json:
+        tables = json.loads(args.tables_json)
+    elif args.manifest:
+        tables = read_manifest(args.manifest)
+    else:
+        tables = [{'schema_name': args.schema, 'table_name': args.table}]
+
+    return [{'schema_name': table.get('schema_name') or args.schema,
+             'table_name': table['table_name'],
+             'primary_key': table.get('primary_key') or args.pk,
+             'task_id': table.get('task_id') or args.taskid,
+             'pk_buckets': int(table.get('pk_buckets') or args.pk_buckets or 0)} for table in tables]
+
+def process_table(spark, table, bucket_name, env, file_index=None, batch_table=None, batch_ttl=0,
+                  index_settle_seconds=0, index_ttl=None):
+    # Every table gets its own session of the shared SparkContext, the tables run concurrently and
+    # the temporary views of the CDC processing have the same names for every table
+    table_session = spark.newSession()
+    configure_session(table_session)
+    table_session.sparkContext.setJobGroup(table['table_name'], f"CDC {table['schema_name']}.{table['table_name']}")
+
+    schema_name = table['schema_name']
+    table_name = table['table_name']
+    task_id = table['task_id']
     dyn_db_table_name = f'dms-app-task-status-{env}'
     prefix = 'dmstarget/' + schema_name.upper() +'/' + table_name.upper()
 
     # get the last incremental file
-    last_incremental_file, path = get_last_incremental_file(bucket_name, prefix, dyn_db_table_name, task_id)
+    last_incremental_file, path, last_batch_at = get_last_incremental_file(bucket_name, prefix, dyn_db_table_name, task_id)
     logging.info(f'Last incremental file is: {last_incremental_file}')
 
     args_map = {}
     args_map['path'] = str(path)
-    args_map['last_incremental_file'] = str(last_incremental_file)
+    args_map['last_incremental_file'] = last_incremental_file
     args_map['bucket_name'] = bucket_name
     args_map['prefix'] = prefix
     args_map['dyn_db_table_name'] = dyn_db_table_name
-    args_map['spark'] = spark
-    args_map['primary_key'] = primary_key
+    args_map['spark'] = table_session
+    args_map['primary_key'] = table['primary_key']
     args_map['schema'] = schema_name
     args_map['table'] = table_name
     args_map['task_id'] = task_id
     args_map['env'] = env
+    args_map['batch_table'] = batch_table
+    args_map['batch_ttl'] = batch_ttl
+    args_map['pk_buckets'] = table.get('pk_buckets')
 
     if last_incremental_file != None:
         # get list of s3 objects to process after the incremental file
-        list_of_files = get_files_to_process(last_incremental_file, bucket_name, prefix)
+        if file_index:
+            if index_ttl:
+                check_index_gap(file_index, last_incremental_file, last_batch_at, bucket_name, prefix, index_ttl,
+                                index_settle_seconds)
+            list_of_files = get_indexed_files(file_index, last_incremental_file, bucket_name, prefix, index_settle_seconds)
+        else:
+            list_of_files = get_files_to_process(last_incremental_file, bucket_name, prefix)
 
         logging.info(len(list_of_files))
 
@@ -416,7 +702,8 @@ def main():
         else:
             logging.info('No new incremental files to process!')
     else:
-        # this is a first time run, get list of all the parquet files except initial LOAD file
+        # this is a first time run, get list of all the parquet files except initial LOAD file. The index only
+        # holds the files of the last index_ttl seconds, the first run lists the table prefix.
         input_file_list = get_files_to_process(None, bucket_name, prefix)
         if len(input_file_list) > 0:
             args_map['list_of_files'] = input_file_list
@@ -424,5 +711,79 @@ def main():
         else:
             logging.info('There are no incremental files yet!')
 
+def process_tables(spark, tables, bucket_name, env, max_workers, file_index=None, batch_table=None, batch_ttl=0,
+                   index_settle_seconds=0, index_ttl=None):
+    # A failed table does not stop the others, every table reports its own status
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_table, spark, table, bucket_name, env, file_index, batch_table, batch_ttl,
+                                   index_settle_seconds, index_ttl): table for table in tables}
+        for future in as_completed(futures):
+            table = futures[future]
+            result = {'schema_name': table['schema_name'], 'table_name': table['table_name'], 'status': 'SUCCESS'}
+            # the processing functions call exit(1) on errors, SystemExit is kept on the future as well
+            error = future.exception()
+            if error is not None:
+                logging.error(f"CDC processing of {table['schema_name']}.{table['table_name']} failed: {error!r}")
+                result.update({'status': 'FAILED', 'error': repr(error)})
+            else:
+                logging.info(f"CDC processing of {table['schema_name']}.{table['table_name']} completed")
+            results.append(result)
+
+    return results
+
+def write_results(results, results_path):
+    bucket, _, key = results_path.replace('s3://', '', 1).partition('/')
+    boto3.client('s3').put_object(Body=json.dumps(results), Bucket=bucket, Key=key)
+    logging.info(f'Table results written to {results_path}')
+
+def get_parser():
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-s", "--schema", help="< Input Schema Name >")
+    parser.add_argument("-t", "--table", help="< Input Table Name >")
+    parser.add_argument("-b", "--bucket", help="< Input DMS target S3 Bucket Name >")
+    parser.add_argument("-p", "--pk", help="< Input Primary Key Name >")
+    parser.add_argument("-e", "--env", help="< Input Env Name >")
+    parser.add_argument("-taskid", "--taskid", help="< Input DMS Task ID >")
+    parser.add_argument("--tables-json", help="< JSON list of tables with schema_name, table_name, primary_key and task_id >")
+    parser.add_argument("--manifest", help="< S3 path of a JSON list of tables >")
+    parser.add_argument("--max-workers", type=int, default=4, help="< Tables processed concurrently >")
+    parser.add_argument("--results", help="< S3 path where the status of every table is written >")
+    parser.add_argument("--file-index", help="< DynamoDB CDC file index table, the S3 prefix is listed without it >")
+    parser.add_argument("--index-settle-seconds", type=int, default=300, help="< Files written this recently are left in the CDC file index for the next run >")
+    parser.add_argument("--index-ttl", type=int, help="< Seconds a row stays in the CDC file index, longer gaps are checked against S3 >")
+    parser.add_argument("--batch-table", help="< DynamoDB table of the processed CDC batches >")
+    parser.add_argument("--batch-ttl", type=int, default=30 * 86400, help="< Seconds a processed CDC batch record is kept >")
+    parser.add_argument("--pk-buckets", type=int, default=0, help="< Primary key buckets the staging table is rewritten in, 0 keeps full rewrites >")
+    return parser
+
+
+def main():
+    logging.info('CDC pre-processing step started')
+
+    # one session for all the tables, the FAIR scheduler keeps small tables from queueing behind a large one
+    spark = SparkSession\
+        .builder\
+        .appName("CrudDMSApp") \
+        .config('spark.scheduler.mode', 'FAIR') \
+        .enableHiveSupport() \
+        .getOrCreate()
+
+    configure_session(spark)
+    args = get_parser().parse_args()
+    tables = get_tables(args)
+
+    results = process_tables(spark, tables, args.bucket, args.env, args.max_workers, args.file_index,
+                             args.batch_table, args.batch_ttl, args.index_settle_seconds, args.index_ttl)
+    logging.info(f'Table results: {results}')
+    if args.results:
+        write_results(results, args.results)
+
+    failed_tables = [f"{result['schema_name']}.{result['table_name']}" for result in results if result['status'] == 'FAILED']
+    if failed_tables:
+        logging.error(f'CDC processing failed for {failed_tables}')
+        sys.exit(1)
+
 if __name__ == "__main__":
     main()
@@ -12,6 +12,7 @@
 #       5) Alter the Hive location to point to load_ts
 # 2023-03-02 Add UTC timezone conversion in insert cast statements
 # 2023-03-07 Add drop partition logic for partitioned table before next refresh
+# Load a list of tables within one Spark session with a pool of concurrent Spark jobs
 # *************************************************************/
 # *************************************************************/
 # To do : Add decode/encode and other transformation in Insert overwrite
@@ -20,9 +21,13 @@
 # Usage : 
 # To run on EMR as a Step:
 # /usr/bin/spark-submit --name dmstolake /home/hadoop/scripts/dms-to-lake.py -src DWOWNER -t DW_MTL_TRNSCNT_ACCOUNTS -tgt finance_dwh -e e2e
+# /usr/bin/spark-submit --name dmstolake /home/hadoop/scripts/dms-to-lake.py -tgt finance_dwh --tables-json '[{"schema_name": "DWOWNER", "table_name": "DIM_AFFILIATE"}]' --max-workers 4
 
 import logging
 import os
+import sys
+import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import boto3
 import argparse
@@ -31,6 +36,7 @@ import pyspark.sql.utils
 from pyspark import SparkConf
 from pyspark.sql import SparkSession
 from pyspark.sql import Row
+from pyspark.sql import functions as F
 from pyspark.sql.types import StringType
 
 '''
@@ -43,6 +49,12 @@ logformat = f'[%(asctime)s]: %(levelname)s: %(message)s'
 logging.basicConfig(format=logformat, datefmt='%Y-%m-%d %H:%M:%S')
 logging.getLogger().setLevel(logging.INFO)
 
+# The staging database cdc_processing.py merges the CDC batches into. Staging tables of the tables with primary
+# key buckets are written partitioned by pk_bucket, with the number of buckets in a table property
+STAGING_DATABASE = 'blog_staging'
+PK_BUCKET_COLUMN = 'pk_bucket'
+PK_BUCKETS_PROPERTY = 'pk_buckets'
+
 #def sync_dms_stg_s3(src_schema_name,table_name,env):
 #
 #   lower_table_name = table_name.lower()
@@ -84,7 +96,31 @@ def execute_query(spark, query_path):
 #
 #    logging.info(f'DMS Data read completed')
 
-def create_stg_table(spark,src_schema_name,table_name):
+def add_pk_bucket(data, primary_key, buckets):
+    # the same buckets as add_pk_bucket in cdc_processing.py
+    primary_keys = [column.strip() for column in primary_key.split(',')]
+    return data.withColumn(PK_BUCKET_COLUMN, F.pmod(F.xxhash64(*primary_keys), F.lit(buckets)).cast('int'))
+
+def get_staging_path(env, path):
+    # the same staging bucket as get_staging_path in cdc_processing.py
+    return f"s3://blogstaging-{env}/hive/{path}"
+
+def create_bucketed_stg_table(spark, data, stg_table, location, primary_key, buckets):
+    # The staging table partitioned by pk_bucket at a new location, created with its partitions under a
+    # temporary name before it replaces the staging table of the earlier load
+    bucketed_table = f'{stg_table}__pk_buckets'
+    data_columns = [column for column in data.columns if column != PK_BUCKET_COLUMN]
+    add_pk_bucket(data.select(*data_columns), primary_key, buckets).write.mode('overwrite').partitionBy(PK_BUCKET_COLUMN).parquet(location)
+
+    spark.sql(f'DROP TABLE IF EXISTS {bucketed_table}')
+    spark.sql(f"CREATE TABLE {bucketed_table} USING PARQUET PARTITIONED BY ({PK_BUCKET_COLUMN}) LOCATION '{location}' "
+              f"TBLPROPERTIES ('{PK_BUCKETS_PROPERTY}'='{buckets}')")
+    spark.sql(f'ALTER TABLE {bucketed_table} RECOVER PARTITIONS')
+    spark.sql(f'DROP TABLE IF EXISTS {stg_table}')
+    spark.sql(f'ALTER TABLE {bucketed_table} RENAME TO {stg_table}')
+    logging.info(f'Staging table re-created in {buckets} primary key buckets at {location}')
+
+def create_stg_table(spark,src_schema_name,table_name,primary_key=None,pk_buckets=0,env=None):
 
     lower_table_name = table_name.lower()
     upper_table_name = table_name.upper()
@@ -93,6 +129,12 @@ def create_stg_table(spark,src_schema_name,table_name):
     tablename=input_file.split("/")[-2]
     df = spark.read.parquet(input_file)
     logging.info(df.printSchema())
+
+    if pk_buckets and primary_key:
+        load_ts = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+        create_bucketed_stg_table(spark, df, f'{STAGING_DATABASE}.{tablename}',
+                                  get_staging_path(env, f'bucketed/{lower_table_name}/load_ts={load_ts}'), primary_key, pk_buckets)
+        return
     v = df._jdf.schema().treeString()
     #print(v)
     str = v.split('-- ')
@@ -109,8 +151,8 @@ def create_stg_table(spark,src_schema_name,table_name):
 
     columns=columns[:-2]
 
-    drop_sql = "DROP TABLE IF EXISTS blogstaging.{0};".format(tablename)
-    ddl_str= "CREATE EXTERNAL TABLE IF NOT EXISTS blogstaging.{0} ( \n {1}) ".format(tablename,columns)
+    drop_sql = "DROP TABLE IF EXISTS {0}.{1};".format(STAGING_DATABASE,tablename)
+    ddl_str= "CREATE EXTERNAL TABLE IF NOT EXISTS {0}.{1} ( \n {2}) ".format(STAGING_DATABASE,tablename,columns)
     ddl_str+="\n STORED AS PARQUET \n LOCATION '{0}';".format(input_file)
 
     print(drop_sql)
@@ -158,7 +200,7 @@ def load_to_lake(spark,tgt_schema_name,table_name):
     #    castcolumns += f"CAST({row[0]} AS {row[1]} ) AS {row[0]}, "
     castcolumns = castcolumns.rstrip(',')
     create_sql = f"INSERT OVERWRITE {tgt_schema_name}.{lower_table_name} \nSELECT "
-    create_sql += f" {castcolumns}\nFROM blogstaging.{table_name};"
+    create_sql += f" {castcolumns}\nFROM {STAGING_DATABASE}.{table_name};"
 
 
     bucket_name =f"test-dms-replication-blog"
@@ -240,40 +282,117 @@ def load_to_lake(spark,tgt_schema_name,table_name):
     print(count_sql)
     spark.sql(count_sql).show()
 
-def main():
-    logging.info('Load from DMS to Lake Started')
-
+def configure_session(spark):
+    spark.conf.set('spark.sql.sources.partitionOverwriteMode', 'dynamic')
+    spark.conf.set('spark.sql.parquet.fs.optimized.committer.optimization-enabled', 'true')
+    spark.conf.set('spark.sql.parquet.output.committer.class', 'com.amazon.emr.committer.EmrOptimizedSparkSqlParquetOutputCommitter')
 
+def read_manifest(manifest_path):
+    # s3://bucket/key of a JSON list of tables
+    bucket, _, key = manifest_path.replace('s3://', '', 1).partition('/')
+    body = boto3.client('s3').get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    tables = json.loads(body)
+    return tables['tables'] if isinstance(tables, dict) else tables
+
+def get_tables(args):
+    # a single table from -src/-t, or a list of tables from --tables-json or --manifest
+    if args.tables_json:
+        tables = json.loads(args.tables_json)
+    elif args.manifest:
+        tables = read_manifest(args.manifest)
+    else:
+        tables = [{'schema_name': args.srcschema, 'table_name': args.table}]
+
+    return [{'src_schema_name': table.get('src_schema_name') or table.get('schema_name') or args.srcschema,
+             'table_name': table['table_name'],
+             'tgt_schema_name': table.get('tgt_schema_name') or args.tgtschema,
+             'primary_key': table.get('primary_key') or args.pk,
+             'pk_buckets': int(table.get('pk_buckets') or args.pk_buckets or 0)} for table in tables]
+
+def process_table(spark, table, env):
+    # Every table gets its own session of the shared SparkContext, the tables run concurrently and
+    # their SQL settings and temporary views must not collide
+    table_session = spark.newSession()
+    configure_session(table_session)
+    table_session.sparkContext.setJobGroup(table['table_name'], f"Load {table['src_schema_name']}.{table['table_name']}")
+
+    create_stg_table(table_session, table['src_schema_name'], table['table_name'], table['primary_key'], table['pk_buckets'], env)
+
+    load_to_lake(table_session, table['tgt_schema_name'], table['table_name'])
+
+def process_tables(spark, tables, env, max_workers):
+    # A failed table does not stop the others, every table reports its own status
+    results = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_table, spark, table, env): table for table in tables}
+        for future in as_completed(futures):
+            table = futures[future]
+            result = {'schema_name': table['src_schema_name'], 'table_name': table['table_name'], 'status': 'SUCCESS'}
+            # the load functions can call exit(), SystemExit is kept on the future as well
+            error = future.exception()
+            if error is not None:
+                logging.error(f"Load of {table['src_schema_name']}.{table['table_name']} failed: {error!r}")
+                result.update({'status': 'FAILED', 'error': repr(error)})
+            else:
+                logging.info(f"Load of {table['src_schema_name']}.{table['table_name']} completed")
+            results.append(result)
+
+    return results
+
+def write_results(results, results_path):
+    bucket, _, key = results_path.replace('s3://', '', 1).partition('/')
+    boto3.client('s3').put_object(Body=json.dumps(results), Bucket=bucket, Key=key)
+    logging.info(f'Table results written to {results_path}')
+
+def get_parser():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-src", "--srcschema", help="< Input Src Schema Name >")
     parser.add_argument("-t", "--table", help="< Input Table Name >")
     parser.add_argument("-tgt", "--tgtschema", help="< Input Tgt Schema Name >")
-    #parser.add_argument("-e", "--env", help="< Input Env Name >")
-    
+    parser.add_argument("-p", "--pk", help="< Input Primary Key Name >")
+    parser.add_argument("--tables-json", help="< JSON list of tables with schema_name, table_name and optionally tgt_schema_name, primary_key and pk_buckets >")
+    parser.add_argument("--manifest", help="< S3 path of a JSON list of tables >")
+    parser.add_argument("--max-workers", type=int, default=4, help="< Tables loaded concurrently >")
+    parser.add_argument("--results", help="< S3 path where the status of every table is written >")
+    parser.add_argument("--pk-buckets", type=int, default=0, help="< Primary key buckets the staging table is written in when the table has a primary key, 0 keeps the table over the DMS files >")
+    parser.add_argument("-e", "--env", help="< Input Env Name, names the staging bucket of the tables with primary key buckets >")
+    return parser
+
+def main():
+    logging.info('Load from DMS to Lake Started')
+
+
+    parser = get_parser()
     args = parser.parse_args()
-    src_schema_name = args.srcschema
-    table_name = args.table
-    tgt_schema_name = args.tgtschema
-    #env = args.env
+    tables = get_tables(args)
+    env = args.env
+    if not env and any(table['primary_key'] and table['pk_buckets'] for table in tables):
+        parser.error('-e is required to write the staging tables in primary key buckets')
 
     #sync_dms_stg_s3(src_schema_name,table_name,env)
 
+    # one session for all the tables, the FAIR scheduler keeps small tables from queueing behind a large one
     spark = SparkSession\
         .builder\
         .appName("DMStoLake") \
+        .config('spark.scheduler.mode', 'FAIR') \
         .enableHiveSupport() \
         .getOrCreate()
 
-    spark.conf.set('spark.sql.sources.partitionOverwriteMode', 'dynamic')
-    spark.conf.set('spark.sql.parquet.fs.optimized.committer.optimization-enabled', 'true')
-    spark.conf.set('spark.sql.parquet.output.committer.class', 'com.amazon.emr.committer.EmrOptimizedSparkSqlParquetOutputCommitter')
+    configure_session(spark)
 
     #read_dms_data(spark,src_schema_name,table_name,env)
 
-    create_stg_table(spark,src_schema_name,table_name)
+    results = process_tables(spark, tables, env, args.max_workers)
+    logging.info(f'Table results: {results}')
+    if args.results:
+        write_results(results, args.results)
 
-    load_to_lake(spark,tgt_schema_name,table_name)
+    failed_tables = [f"{result['schema_name']}.{result['table_name']}" for result in results if result['status'] == 'FAILED']
+    if failed_tables:
+        logging.error(f'Load failed for {failed_tables}')
+        sys.exit(1)
 
 
 
@@ -0,0 +1,77 @@
+import argparse
+import logging
+import time
+from pyspark.sql import SparkSession
+from pyspark.sql import functions as F
+
+from cdc_processing import MERGE_STRATEGIES, get_key_bytes, get_merge_strategy, get_unchanged_rows
+
+'''
+Compares the strategies of the CDC merge in cdc_processing.py on synthetic data, in local Spark:
+spark-submit --master 'local[*]' scripts/merge_benchmark.py --rows 20000000 --cdc-rows 1000 100000 5000000
+
+Every strategy keeps the staging rows without a change in the CDC batch and the rows are written to the noop
+sink, so the time is the time of the join.
+'''
+# Configure logging
+logformat = f'[%(asctime)s]: %(levelname)s: %(message)s'
+logging.basicConfig(format=logformat, datefmt='%Y-%m-%d %H:%M:%S')
+logging.getLogger().setLevel(logging.INFO)
+
+
+def get_staging_data(spark, rows):
+    return spark.range(rows).select(
+        F.col('id'),
+        F.concat(F.lit('name-'), F.col('id').cast('string')).alias('name'),
+        (F.col('id') % 1000).alias('dept_id'),
+        F.current_timestamp().alias('audit_upd_ts'))
+
+
+def get_cdc_data(spark, rows, cdc_rows):
+    # changed keys spread over the whole table, a tenth of them new rows
+    step = max(rows // cdc_rows, 1)
+    return spark.range(cdc_rows).select(
+        F.when(F.col('id') % 10 == 0, F.col('id') + rows).otherwise(F.col('id') * step).alias('id'),
+        F.lit('changed').alias('name'),
+        F.lit(0).cast('long').alias('dept_id'),
+        F.current_timestamp().alias('audit_upd_ts'),
+        F.lit('U').alias('op'))
+
+
+def run_strategy(spark, stg_data, cdc_data, strategy):
+    started = time.time()
+    unchanged = get_unchanged_rows(spark, stg_data, cdc_data, 'id', strategy)
+    unchanged.write.format('noop').mode('overwrite').save()
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000000, help="< Rows of the staging table >")
+    parser.add_argument("--cdc-rows", type=int, nargs='+', default=[1000, 100000, 2000000], help="< Keys of the CDC batches >")
+    parser.add_argument("--strategies", nargs='+', default=MERGE_STRATEGIES, help="< Merge strategies compared >")
+    parser.add_argument("--runs", type=int, default=3, help="< Runs per strategy, the fastest is reported >")
+    args = parser.parse_args()
+
+    spark = SparkSession.builder.appName("MergeBenchmark").getOrCreate()
+    stg_data = get_staging_data(spark, args.rows).persist()
+    stg_data.count()
+
+    results = []
+    for cdc_rows in args.cdc_rows:
+        cdc_data = get_cdc_data(spark, args.rows, cdc_rows).persist()
+        cdc_data.count()
+        chosen = get_merge_strategy(spark, cdc_rows, get_key_bytes(cdc_data, 'id'))
+        for strategy in args.strategies:
+            seconds = min(run_strategy(spark, stg_data, cdc_data, strategy) for _ in range(args.runs))
+            results.append((cdc_rows, strategy, seconds, strategy == chosen))
+            logging.info(f'{cdc_rows} CDC keys, {strategy}: {seconds:.2f}s')
+        cdc_data.unpersist()
+
+    print(f"{'cdc keys':>12} {'strategy':>14} {'seconds':>9} {'auto':>6}")
+    for cdc_rows, strategy, seconds, chosen in results:
+        print(f'{cdc_rows:>12} {strategy:>14} {seconds:>9.2f} {"*" if chosen else "":>6}')
+
+
+if __name__ == "__main__":
+    main()
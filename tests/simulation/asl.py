@@ -0,0 +1,178 @@
+import json
+import re
+import uuid
+
+
+# JSONPath subset used by the StfStack definitions: $.a.b, $['a'][0], $$.Map.Item.Value, $[*]
+PATH_SEGMENT = re.compile(r"\.([A-Za-z0-9_\-]+)|\['([^']*)'\]|\[(\d+)\]|\[(\*)\]")
+
+
+class StatesError(Exception):
+    def __init__(self, error, cause=''):
+        super().__init__(f'{error}: {cause}')
+        self.error = error
+        self.cause = cause
+
+
+def parse_path(path):
+    root = '$$' if path.startswith('$$') else '$'
+    rest = path[len(root):]
+    segments = []
+    position = 0
+    while position < len(rest):
+        match = PATH_SEGMENT.match(rest, position)
+        if not match:
+            raise StatesError('States.Runtime', f'Unsupported path {path}')
+        name, quoted, index, wildcard = match.groups()
+        if index is not None:
+            segments.append(int(index))
+        elif wildcard:
+            segments.append('*')
+        else:
+            segments.append(name if name is not None else quoted)
+        position = match.end()
+    return root, segments
+
+
+def read_path(path, data, context=None):
+    root, segments = parse_path(path)
+    value = context if root == '$$' else data
+    for position, segment in enumerate(segments):
+        if segment == '*':
+            return [read_path('$' + ''.join(format_segment(s) for s in segments[position + 1:]), item) for item in value]
+        try:
+            value = value[segment]
+        except (KeyError, IndexError, TypeError):
+            raise StatesError('States.Runtime', f'Path {path} not found in the input')
+    return value
+
+
+def format_segment(segment):
+    return f'[{segment}]' if isinstance(segment, int) else f"['{segment}']"
+
+
+def is_present(path, data):
+    try:
+        read_path(path, data)
+        return True
+    except StatesError:
+        return False
+
+
+def write_path(data, path, value):
+    # ResultPath: null discards the result, $ replaces the input
+    if path is None:
+        return data
+    root, segments = parse_path(path)
+    if not segments:
+        return value
+    data = json.loads(json.dumps(data)) if isinstance(data, dict) else {}
+    target = data
+    for segment in segments[:-1]:
+        if not isinstance(target.get(segment), dict):
+            target[segment] = {}
+        target = target[segment]
+    target[segments[-1]] = value
+    return data
+
+
+def split_arguments(arguments):
+    parts, depth, quoted, current = [], 0, False, ''
+    for char in arguments:
+        if char == "'" and not current.endswith('\\'):
+            quoted = not quoted
+        if not quoted and char == '(':
+            depth += 1
+        elif not quoted and char == ')':
+            depth -= 1
+        if char == ',' and depth == 0 and not quoted:
+            parts.append(current.strip())
+            current = ''
+        else:
+            current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def evaluate_intrinsic(expression, data, context):
+    name, _, arguments = expression.partition('(')
+    values = []
+    for argument in split_arguments(arguments[:-1]):
+        if argument.startswith('$'):
+            values.append(read_path(argument, data, context))
+        elif argument.startswith("'"):
+            values.append(argument[1:-1].replace("\\'", "'"))
+        elif argument.startswith('States.'):
+            values.append(evaluate_intrinsic(argument, data, context))
+        else:
+            values.append(json.loads(argument))
+
+    if name == 'States.Array':
+        return values
+    if name == 'States.UUID':
+        return str(uuid.uuid4())
+    if name == 'States.Format':
+        template = values[0]
+        for value in values[1:]:
+            template = template.replace('{}', value if isinstance(value, str) else json.dumps(value), 1)
+        return template
+    if name == 'States.StringToJson':
+        return json.loads(values[0])
+    if name == 'States.JsonToString':
+        return json.dumps(values[0])
+    raise StatesError('States.Runtime', f'Unsupported intrinsic function {name}')
+
+
+def apply_parameters(template, data, context):
+    # Parameters, ItemSelector and ResultSelector: keys ending with .$ take a path or an intrinsic function
+    if isinstance(template, dict):
+        resolved = {}
+        for key, value in template.items():
+            if key.endswith('.$'):
+                resolved[key[:-2]] = evaluate_intrinsic(value, data, context) if value.startswith('States.') \
+                    else read_path(value, data, context)
+            else:
+                resolved[key] = apply_parameters(value, data, context)
+        return resolved
+    if isinstance(template, list):
+        return [apply_parameters(value, data, context) for value in template]
+    return template
+
+
+COMPARISONS = {
+    'StringEquals': lambda value, expected: isinstance(value, str) and value == expected,
+    'StringLessThan': lambda value, expected: isinstance(value, str) and value < expected,
+    'StringGreaterThan': lambda value, expected: isinstance(value, str) and value > expected,
+    'NumericEquals': lambda value, expected: isinstance(value, (int, float)) and value == expected,
+    'NumericLessThan': lambda value, expected: isinstance(value, (int, float)) and value < expected,
+    'NumericLessThanEquals': lambda value, expected: isinstance(value, (int, float)) and value <= expected,
+    'NumericGreaterThan': lambda value, expected: isinstance(value, (int, float)) and value > expected,
+    'NumericGreaterThanEquals': lambda value, expected: isinstance(value, (int, float)) and value >= expected,
+    'BooleanEquals': lambda value, expected: isinstance(value, bool) and value == expected,
+}
+
+
+def evaluate_condition(rule, data, context):
+    if 'And' in rule:
+        return all(evaluate_condition(sub_rule, data, context) for sub_rule in rule['And'])
+    if 'Or' in rule:
+        return any(evaluate_condition(sub_rule, data, context) for sub_rule in rule['Or'])
+    if 'Not' in rule:
+        return not evaluate_condition(rule['Not'], data, context)
+
+    variable = rule['Variable']
+    if 'IsPresent' in rule:
+        return is_present(variable, data) == rule['IsPresent']
+    if not is_present(variable, data):
+        # a comparison on a missing variable fails the execution
+        raise StatesError('States.Runtime', f'Invalid path {variable}: the choice state could not find the field')
+    value = read_path(variable, data, context)
+    if 'IsNull' in rule:
+        return (value is None) == rule['IsNull']
+    for operator, compare in COMPARISONS.items():
+        if operator in rule:
+            return compare(value, rule[operator])
+        if f'{operator}Path' in rule:
+            return compare(value, read_path(rule[f'{operator}Path'], data, context))
+    raise StatesError('States.Runtime', f'Unsupported choice rule {rule}')
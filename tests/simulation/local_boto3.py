@@ -0,0 +1,108 @@
+import importlib.util
+import os
+import sys
+import types
+
+from tests.simulation.local_storage import ClientError
+
+
+LAMBDA_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'lambda'))
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'scripts'))
+
+
+class KeyCondition:
+    def __init__(self, expression, values):
+        self.expression = expression
+        self.values = values
+
+
+class Key:
+    """The equality key condition of boto3.dynamodb.conditions used by the Lambdas."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def eq(self, value):
+        return KeyCondition(f'{self.name} = :{self.name}', {f':{self.name}': value})
+
+
+class LocalBoto3:
+    """The services of a boto3 module backed by local stand-ins: DynamoDB tables by name and clients by service."""
+
+    def __init__(self, tables=None, clients=None):
+        self.tables = tables or {}
+        self.clients = clients or {}
+
+    def client(self, service_name, **kwargs):
+        return self.clients[service_name]
+
+    def resource(self, service_name, **kwargs):
+        assert service_name == 'dynamodb'
+        return self
+
+    def Table(self, name):
+        return self.tables[name]
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for table_name, request in RequestItems.items():
+            items = [self.tables[table_name].get_item(Key=key).get('Item') for key in request['Keys']]
+            responses[table_name] = [item for item in items if item]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+def build_modules(services):
+    # boto3 and botocore modules backed by the stand-ins
+    boto3 = types.ModuleType('boto3')
+    boto3.client = services.client
+    boto3.resource = services.resource
+    conditions = types.ModuleType('boto3.dynamodb.conditions')
+    conditions.Key = Key
+    exceptions = types.ModuleType('botocore.exceptions')
+    exceptions.ClientError = ClientError
+    return {'boto3': boto3, 'boto3.dynamodb': types.ModuleType('boto3.dynamodb'), 'boto3.dynamodb.conditions': conditions,
+            'botocore': types.ModuleType('botocore'), 'botocore.exceptions': exceptions}
+
+
+def install(monkeypatch, tables=None, clients=None):
+    # the Lambda modules are imported again against the stand-ins
+    services = LocalBoto3(tables, clients)
+    for name, module in build_modules(services).items():
+        monkeypatch.setitem(sys.modules, name, module)
+    for name, module in list(sys.modules.items()):
+        if os.path.dirname(os.path.abspath(getattr(module, '__file__', None) or '/')) == LAMBDA_DIR:
+            monkeypatch.delitem(sys.modules, name)
+    monkeypatch.syspath_prepend(LAMBDA_DIR)
+    return services
+
+
+def load_lambda(file_name, services=None):
+    # The handler files are named after their functions, e.g. create-dms-tasks.py, and cannot be imported
+    # by name. With services the handler is loaded against its own stand-ins and keeps them, sys.modules
+    # is left as it was, so the simulator can run handlers outside of pytest.
+    spec = importlib.util.spec_from_file_location(file_name.replace('-', '_'), os.path.join(LAMBDA_DIR, f'{file_name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    if services is None:
+        spec.loader.exec_module(module)
+        return module
+
+    modules = build_modules(services)
+    saved = {name: sys.modules.get(name) for name in modules}
+    sys.modules.update(modules)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        for name, saved_module in saved.items():
+            if saved_module is None:
+                sys.modules.pop(name, None)
+            else:
+                sys.modules[name] = saved_module
+    return module
+
+
+def load_script(file_name):
+    # the EMR scripts import boto3 at the top, they are loaded again after install()
+    spec = importlib.util.spec_from_file_location(file_name, os.path.join(SCRIPTS_DIR, f'{file_name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,155 @@
+import copy
+import re
+
+
+# Condition and key condition expressions of the form used by the Lambdas and scripts:
+# terms joined by AND / OR, without parentheses, AND binding closer than OR
+TERM = re.compile(r'^(attribute_exists|attribute_not_exists)\((\w+)\)$|^(\w+)\s*(=|<>|<=|>=|<|>)\s*(:\w+)$')
+COMPARE = {
+    '=': lambda left, right: left == right,
+    '<>': lambda left, right: left != right,
+    '<': lambda left, right: left < right,
+    '<=': lambda left, right: left <= right,
+    '>': lambda left, right: left > right,
+    '>=': lambda left, right: left >= right,
+}
+
+
+class ClientError(Exception):
+    """Stand-in of botocore.exceptions.ClientError, the service errors carry their code in response."""
+
+    def __init__(self, code, message=''):
+        super().__init__(f'An error occurred ({code}): {message}')
+        self.response = {'Error': {'Code': code, 'Message': message}}
+
+
+class ConditionalCheckFailedException(ClientError):
+    def __init__(self, message='The conditional request failed'):
+        super().__init__('ConditionalCheckFailedException', message)
+
+
+def evaluate(expression, item, values, names=None):
+    for placeholder, name in (names or {}).items():
+        expression = re.sub(f'{placeholder}\\b', name, expression)
+    return any(all(evaluate_term(term.strip(), item, values) for term in re.split(r'\s+AND\s+', alternative))
+               for alternative in re.split(r'\s+OR\s+', expression))
+
+
+def evaluate_term(term, item, values):
+    match = TERM.match(term)
+    if not match:
+        raise ValueError(f'Unsupported expression {term}')
+    function, function_attribute, attribute, operator, value = match.groups()
+    if function:
+        return (function_attribute in item) == (function == 'attribute_exists')
+    return attribute in item and COMPARE[operator](item[attribute], values[value])
+
+
+class LocalTable:
+    """In-memory stand-in of a boto3 DynamoDB Table resource: put_item, update_item (SET only), get_item,
+    delete_item and query."""
+
+    def __init__(self, partition_key, sort_key=None, page_size=100):
+        self.partition_key = partition_key
+        self.sort_key = sort_key
+        self.page_size = page_size
+        self.items = {}
+        self.calls = {}
+        # boto3 raises the conditional check failures from table.meta.client.exceptions
+        self.meta = type('Meta', (), {'client': type('Client', (), {'exceptions': type('Exceptions', (), {
+            'ConditionalCheckFailedException': ConditionalCheckFailedException})})})
+
+    def get_key(self, item):
+        return item[self.partition_key], item.get(self.sort_key) if self.sort_key else None
+
+    def record(self, call):
+        self.calls[call] = self.calls.get(call, 0) + 1
+
+    def check(self, key, condition, values, names):
+        if condition and not evaluate(condition, self.items.get(key, {}), values or {}, names):
+            raise ConditionalCheckFailedException()
+
+    def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None, ExpressionAttributeNames=None):
+        self.record('put_item')
+        self.check(self.get_key(Item), ConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames)
+        self.items[self.get_key(Item)] = copy.deepcopy(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeValues=None,
+                    ExpressionAttributeNames=None, ReturnValues=None):
+        self.record('update_item')
+        self.check(self.get_key(Key), ConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames)
+        action, _, assignments = UpdateExpression.strip().partition(' ')
+        if action.upper() != 'SET':
+            raise NotImplementedError(f'Only SET updates are supported, got {UpdateExpression}')
+        item = self.items.setdefault(self.get_key(Key), copy.deepcopy(Key))
+        for assignment in assignments.split(','):
+            name, _, value = (part.strip() for part in assignment.partition('='))
+            item[(ExpressionAttributeNames or {}).get(name, name)] = copy.deepcopy(ExpressionAttributeValues[value])
+        return {}
+
+    def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeValues=None, ExpressionAttributeNames=None):
+        self.record('delete_item')
+        self.check(self.get_key(Key), ConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames)
+        self.items.pop(self.get_key(Key), None)
+        return {}
+
+    def get_item(self, Key):
+        self.record('get_item')
+        item = self.items.get(self.get_key(Key))
+        return {'Item': copy.deepcopy(item)} if item else {}
+
+    def query(self, KeyConditionExpression, ExpressionAttributeValues=None, ExclusiveStartKey=None, **kwargs):
+        self.record('query')
+        if not isinstance(KeyConditionExpression, str):
+            # a boto3.dynamodb.conditions Key condition of the local boto3
+            KeyConditionExpression, ExpressionAttributeValues = KeyConditionExpression.expression, KeyConditionExpression.values
+        items = sorted((item for item in self.items.values()
+                        if evaluate(KeyConditionExpression, item, ExpressionAttributeValues)),
+                       key=lambda item: self.get_key(item))
+        if ExclusiveStartKey:
+            items = [item for item in items if self.get_key(item) > self.get_key(ExclusiveStartKey)]
+        response = {'Items': copy.deepcopy(items[:self.page_size])}
+        if len(items) > self.page_size:
+            last = items[self.page_size - 1]
+            response['LastEvaluatedKey'] = {key: last[key] for key in (self.partition_key, self.sort_key) if key}
+        return response
+
+
+class LocalBucket:
+    """In-memory stand-in of the list_objects_v2 paginator of a boto3 S3 client."""
+
+    def __init__(self, name, page_size=1000):
+        self.name = name
+        self.page_size = page_size
+        self.objects = {}
+        self.list_calls = 0
+
+    def put_object(self, Key, Body=b''):
+        self.objects[Key] = {'Key': Key, 'Size': len(Body)}
+
+    def get_paginator(self, operation):
+        assert operation == 'list_objects_v2'
+        return self
+
+    def paginate(self, Bucket, Prefix='', StartAfter='', Delimiter=None):
+        entries = []
+        for key in sorted(key for key in self.objects if key.startswith(Prefix) and key > StartAfter):
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                common_prefix = Prefix + rest.split(Delimiter)[0] + Delimiter
+                if not entries or entries[-1] != ('prefix', common_prefix):
+                    entries.append(('prefix', common_prefix))
+            else:
+                entries.append(('key', key))
+
+        for start in range(0, max(len(entries), 1), self.page_size):
+            self.list_calls += 1
+            page = {}
+            contents = [dict(self.objects[key]) for kind, key in entries[start:start + self.page_size] if kind == 'key']
+            common_prefixes = [{'Prefix': key} for kind, key in entries[start:start + self.page_size] if kind == 'prefix']
+            if contents:
+                page['Contents'] = contents
+            if common_prefixes:
+                page['CommonPrefixes'] = common_prefixes
+            yield page
@@ -0,0 +1,345 @@
+import copy
+import json
+import os
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+from .local_boto3 import LocalBoto3, load_lambda
+from .local_storage import ClientError, LocalTable
+
+
+# Simulated durations in seconds, a profile can override them for every table or per table in 'tables'
+DEFAULT_PROFILE = {
+    'create_seconds': 90,            # creating -> ready
+    'start_seconds': 30,             # starting -> running
+    'load_seconds': 600,             # running -> stopped of a full load
+    'emr_seconds': 300,              # job run submitted -> SUCCESS
+    'event_latency_seconds': 2,      # state change -> EventBridge event delivered to the task-state Lambda
+    'events_enabled': True,          # False simulates lost events, the waits then fall back to polling
+    'task_fails': False,
+    'emr_fails': False,
+    'expected_seconds': None,        # duration of earlier runs, as create-dms-tasks reads it from DynamoDB
+    'poll_min_seconds': 15,
+    'poll_max_seconds': 300,
+    'tables': {},
+}
+
+EPOCH = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+TOKEN_TABLE = 'task-token-table'
+
+# the simulated time of a handler call, the events of a wait reach the handler at their own time
+HandlerCall = namedtuple('HandlerCall', ['now', 'context', 'simulator', 'request'])
+
+LAMBDA_NAMES = ['get-splits-lambda', 'create-task-lambda', 'start-task-lambda', 'delete-task-lambda',
+                'task-state-lambda', 'migration-manifest-lambda']
+
+
+def to_timestamp(seconds):
+    return (EPOCH + timedelta(seconds=seconds)).isoformat()
+
+
+def normalize(name):
+    return ''.join(char for char in str(name).lower() if char.isalnum())
+
+
+class SimulatedServices:
+    """Local stand-ins for the DMS, EMR Serverless, DynamoDB and Step Functions calls of the workflows.
+
+    The task-state Lambda runs its own handler against stand-ins of its DMS, EMR Serverless, DynamoDB and
+    Step Functions clients. The Lambdas that work on the wall clock are replaced by their contract: what
+    they return and which service calls they make. Resource states only depend on the simulated clock.
+    """
+
+    def __init__(self, profile=None):
+        self.profile = dict(DEFAULT_PROFILE, **(profile or {}))
+        self.dms_tasks = {}
+        self.emr_jobs = {}
+        self.observed = {}
+        self.call = None
+        self.token_table = RecordedTable(self, 'resource_id')
+        self.task_state = load_lambda('task-state', LocalBoto3(
+            tables={TOKEN_TABLE: self.token_table},
+            clients={'dms': SimulatedDms(self), 'emr-serverless': SimulatedEmrServerless(self),
+                     'stepfunctions': SimulatedStepFunctions(self)}))
+
+    def get_profile(self, table_name):
+        return dict(self.profile, **self.profile['tables'].get(table_name or '', {}))
+
+    def record(self, context, api_call, count=1):
+        context.metrics.api_calls[api_call] += count
+
+    # DMS and EMR Serverless resources
+
+    def get_task_status(self, task, now):
+        if task['started_at'] is None:
+            return 'creating' if now < task['ready_at'] else 'ready'
+        if now < task['started_at'] + task['profile']['start_seconds']:
+            return 'starting'
+        if task['task_type'] == 'cdc' or now < task['stop_at']:
+            return 'running'
+        return 'failed' if task['profile']['task_fails'] else 'stopped'
+
+    def get_status_since(self, task, status):
+        # when the task entered the status, to measure how late the workflow noticed it
+        if status == 'ready':
+            return task['ready_at']
+        if status == 'running':
+            return task['started_at'] + task['profile']['start_seconds']
+        if status in ('stopped', 'failed'):
+            return task['stop_at']
+        return None
+
+    def get_job_state(self, job, now):
+        if now < job['end_at']:
+            return 'RUNNING'
+        return 'FAILED' if job['profile']['emr_fails'] else 'SUCCESS'
+
+    def observe(self, context, resource_id, status, since):
+        # the delay between a state change and the first time the workflow saw it
+        if since is not None and (resource_id, status) not in self.observed:
+            self.observed[(resource_id, status)] = context.now
+            context.metrics.detection_delay_seconds += max(context.now - since, 0)
+
+    def describe_task(self, context, arn):
+        task = self.dms_tasks[arn]
+        status = self.get_task_status(task, context.now)
+        self.observe(context, arn, status, self.get_status_since(task, status))
+        return {
+            'ReplicationTaskIdentifier': task['replication_task_id'],
+            'ReplicationTaskArn': arn,
+            'Status': status,
+            'ReplicationTaskStartDate': to_timestamp(task['started_at']) if task['started_at'] is not None else None,
+        }
+
+    def create_task(self, context, replication_task_id, event, load_share=1):
+        profile = self.get_profile(event.get('table_name'))
+        arn = f'arn:aws:dms:task:{replication_task_id}'
+        self.dms_tasks[arn] = {
+            'replication_task_id': replication_task_id,
+            'task_type': event['task_type'],
+            'profile': profile,
+            'load_seconds': profile['load_seconds'] * load_share,
+            'ready_at': context.now + profile['create_seconds'],
+            'started_at': None,
+            'stop_at': None,
+            'table_name': event.get('table_name'),
+        }
+        self.record(context, 'dms:CreateReplicationTask')
+        return arn
+
+    def start_task(self, context, arn):
+        task = self.dms_tasks[arn]
+        task['started_at'] = context.now
+        task['stop_at'] = context.now + task['profile']['start_seconds'] + task['load_seconds']
+        self.record(context, 'dms:StartReplicationTask')
+
+    # Lambda contracts
+
+    def invoke_lambda(self, function_name, payload, context, simulator):
+        name = next((name for name in LAMBDA_NAMES if normalize(name) in normalize(function_name)), None)
+        if name is None:
+            raise ValueError(f'No stand-in for the Lambda {function_name}')
+        context.metrics.lambda_invocations[name] += 1
+        event = copy.deepcopy(payload)
+        return getattr(self, name.replace('-', '_'))(event, context, simulator)
+
+    def get_splits_lambda(self, event, context, simulator):
+        event.setdefault('splits_json_data', None)
+        return event
+
+    def create_task_lambda(self, event, context, simulator):
+        profile = self.get_profile(event.get('table_name'))
+        self.record(context, 'dms:DescribeReplicationTasks')  # load of the instance pool
+        self.record(context, 'dynamodb:Query')  # run history for the task settings
+        event.update({'placement_status': 'placed', 'expected_seconds': profile['expected_seconds'],
+                      'task_started_at': None, 'task_reused': False})
+
+        if event.get('task_groups'):
+            group_count = int(event['task_groups'])
+            event['task_group'] = []
+            for index in range(group_count):
+                task_id = f'{event["replication_task_id"]}-{index + 1}'
+                event['task_group'].append({'replication_task_id': task_id, 'tables': [event.get('table_name')],
+                                            'ReplicationTaskArn': self.create_task(context, task_id, event, 1 / group_count)})
+            self.record(context, 'dynamodb:PutItem', group_count)
+            return event
+
+        event['ReplicationTaskArn'] = self.create_task(context, event['replication_task_id'], event)
+        self.record(context, 'dynamodb:PutItem')
+        return event
+
+    def start_task_lambda(self, event, context, simulator):
+        self.start_task(context, event['ReplicationTaskArn'])
+        event['task_started_at'] = to_timestamp(context.now)
+        self.record(context, 'dynamodb:UpdateItem', max(len(event.get('tables') or []), 1))
+        return event
+
+    def delete_task_lambda(self, event, context, simulator):
+        arns = [result['ReplicationTaskArn'] for result in event.get('TaskGroupResults', [])] or [event['ReplicationTaskArn']]
+        for arn in arns:
+            self.dms_tasks.pop(arn, None)
+        self.record(context, 'dms:DeleteReplicationTask', len(arns))
+        self.record(context, 'dynamodb:UpdateItem', len(arns))
+        return event
+
+    def get_task_details(self, arn, now):
+        # describe_replication_tasks as boto3 returns it, dates as datetime
+        task = self.dms_tasks[arn]
+        return {'ReplicationTaskIdentifier': task['replication_task_id'], 'ReplicationTaskArn': arn,
+                'Status': self.get_task_status(task, now),
+                'ReplicationTaskStartDate': EPOCH + timedelta(seconds=task['started_at']) if task['started_at'] is not None else None}
+
+    def get_transition_times(self, request, now):
+        # the status changes of the resource after now, each one sends an EventBridge state change event
+        if request['resource_type'] == 'emr-job':
+            times = [self.emr_jobs[request['resource_id']]['end_at']]
+        else:
+            task = self.dms_tasks[request['resource_id']]
+            times = [task['ready_at']]
+            if task['started_at'] is not None:
+                times.append(task['started_at'] + task['profile']['start_seconds'])
+                if task['task_type'] != 'cdc':
+                    times.append(task['stop_at'])
+        return sorted(time for time in times if time > now)
+
+    def get_state_change_event(self, request):
+        if request['resource_type'] == 'emr-job':
+            return {'detail-type': 'EMR Serverless Job Run State Change', 'source': 'aws.emr-serverless',
+                    'detail': {'jobRunId': request['resource_id']}}
+        return {'detail-type': 'DMS Replication Task State Change', 'source': 'aws.dms', 'resources': [request['resource_id']]}
+
+    @contextmanager
+    def handler_call(self, now, context, simulator, request):
+        # simulated time, metrics and environment seen by a real handler and its service calls
+        environment = {'task_token_table': TOKEN_TABLE, 'poll_min_seconds': str(self.profile['poll_min_seconds']),
+                       'poll_max_seconds': str(self.profile['poll_max_seconds'])}
+        saved = {name: os.environ.get(name) for name in environment}
+        os.environ.update(environment)
+        self.call = HandlerCall(now, context, simulator, request)
+        try:
+            yield
+        finally:
+            self.call = None
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+
+    def task_state_lambda(self, event, context, simulator):
+        with self.handler_call(context.now, context, simulator, event):
+            result = self.task_state.handler(copy.deepcopy(event), None)
+        if event.get('action') == 'poll':
+            if result['done']:
+                self.observe_request(context, event, result['status'])
+            return result
+
+        # the events still to come reach the handler at their simulated time, until one sends the token back
+        # or the token times out
+        if self.profile['events_enabled']:
+            deadline = simulator.token_deadlines.get(event['token'], float('inf'))
+            for transition_time in self.get_transition_times(event, context.now):
+                event_time = transition_time + self.profile['event_latency_seconds']
+                if simulator.tokens.get(event['token']) is not None or event_time > deadline:
+                    break
+                with self.handler_call(event_time, context, simulator, event):
+                    self.task_state.handler(self.get_state_change_event(event), None)
+        return result
+
+    def observe_request(self, context, request, status):
+        if request['resource_type'] == 'emr-job':
+            self.observe(context, request['resource_id'], status, self.emr_jobs[request['resource_id']]['end_at'])
+        else:
+            task = self.dms_tasks[request['resource_id']]
+            self.observe(context, request['resource_id'], status, self.get_status_since(task, status))
+
+    def migration_manifest_lambda(self, event, context, simulator):
+        raise ValueError('The migration parent workflow is not simulated, run the table executions directly')
+
+    # AWS SDK service integrations
+
+    def call_api(self, service, action, parameters, context, simulator):
+        self.record(context, f'{service}:{action}')
+        if service == 'databasemigration' and action == 'describeReplicationTasks':
+            arns = parameters['Filters'][0]['Values']
+            return {'ReplicationTasks': [self.describe_task(context, arn) for arn in arns if arn in self.dms_tasks]}
+        if service == 'databasemigration' and action == 'describeTableStatistics':
+            task = self.dms_tasks[parameters['ReplicationTaskArn']]
+            return {'TableStatistics': [{'TableName': task['table_name'], 'FullLoadRows': 0}]}
+        if service == 'emrserverless' and action == 'startJobRun':
+            job_run_id = f'job-{len(self.emr_jobs) + 1}'
+            profile = self.get_profile(get_job_table_name(parameters))
+            self.emr_jobs[job_run_id] = {'profile': profile, 'end_at': context.now + profile['emr_seconds']}
+            return {'JobRunId': job_run_id, 'ApplicationId': parameters.get('ApplicationId')}
+        if service == 'emrserverless' and action == 'getJobRun':
+            job = self.emr_jobs[parameters['JobRunId']]
+            state = self.get_job_state(job, context.now)
+            self.observe(context, parameters['JobRunId'], state, job['end_at'] if state != 'RUNNING' else None)
+            return {'JobRun': {'State': state}}
+        if service == 'sfn' and action == 'sendTaskSuccess':
+            simulator.send_task_result(parameters['TaskToken'], context.now, parameters.get('Output'))
+            return {}
+        if service == 'sfn' and action == 'sendTaskFailure':
+            simulator.send_task_result(parameters['TaskToken'], context.now,
+                                       error={'Error': parameters.get('Error', 'States.TaskFailed'), 'Cause': parameters.get('Cause', '')})
+            return {}
+        if service == 'sns' and action == 'publish':
+            return {'MessageId': 'message'}
+        raise ValueError(f'No stand-in for {service}:{action}')
+
+
+def get_job_table_name(parameters):
+    # the table of an EMR job run is the argument after -t
+    arguments = parameters.get('JobDriver', {}).get('SparkSubmit', {}).get('EntryPointArguments', [])
+    return arguments[arguments.index('-t') + 1] if '-t' in arguments else None
+
+
+class RecordedTable(LocalTable):
+    # the calls of the handlers count in the metrics of the execution
+    def __init__(self, services, partition_key, sort_key=None):
+        super().__init__(partition_key, sort_key)
+        self.services = services
+
+    def record(self, call):
+        super().record(call)
+        self.services.record(self.services.call.context, 'dynamodb:' + ''.join(part.title() for part in call.split('_')))
+
+
+class SimulatedDms:
+    def __init__(self, services):
+        self.services = services
+
+    def describe_replication_tasks(self, Filters, WithoutSettings=False):
+        call = self.services.call
+        self.services.record(call.context, 'dms:DescribeReplicationTasks')
+        return {'ReplicationTasks': [self.services.get_task_details(arn, call.now) for arn in Filters[0]['Values']
+                                     if arn in self.services.dms_tasks]}
+
+
+class SimulatedEmrServerless:
+    def __init__(self, services):
+        self.services = services
+
+    def get_job_run(self, applicationId, jobRunId):
+        call = self.services.call
+        self.services.record(call.context, 'emr-serverless:GetJobRun')
+        return {'jobRun': {'state': self.services.get_job_state(self.services.emr_jobs[jobRunId], call.now)}}
+
+
+class SimulatedStepFunctions:
+    def __init__(self, services):
+        self.services = services
+
+    def send_task_success(self, taskToken, output):
+        # the execution sees the status when it resumes, which may be later than the call
+        call = self.services.call
+        self.services.record(call.context, 'states:SendTaskSuccess')
+        details = json.loads(output)
+        status = details['ReplicationTasks'][0]['Status'] if 'ReplicationTasks' in details else details['JobRun']['State']
+        if not call.simulator.send_task_result(taskToken, call.now, details, on_resume=lambda resume_context:
+                                               self.services.observe_request(resume_context, call.request, status)):
+            raise ClientError('TaskTimedOut', 'Task Timed Out')
+        return {}
+
@@ -0,0 +1,361 @@
+import argparse
+import copy
+import heapq
+import json
+import re
+import sys
+from collections import Counter
+
+from .asl import StatesError, apply_parameters, evaluate_condition, read_path, write_path
+from .stand_ins import SimulatedServices
+
+
+MAX_TRANSITIONS = 100000
+
+
+def normalize(name):
+    return re.sub('[^a-z0-9]', '', str(name).lower())
+
+
+def resolve_intrinsic_refs(value):
+    # Fn::Join parts of a synthesized DefinitionString, references keep the logical id or parameter name
+    if isinstance(value, str):
+        return value
+    if 'Ref' in value:
+        return value['Ref']
+    if 'Fn::GetAtt' in value:
+        return value['Fn::GetAtt'][0]
+    if 'Fn::Join' in value:
+        separator, parts = value['Fn::Join']
+        return separator.join(resolve_intrinsic_refs(part) for part in parts)
+    return json.dumps(value)
+
+
+def load_definitions(template_path):
+    # state machine definitions of a template synthesized by `cdk synth`, by logical id and by name
+    with open(template_path) as template_file:
+        template = json.load(template_file)
+
+    definitions = {}
+    for logical_id, resource in template.get('Resources', {}).items():
+        if resource['Type'] != 'AWS::StepFunctions::StateMachine':
+            continue
+        properties = resource['Properties']
+        definition = properties.get('DefinitionString') or properties.get('Definition')
+        if not isinstance(definition, dict) or 'StartAt' not in definition:
+            definition = json.loads(resolve_intrinsic_refs(definition))
+        definitions[logical_id] = definition
+        if isinstance(properties.get('StateMachineName'), str):
+            definitions[properties['StateMachineName']] = definition
+    return definitions
+
+
+class Metrics:
+    def __init__(self):
+        self.transitions = 0
+        self.wait_seconds = 0
+        self.token_wait_seconds = 0
+        self.detection_delay_seconds = 0
+        self.api_calls = Counter()
+        self.lambda_invocations = Counter()
+        self.states = Counter()
+
+    def merge(self, other):
+        self.transitions += other.transitions
+        self.wait_seconds += other.wait_seconds
+        self.token_wait_seconds += other.token_wait_seconds
+        self.detection_delay_seconds += other.detection_delay_seconds
+        self.api_calls.update(other.api_calls)
+        self.lambda_invocations.update(other.lambda_invocations)
+        self.states.update(other.states)
+
+    def to_dict(self):
+        return {
+            'transitions': self.transitions,
+            'wait_seconds': self.wait_seconds,
+            'token_wait_seconds': self.token_wait_seconds,
+            'detection_delay_seconds': self.detection_delay_seconds,
+            'api_calls': dict(self.api_calls),
+            'lambda_invocations': dict(self.lambda_invocations),
+        }
+
+
+class Context:
+    # simulated clock and metrics of one branch of an execution, Map iterations run on forks
+    def __init__(self, now, metrics, execution):
+        self.now = now
+        self.metrics = metrics
+        self.execution = execution
+
+    def fork(self, now):
+        return Context(now, Metrics(), self.execution)
+
+
+class StateMachineSimulator:
+    """Runs Amazon States Language definitions on a simulated clock against SimulatedServices."""
+
+    def __init__(self, definitions, services=None, lambda_seconds=1, api_seconds=0.2):
+        self.definitions = definitions
+        self.services = services or SimulatedServices()
+        self.lambda_seconds = lambda_seconds
+        self.api_seconds = api_seconds
+        self.tokens = {}
+        # simulated time a token wait times out, later results are never seen
+        self.token_deadlines = {}
+        self.execution_count = 0
+
+    def get_definition(self, reference):
+        if reference in self.definitions:
+            return self.definitions[reference]
+        for name, definition in self.definitions.items():
+            if normalize(reference).endswith(normalize(name)) or normalize(name) in normalize(reference):
+                return definition
+        raise StatesError('States.Runtime', f'Unknown state machine {reference}')
+
+    def run(self, name, execution_input, start_time=0):
+        self.execution_count += 1
+        execution = {'Id': f'execution-{self.execution_count}', 'Input': execution_input, 'StartTime': start_time,
+                     'Name': name}
+        context = Context(start_time, Metrics(), execution)
+        result = {'state_machine': name, 'start_seconds': start_time}
+        try:
+            output = self.run_states(self.get_definition(name), execution_input, context)
+            result.update({'status': 'SUCCEEDED', 'output': output})
+        except StatesError as e:
+            result.update({'status': 'FAILED', 'error': e.error, 'cause': e.cause})
+        result.update({'end_seconds': context.now, 'duration_seconds': context.now - start_time,
+                       'metrics': context.metrics})
+        return result
+
+    def run_states(self, definition, data, context, context_object=None):
+        context_object = context_object or {'Execution': context.execution}
+        states = definition['States']
+        name = definition['StartAt']
+        while name is not None:
+            state = states[name]
+            context.metrics.transitions += 1
+            context.metrics.states[name] += 1
+            if context.metrics.transitions > MAX_TRANSITIONS:
+                raise StatesError('Simulation.TooManyTransitions', f'Stopped in state {name}')
+            state_context = dict(context_object, State={'Name': name})
+            try:
+                data, name = self.run_state(state, data, context, state_context)
+            except StatesError as e:
+                catcher = next((catcher for catcher in state.get('Catch', [])
+                                if e.error in catcher['ErrorEquals'] or 'States.ALL' in catcher['ErrorEquals']), None)
+                if catcher is None or e.error == 'Simulation.TooManyTransitions':
+                    raise
+                data = write_path(data, catcher.get('ResultPath', '$'), {'Error': e.error, 'Cause': e.cause})
+                name = catcher['Next']
+        return data
+
+    def get_next(self, state):
+        return None if state.get('End') else state.get('Next')
+
+    def finish(self, state, data, result, context_object):
+        if 'ResultSelector' in state:
+            result = apply_parameters(state['ResultSelector'], result, context_object)
+        output = write_path(data, state.get('ResultPath', '$'), result)
+        if state.get('OutputPath', '$') is None:
+            return {}
+        return read_path(state.get('OutputPath', '$'), output, context_object)
+
+    def get_effective_input(self, state, data, context_object, parameters_key='Parameters'):
+        effective = {} if state.get('InputPath', '$') is None else read_path(state.get('InputPath', '$'), data, context_object)
+        if parameters_key in state:
+            effective = apply_parameters(state[parameters_key], effective, context_object)
+        return effective
+
+    def run_state(self, state, data, context, context_object):
+        state_type = state['Type']
+        if state_type == 'Pass':
+            effective = self.get_effective_input(state, data, context_object)
+            result = state['Result'] if 'Result' in state else effective
+            return self.finish(state, data, result, context_object), self.get_next(state)
+
+        if state_type == 'Wait':
+            effective = {} if state.get('InputPath', '$') is None else read_path(state.get('InputPath', '$'), data)
+            seconds = state['Seconds'] if 'Seconds' in state else read_path(state['SecondsPath'], effective, context_object)
+            context.now += seconds
+            context.metrics.wait_seconds += seconds
+            return read_path(state.get('OutputPath', '$'), data), self.get_next(state)
+
+        if state_type == 'Choice':
+            effective = {} if state.get('InputPath', '$') is None else read_path(state.get('InputPath', '$'), data)
+            for rule in state['Choices']:
+                if evaluate_condition(rule, effective, context_object):
+                    return read_path(state.get('OutputPath', '$'), effective), rule['Next']
+            if 'Default' not in state:
+                raise StatesError('States.NoChoiceMatched', 'No choice rule matched and there is no default')
+            return read_path(state.get('OutputPath', '$'), effective), state['Default']
+
+        if state_type == 'Succeed':
+            effective = {} if state.get('InputPath', '$') is None else read_path(state.get('InputPath', '$'), data)
+            return read_path(state.get('OutputPath', '$'), effective), None
+
+        if state_type == 'Fail':
+            raise StatesError(state.get('Error', 'States.Fail'), state.get('Cause', ''))
+
+        if state_type == 'Task':
+            if 'TimeoutSecondsPath' in state:
+                state = dict(state, TimeoutSeconds=read_path(state['TimeoutSecondsPath'], data, context_object))
+            if state['Resource'].endswith('.waitForTaskToken'):
+                token = f'token-{len(self.tokens) + 1}'
+                self.tokens[token] = None
+                if state.get('TimeoutSeconds'):
+                    self.token_deadlines[token] = context.now + self.lambda_seconds + state['TimeoutSeconds']
+                context_object = dict(context_object, Task={'Token': token})
+            effective = self.get_effective_input(state, data, context_object)
+            result = self.run_task(state, effective, context, context_object)
+            return self.finish(state, data, result, context_object), self.get_next(state)
+
+        if state_type == 'Map':
+            result = self.run_map(state, data, context, context_object)
+            return self.finish(state, data, result, context_object), self.get_next(state)
+
+        if state_type == 'Parallel':
+            start = context.now
+            results = []
+            for branch in state['Branches']:
+                branch_context = context.fork(start)
+                results.append(self.run_states(branch, data, branch_context, context_object))
+                context.metrics.merge(branch_context.metrics)
+                context.now = max(context.now, branch_context.now)
+            return self.finish(state, data, results, context_object), self.get_next(state)
+
+        raise StatesError('States.Runtime', f'Unsupported state type {state_type}')
+
+    def run_map(self, state, data, context, context_object):
+        # The iterations run one after the other on forked clocks, each starts when one of the
+        # MaxConcurrency slots is free, so the Map ends with the last iteration as on Step Functions.
+        effective = {} if state.get('InputPath', '$') is None else read_path(state.get('InputPath', '$'), data)
+        items = read_path(state.get('ItemsPath', '$'), effective, context_object)
+        iterator = state.get('ItemProcessor') or state['Iterator']
+        selector = state.get('ItemSelector') or state.get('Parameters')
+        concurrency = int(state.get('MaxConcurrency') or 0) or max(len(items), 1)
+
+        slots = [context.now] * min(concurrency, max(len(items), 1))
+        heapq.heapify(slots)
+        results = []
+        end = context.now
+        for index, item in enumerate(items):
+            map_context = dict(context_object, Map={'Item': {'Index': index, 'Value': item}})
+            item_input = apply_parameters(selector, effective, map_context) if selector else item
+            branch_context = context.fork(heapq.heappop(slots))
+            try:
+                results.append(self.run_states(iterator, item_input, branch_context, map_context))
+            finally:
+                context.metrics.merge(branch_context.metrics)
+            heapq.heappush(slots, branch_context.now)
+            end = max(end, branch_context.now)
+
+        context.now = end
+        return results
+
+    def run_task(self, state, parameters, context, context_object):
+        resource = state['Resource']
+        wait_for_token = resource.endswith('.waitForTaskToken')
+
+        if ':lambda:invoke' in resource:
+            context.now += self.lambda_seconds
+            response = self.services.invoke_lambda(parameters['FunctionName'], parameters.get('Payload', {}), context, self)
+            result = {'Payload': response, 'StatusCode': 200, 'ExecutedVersion': '$LATEST'}
+        elif not resource.startswith('arn:aws:states:'):
+            # payload_response_only invokes the function directly and returns its response
+            context.now += self.lambda_seconds
+            result = self.services.invoke_lambda(resource, parameters, context, self)
+        elif ':states:startExecution' in resource:
+            result = self.run_child_execution(resource, parameters, context)
+        elif ':aws-sdk:' in resource:
+            service, action = resource.split(':aws-sdk:')[1].split(':')[:2]
+            context.now += self.api_seconds
+            result = self.services.call_api(service, action.split('.')[0], parameters, context, self)
+        else:
+            raise StatesError('States.Runtime', f'Unsupported resource {resource}')
+
+        if wait_for_token:
+            return self.wait_for_token(context_object['Task']['Token'], state, context)
+        return result
+
+    def run_child_execution(self, resource, parameters, context):
+        context.now += self.api_seconds
+        child_input = parameters.get('Input', {})
+        if isinstance(child_input, str):
+            child_input = json.loads(child_input)
+        child = self.run(parameters['StateMachineArn'], child_input, start_time=context.now)
+        context.metrics.merge(child['metrics'])
+        context.metrics.api_calls['states:StartExecution'] += 1
+        if resource.endswith('.waitForTaskToken'):
+            return None
+        context.now = child['end_seconds']
+        if '.sync' not in resource:
+            return {'ExecutionArn': child.get('execution_arn', child['state_machine']), 'StartDate': child['start_seconds']}
+        if child['status'] != 'SUCCEEDED':
+            raise StatesError('States.TaskFailed', json.dumps({'Error': child['error'], 'Cause': child['cause']}))
+        output = child['output'] if resource.endswith(':2') else json.dumps(child['output'])
+        return {'Output': output, 'Status': child['status'], 'ExecutionArn': child['state_machine'],
+                'StartDate': child['start_seconds'] * 1000, 'StopDate': child['end_seconds'] * 1000}
+
+    def send_task_result(self, token, at_seconds, output=None, error=None, on_resume=None):
+        # called by the stand-ins, the first result of a token wins as on Step Functions
+        if token in self.tokens and self.tokens[token] is None:
+            self.tokens[token] = (at_seconds, output, error, on_resume)
+            return True
+        return False
+
+    def wait_for_token(self, token, state, context):
+        timeout = state.get('TimeoutSeconds') or state.get('HeartbeatSeconds')
+        resolution = self.tokens.pop(token)
+        if resolution is None or (timeout and resolution[0] > context.now + timeout):
+            if not timeout:
+                raise StatesError('Simulation.TokenNeverSent', 'The task token was never sent back')
+            context.now += timeout
+            context.metrics.token_wait_seconds += timeout
+            raise StatesError('States.Timeout', f'No result for the task token within {timeout} seconds')
+
+        at_seconds, output, error, on_resume = resolution
+        waited = max(at_seconds - context.now, 0)
+        context.now += waited
+        context.metrics.token_wait_seconds += waited
+        if on_resume:
+            on_resume(context)
+        if error:
+            raise StatesError(error['Error'], error.get('Cause', ''))
+        return output
+
+
+def format_report(results):
+    lines = [f'{"execution":<40} {"status":<10} {"seconds":>9} {"waits":>7} {"token":>7} {"delay":>7} '
+             f'{"states":>7} {"api":>5} {"lambda":>7}']
+    for label, result in results:
+        metrics = result['metrics']
+        lines.append(f'{label:<40} {result["status"]:<10} {result["duration_seconds"]:>9.0f} '
+                     f'{metrics.wait_seconds:>7.0f} {metrics.token_wait_seconds:>7.0f} '
+                     f'{metrics.detection_delay_seconds:>7.0f} {metrics.transitions:>7} '
+                     f'{sum(metrics.api_calls.values()):>5} {sum(metrics.lambda_invocations.values()):>7}')
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs a synthesized state machine against simulated services')
+    parser.add_argument('--template', required=True, help='nested stack template of the StfStack in cdk.out')
+    parser.add_argument('--state-machine', default='dms-app-load-dms-to-lake')
+    parser.add_argument('--input', required=True, help='JSON input or @file with a list of inputs')
+    parser.add_argument('--profile', help='JSON file with the simulated durations, see stand_ins.DEFAULT_PROFILE')
+    args = parser.parse_args(argv)
+
+    inputs = json.load(open(args.input[1:])) if args.input.startswith('@') else json.loads(args.input)
+    profile = json.load(open(args.profile)) if args.profile else {}
+    results = []
+    for execution_input in inputs if isinstance(inputs, list) else [inputs]:
+        simulator = StateMachineSimulator(load_definitions(args.template), SimulatedServices(profile))
+        result = simulator.run(args.state_machine, copy.deepcopy(execution_input))
+        label = f'{execution_input.get("schema_name", "")}.{execution_input.get("table_name", "")}'
+        results.append((label, result))
+        print(json.dumps(dict(result, metrics=result['metrics'].to_dict(), output=None), default=str), file=sys.stderr)
+
+    print(format_report(results))
+
+
+if __name__ == '__main__':
+    main()
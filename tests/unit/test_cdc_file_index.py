@@ -0,0 +1,88 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda'))
+
+from cdc_file_index import index_records, list_records
+from tests.simulation.local_storage import LocalBucket, LocalTable
+
+
+PREFIX = 'dmstarget/SALES/ORDERS'
+NEW_FILES = 'table_prefix = :prefix AND file_key > :watermark'
+
+
+def notification(key, sequencer, size=100, event_time=None):
+    record = {'eventName': 'ObjectCreated:Put', 's3': {'bucket': {'name': 'dms-bucket'},
+                                                       'object': {'key': key, 'size': size, 'sequencer': sequencer}}}
+    if event_time:
+        record['eventTime'] = event_time
+    return record
+
+
+def pending_files(table, watermark):
+    response = table.query(KeyConditionExpression=NEW_FILES,
+                           ExpressionAttributeValues={':prefix': PREFIX, ':watermark': watermark})
+    return [item['file_key'] for item in response['Items']]
+
+
+def test_notifications_index_cdc_files_by_table():
+    table = LocalTable('table_prefix', 'file_key')
+    records = [
+        notification(f'{PREFIX}/LOAD00000001.parquet', '0055AED6DCD90281E5'),
+        notification(f'{PREFIX}/20240102-120000001.parquet', '0055AED6DCD90281E6'),
+        notification('dmstarget/SALES/ITEMS/2024/01/03/20240103-120000001.parquet', '0055AED6DCD90281E7'),
+        notification('dmstarget/SALES/ORDER+LINES/20240102-120000001.parquet', '0055AED6DCD90281E8'),
+        notification('scripts/cdc_processing.py', '0055AED6DCD90281E9'),
+    ]
+
+    result = index_records(records, table, 'dmstarget', ttl_seconds=3600, now=1000)
+
+    assert result == {'indexed': 3, 'skipped': 2}
+    assert pending_files(table, '20240101-000000000.parquet') == ['20240102-120000001.parquet']
+    # date partition folders are part of the sort key
+    assert ('dmstarget/SALES/ITEMS', '2024/01/03/20240103-120000001.parquet') in table.items
+    assert ('dmstarget/SALES/ORDER LINES', '20240102-120000001.parquet') in table.items
+    assert table.items[(PREFIX, '20240102-120000001.parquet')]['expires_at'] == 4600
+    assert table.items[(PREFIX, '20240102-120000001.parquet')]['written_at'] == 1000
+
+
+def test_files_are_indexed_with_the_time_they_were_written():
+    table = LocalTable('table_prefix', 'file_key')
+    index_records([notification(f'{PREFIX}/20240102-120000001.parquet', '0055AED6DCD90281E6',
+                                event_time='2024-01-02T12:00:00.123Z')], table, 'dmstarget', 3600, now=1704200000)
+
+    # the notification of an earlier file can arrive later, the CDC processing waits on the write time
+    assert table.items[(PREFIX, '20240102-120000001.parquet')]['written_at'] == 1704196800
+    assert table.items[(PREFIX, '20240102-120000001.parquet')]['indexed_at'] == 1704200000
+
+
+def test_out_of_order_notifications_keep_the_latest_object():
+    table = LocalTable('table_prefix', 'file_key')
+    key = f'{PREFIX}/20240102-120000001.parquet'
+
+    index_records([notification(key, '0055AED6DCD90281F0', size=200)], table, 'dmstarget', 3600)
+    # an earlier write of the same key delivered late, and a sequencer of more digits
+    result = index_records([notification(key, '0055AED6DCD90281E0', size=100)], table, 'dmstarget', 3600)
+    assert result == {'indexed': 0, 'skipped': 1}
+    index_records([notification(key, '10055AED6DCD90281E0', size=300)], table, 'dmstarget', 3600)
+
+    assert table.items[(PREFIX, '20240102-120000001.parquet')]['size'] == 300
+
+
+def test_backfill_indexes_files_after_the_watermark_only():
+    bucket = LocalBucket('dms-bucket', page_size=10)
+    for minute in range(30):
+        bucket.put_object(Key=f'{PREFIX}/20240102-12{minute:02}00000.parquet', Body=b'cdc')
+    table = LocalTable('table_prefix', 'file_key', page_size=5)
+    index_records([notification(f'{PREFIX}/20240102-122900000.parquet', '0055AED6DCD90281F0', size=7)],
+                  table, 'dmstarget', 3600)
+
+    result = index_records(list_records(bucket, 'dms-bucket', PREFIX, '20240102-121900000.parquet'),
+                           table, 'dmstarget', 3600)
+
+    # ten files after the watermark, the one already indexed by its notification is kept
+    assert result == {'indexed': 9, 'skipped': 1}
+    assert bucket.list_calls == 1
+    assert len(table.items) == 10
+    assert table.items[(PREFIX, '20240102-122900000.parquet')]['size'] == 7
+    assert pending_files(table, '20240102-122400000.parquet') == [f'20240102-12{minute}00000.parquet' for minute in range(25, 30)]
@@ -0,0 +1,260 @@
+import os
+
+import pytest
+
+from tests.simulation.local_boto3 import install, load_script
+from tests.simulation.local_storage import ConditionalCheckFailedException, LocalBucket, LocalTable
+
+
+PREFIX = 'dmstarget/SALES/ORDERS'
+BUCKET = 'dms-bucket'
+
+
+@pytest.fixture
+def storage(monkeypatch):
+    pytest.importorskip('pyspark')
+    index = LocalTable('table_prefix', 'file_key', page_size=2)
+    bucket = LocalBucket(BUCKET)
+    install(monkeypatch, tables={'cdc-file-index': index}, clients={'s3': bucket})
+    return index, bucket
+
+
+def index_file(index, file_key, written_at):
+    index.put_item(Item={'table_prefix': PREFIX, 'file_key': file_key, 'written_at': written_at})
+
+
+def test_indexed_files_stop_at_the_first_file_within_the_settle_window(storage):
+    index, _ = storage
+    cdc_processing = load_script('cdc_processing')
+    index_file(index, '20240102-120000000.parquet', 1000)
+    index_file(index, '20240102-120100000.parquet', 1100)
+    index_file(index, '20240102-120200000.parquet', 1390)
+    # written before the file above, its notification arrived late
+    index_file(index, '20240102-120300000.parquet', 1000)
+    index.put_item(Item={'table_prefix': PREFIX, 'file_key': '20240102-115900000.parquet'})
+
+    files = cdc_processing.get_indexed_files('cdc-file-index', '20240102-115900000.parquet', BUCKET, PREFIX,
+                                             settle_seconds=300, now=1400)
+
+    assert files == [f's3://{BUCKET}/{PREFIX}/20240102-120000000.parquet', f's3://{BUCKET}/{PREFIX}/20240102-120100000.parquet']
+    # rows indexed before written_at was recorded are settled
+    assert len(cdc_processing.get_indexed_files('cdc-file-index', None, BUCKET, PREFIX, 300, now=1400)) == 3
+
+
+def test_gaps_longer_than_the_index_ttl_fail_when_the_index_misses_files(storage):
+    index, bucket = storage
+    cdc_processing = load_script('cdc_processing')
+    for minute in range(3):
+        bucket.put_object(Key=f'{PREFIX}/20240102-12{minute:02}00000.parquet', Body=b'cdc')
+    # the row of the first file after the mark expired
+    index_file(index, '20240102-120200000.parquet', 1000)
+
+    # processed within the ttl, the index is read without a listing
+    cdc_processing.check_index_gap('cdc-file-index', '20240102-120000000.parquet', 90000, BUCKET, PREFIX,
+                                   index_ttl=86400, settle_seconds=300, now=100000)
+    assert bucket.list_calls == 0
+
+    with pytest.raises(RuntimeError, match='1 files of dmstarget/SALES/ORDERS after 20240102-120000000.parquet'):
+        cdc_processing.check_index_gap('cdc-file-index', '20240102-120000000.parquet', 1000, BUCKET, PREFIX,
+                                       index_ttl=86400, settle_seconds=300, now=100000)
+
+    index_file(index, '20240102-120100000.parquet', 1000)
+    cdc_processing.check_index_gap('cdc-file-index', '20240102-120000000.parquet', None, BUCKET, PREFIX,
+                                   index_ttl=86400, settle_seconds=300, now=100000)
+
+
+class TransactionCanceledException(Exception):
+    pass
+
+
+class StateClient:
+    """The update_item and transact_write_items calls of update_processed_files on typed attribute values."""
+
+    exceptions = type('Exceptions', (), {'ConditionalCheckFailedException': ConditionalCheckFailedException,
+                                         'TransactionCanceledException': TransactionCanceledException})
+
+    def __init__(self):
+        self.tables = {'task-status': LocalTable('path', 'task_id'), 'cdc-batch': LocalTable('path', 'batch_end')}
+
+    def get_update(self, TableName, Key, ConditionExpression, ExpressionAttributeValues, **kwargs):
+        table = self.tables[TableName]
+        key, values = untyped(Key), untyped(ExpressionAttributeValues)
+        table.check(table.get_key(key), ConditionExpression, values, None)
+        item = dict(table.get_item(Key=key).get('Item', key))
+        item.pop('ListOfProcessedFiles', None)
+        item.update({'LastIncrementalFile': values[':last'], 'LastBatchAt': values[':now'],
+                     'BatchCount': item.get('BatchCount', values[':zero']) + values[':one']})
+        return table, item
+
+    def update_item(self, **update):
+        table, item = self.get_update(**update)
+        table.put_item(Item=item)
+
+    def transact_write_items(self, TransactItems):
+        try:
+            table, item = self.get_update(**TransactItems[0]['Update'])
+            put = TransactItems[1]['Put']
+            self.tables[put['TableName']].check(self.tables[put['TableName']].get_key(untyped(put['Item'])),
+                                                put['ConditionExpression'], {}, None)
+        except ConditionalCheckFailedException as e:
+            raise TransactionCanceledException(str(e))
+        table.put_item(Item=item)
+        self.tables[put['TableName']].put_item(Item=untyped(put['Item']))
+
+
+def untyped(values):
+    return {name: int(value['N']) if 'N' in value else value['S'] for name, value in values.items()}
+
+
+@pytest.fixture
+def state_client(monkeypatch):
+    pytest.importorskip('pyspark')
+    client = StateClient()
+    install(monkeypatch, clients={'dynamodb': client})
+    return client
+
+
+def processed(*file_keys):
+    return [f's3://{BUCKET}/{PREFIX}/{file_key}' for file_key in file_keys]
+
+
+def test_the_high_water_mark_only_moves_from_the_mark_the_run_read(state_client):
+    cdc_processing = load_script('cdc_processing')
+    path = f's3://{BUCKET}/{PREFIX}'
+    state = state_client.tables['task-status']
+    # an item of an earlier version, with the list of every processed file
+    state.put_item(Item={'path': path, 'task_id': 'task', 'ListOfProcessedFiles': ['20240102-115900000.parquet']})
+
+    assert cdc_processing.update_processed_files(processed('20240102-120100000.parquet', '20240102-120000000.parquet'),
+                                                 path, 'task-status', 'task', None) == '20240102-120100000.parquet'
+    cdc_processing.update_processed_files(processed('20240102-120200000.parquet'), path, 'task-status', 'task',
+                                          '20240102-120100000.parquet')
+
+    item = state.items[(path, 'task')]
+    assert item['LastIncrementalFile'] == '20240102-120200000.parquet'
+    assert item['BatchCount'] == 2
+    assert 'ListOfProcessedFiles' not in item
+
+    # a run that read the mark before the last batch is rejected and leaves the mark
+    with pytest.raises(ConditionalCheckFailedException):
+        cdc_processing.update_processed_files(processed('20240102-120200000.parquet'), path, 'task-status', 'task',
+                                              '20240102-120100000.parquet')
+    with pytest.raises(ConditionalCheckFailedException):
+        cdc_processing.update_processed_files(processed('20240102-120000000.parquet'), path, 'task-status', 'task', None)
+    assert state.items[(path, 'task')] == item
+
+
+def test_the_batch_record_is_written_with_the_high_water_mark(state_client):
+    cdc_processing = load_script('cdc_processing')
+    path = f's3://{BUCKET}/{PREFIX}'
+
+    cdc_processing.update_processed_files(processed('20240102-120000000.parquet', '20240102-120100000.parquet'), path,
+                                          'task-status', 'task', None, batch_table='cdc-batch', batch_ttl=3600)
+
+    batch = state_client.tables['cdc-batch'].items[(path, '20240102-120100000.parquet')]
+    assert batch['batch_start_after'] == '' and batch['first_file'] == '20240102-120000000.parquet'
+    assert batch['file_count'] == 2 and batch['expires_at'] == batch['processed_at'] + 3600
+
+    # the same batch again fails the transaction, the mark is not moved back
+    state_client.tables['task-status'].items[(path, 'task')]['LastIncrementalFile'] = ''
+    with pytest.raises(TransactionCanceledException):
+        cdc_processing.update_processed_files(processed('20240102-120100000.parquet'), path, 'task-status', 'task', '',
+                                              batch_table='cdc-batch', batch_ttl=3600)
+    assert state_client.tables['task-status'].items[(path, 'task')]['LastIncrementalFile'] == ''
+
+
+class SessionConf:
+    def __init__(self, **settings):
+        self.settings = settings
+
+    def get(self, name, default=None):
+        return self.settings.get(name, default)
+
+
+def session(**settings):
+    return type('Session', (), {'conf': SessionConf(**settings)})()
+
+
+def test_the_merge_strategy_follows_the_estimated_bytes_of_the_keys(monkeypatch):
+    pytest.importorskip('pyspark')
+    from pyspark.sql.types import LongType, StringType, StructField, StructType
+    install(monkeypatch)
+    cdc_processing = load_script('cdc_processing')
+    cdc_data = type('Data', (), {'schema': StructType([StructField('ID', LongType()), StructField('region', StringType()),
+                                                       StructField('name', StringType())])})()
+
+    assert cdc_processing.get_key_bytes(cdc_data, 'id') == 8
+    assert cdc_processing.get_key_bytes(cdc_data, 'id, region') == 28
+    assert cdc_processing.get_size_bytes('10485760b') == cdc_processing.get_size_bytes('10m') == 10485760
+    # 1M bigint keys fit in the default 10MB, 1M composite keys do not
+    assert cdc_processing.get_merge_strategy(session(), 1000000, 8) == 'broadcast'
+    assert cdc_processing.get_merge_strategy(session(), 1000000, 28) == 'shuffle_hash'
+    assert cdc_processing.get_merge_strategy(session(**{'spark.sql.autoBroadcastJoinThreshold': '64MB'}), 1000000, 28) == 'broadcast'
+    assert cdc_processing.get_merge_strategy(session(**{'spark.sql.autoBroadcastJoinThreshold': '-1'}), 10, 8) == 'shuffle_hash'
+    assert cdc_processing.get_merge_strategy(session(**{'spark.dms.cdc.mergeStrategy': 'not_in'}), 10, 8) == 'not_in'
+
+
+@pytest.fixture(scope='module')
+def spark(tmp_path_factory):
+    # local Spark with its own warehouse, the staging and dm tables of a test are tables of this catalog
+    pytest.importorskip('pyspark')
+    from pyspark.sql import SparkSession
+    session = SparkSession.builder.master('local[1]').appName('cdc-processing-test') \
+        .config('spark.sql.warehouse.dir', str(tmp_path_factory.mktemp('warehouse'))) \
+        .config('spark.sql.sources.partitionOverwriteMode', 'dynamic') \
+        .config('spark.sql.shuffle.partitions', '2') \
+        .getOrCreate()
+    yield session
+    session.stop()
+
+
+def get_bucket_files(location):
+    return {bucket: sorted(os.listdir(os.path.join(location, bucket))) for bucket in os.listdir(location)
+            if bucket.startswith('pk_bucket=')}
+
+
+def test_only_the_buckets_of_the_batch_keys_are_rewritten(spark, monkeypatch, tmp_path):
+    install(monkeypatch)
+    cdc_processing = load_script('cdc_processing')
+    monkeypatch.setattr(cdc_processing, 'get_staging_path', lambda env, path: str(tmp_path / path))
+    monkeypatch.setattr(cdc_processing, 'get_insert_stmt',
+                        lambda spark, schema_name, table_name, env: 'INSERT OVERWRITE blogdatamart.orders SELECT * FROM blog_staging.orders')
+    for database in ('blog_staging', 'blogdatamart'):
+        spark.sql(f'DROP DATABASE IF EXISTS {database} CASCADE')
+        spark.sql(f'CREATE DATABASE {database}')
+    spark.createDataFrame([(key, f'name-{key}') for key in range(20)], 'id long, name string').write.saveAsTable('blog_staging.orders')
+    spark.sql('CREATE TABLE blogdatamart.orders (id long, name string) USING PARQUET')
+
+    assert cdc_processing.bucket_staging_table(spark, 'orders', 'id', 16, 'test') == 16
+    assert cdc_processing.get_pk_buckets(spark, 'blog_staging.orders') == 16
+    assert spark.table('blog_staging.orders').columns == ['id', 'name', 'pk_bucket']
+    assert spark.table('blog_staging.orders').count() == 20
+    location = str(tmp_path / 'bucketed' / 'orders')
+    files = get_bucket_files(location)
+
+    # an update, a delete and an insert
+    batch = spark.createDataFrame([(1, 'changed', 'U', 1), (2, 'name-2', 'D', 1), (100, 'new', 'I', 1)],
+                                  'id long, name string, op string, rn int')
+    touched = {f'pk_bucket={row[0]}' for row in cdc_processing.add_pk_bucket(batch, 'id', 16).select('pk_bucket').distinct().collect()}
+    cdc_processing.load_stg_to_dm_buckets(spark, 'SALES', batch, 'orders', 'id', 'test', 16)
+
+    rows = {row.id: row.name for row in spark.table('blog_staging.orders').collect()}
+    assert len(rows) == 20 and rows[1] == 'changed' and rows[100] == 'new' and 2 not in rows
+    untouched = set(files) - touched
+    assert untouched and {bucket: files[bucket] for bucket in untouched} == \
+        {bucket: bucket_files for bucket, bucket_files in get_bucket_files(location).items() if bucket in untouched}
+    # the dm table is not bucketed, it reads the staging table without pk_bucket
+    assert spark.table('blogdatamart.orders').columns == ['id', 'name']
+    assert {row.id: row.name for row in spark.table('blogdatamart.orders').collect()} == rows
+
+
+@pytest.mark.parametrize('strategy', ['not_in', 'broadcast', 'shuffle_hash'])
+def test_every_merge_strategy_keeps_the_rows_of_a_composite_key_without_a_change(spark, monkeypatch, strategy):
+    install(monkeypatch)
+    cdc_processing = load_script('cdc_processing')
+    stg_data = spark.createDataFrame([(1, 'EU', 'a'), (1, 'US', 'b'), (2, 'EU', 'c')], 'id long, region string, name string')
+    cdc_data = spark.createDataFrame([(1, 'US', 'changed')], 'id long, region string, name string')
+
+    unchanged = cdc_processing.get_unchanged_rows(spark, stg_data, cdc_data, 'id, region', strategy)
+
+    assert sorted(row.name for row in unchanged.collect()) == ['a', 'c']
@@ -0,0 +1,167 @@
+import json
+
+import pytest
+
+from tests.simulation.local_boto3 import install, load_lambda
+from tests.simulation.local_storage import LocalTable
+
+
+@pytest.fixture
+def create_dms_tasks(monkeypatch):
+    install(monkeypatch)
+    return load_lambda('create-dms-tasks')
+
+
+def range_mappings(boundaries):
+    return json.dumps({'rules': [
+        {'rule-type': 'selection', 'rule-id': '1', 'rule-name': '1', 'rule-action': 'include',
+         'object-locator': {'schema-name': 'SALES', 'table-name': 'ORDERS'}},
+        {'rule-type': 'table-settings', 'rule-id': '2', 'rule-name': '2',
+         'object-locator': {'schema-name': 'SALES', 'table-name': 'ORDERS'},
+         'parallel-load': {'type': 'ranges', 'columns': ['AMOUNT'], 'boundaries': boundaries}},
+    ]})
+
+
+def get_lower_bounds(group_mappings):
+    return [[condition for rule_filter in json.loads(mappings)['rules'][0].get('filters', [])
+             for condition in rule_filter['filter-conditions'] if condition['filter-operator'] != 'ste']
+            for mappings in group_mappings]
+
+
+def test_integer_key_groups_start_after_the_previous_upper_bound(create_dms_tasks):
+    group_mappings = create_dms_tasks.split_task_group(range_mappings([['100'], ['200'], ['300'], ['400']]), 2,
+                                                       integer_key=True)
+
+    assert get_lower_bounds(group_mappings) == [[], [{'filter-operator': 'gte', 'value': '201'}]]
+
+
+def test_fractional_key_groups_keep_the_rows_above_the_previous_upper_bound(create_dms_tasks):
+    # a NUMBER(10,2) key has rows between 200 and 201, the next group excludes only 200 itself
+    group_mappings = create_dms_tasks.split_task_group(range_mappings([['100'], ['200'], ['300'], ['400']]), 2)
+
+    assert get_lower_bounds(group_mappings) == [[], [{'filter-operator': 'gte', 'value': '200'},
+                                                     {'filter-operator': 'noteq', 'value': '200'}]]
+
+
+def test_fan_out_reads_the_key_type_from_the_split_plan(create_dms_tasks):
+    event = {'replication_task_id': 'orders', 'schema_name': 'SALES', 'table_name': 'ORDERS', 'task_groups': 2,
+             'splits_json_data': range_mappings([['100.5'], ['200.5'], ['300.5']]),
+             'split_plan': {'key_family': 'numeric', 'integer_key': False}}
+
+    group_tasks = create_dms_tasks.get_fan_out_tasks(event)
+
+    assert [task_id for task_id, _, _ in group_tasks] == ['orders-g0', 'orders-g1']
+    assert get_lower_bounds([mappings for _, mappings, _ in group_tasks])[1][0] == {'filter-operator': 'gte', 'value': '200.5'}
+
+
+class ReuseDmsClient:
+    """DMS calls of create-dms-tasks, replication_tasks maps the task ARNs to their described state."""
+
+    def __init__(self, replication_tasks=None):
+        self.replication_tasks = replication_tasks or {}
+        self.calls = []
+
+    def describe_endpoints(self, Filters):
+        return {'Endpoints': [{'EndpointArn': f'arn:endpoint:{Filters[0]["Values"][0]}'}]}
+
+    def describe_replication_instances(self, Filters):
+        return {'ReplicationInstances': [{'ReplicationInstanceArn': f'arn:ri:{Filters[0]["Values"][0]}'}]}
+
+    def describe_replication_tasks(self, Filters, WithoutSettings):
+        task = self.replication_tasks.get(Filters[0]['Values'][0])
+        return {'ReplicationTasks': [task] if task else []}
+
+    def create_replication_task(self, **kwargs):
+        self.calls.append('create_replication_task')
+        return {'ReplicationTask': {'ReplicationTaskArn': f'arn:task:{kwargs["ReplicationTaskIdentifier"]}:new',
+                                    'Status': 'creating'}}
+
+    def modify_replication_task(self, **kwargs):
+        self.calls.append('modify_replication_task')
+        return {}
+
+
+DEFAULT_MAPPINGS = ('{"rules":[{"rule-type":"selection","rule-id":"1","rule-name":"1","object-locator":{"schema-name":"SALES",'
+                    '"table-name":"ORDERS"},"rule-action":"include"}]}')
+DEFAULT_SETTINGS = json.dumps({'FullLoadSettings': {'MaxFullLoadSubTasks': 49}, 'Logging': {'EnableLogging': True}})
+KEPT_TASK = {'ReplicationTaskArn': 'arn:task:orders:kept', 'ReplicationTaskIdentifier': 'orders',
+             'ReplicationInstanceArn': 'arn:ri:dms', 'Status': 'stopped', 'ReplicationTaskStartDate': '2024-01-01'}
+
+
+def create_task(monkeypatch, client, generation=None):
+    generations = LocalTable('replication_task_id')
+    if generation:
+        generations.put_item(Item=dict({'replication_task_id': 'orders', 'generation': 4, 'runs': 3,
+                                        'replication_task_arn': KEPT_TASK['ReplicationTaskArn']}, **generation))
+    install(monkeypatch, tables={'dms-tasks': LocalTable('taskid'), 'generations': generations}, clients={'dms': client})
+    for name, value in {'source_endpoint_id': 'source', 'destination_endpoint_id': 's3', 'replication_instance_id': 'dms',
+                        'dynamodb_table': 'dms-tasks', 'task_generation_table': 'generations', 'reuse_tasks': 'true'}.items():
+        monkeypatch.setenv(name, value)
+    create_dms_tasks = load_lambda('create-dms-tasks')
+
+    event = create_dms_tasks.main({'replication_task_id': 'orders', 'schema_name': 'SALES', 'table_name': 'ORDERS',
+                                   'task_type': 'full-load', 'splits_json_data': None})
+    return event, generations.items[('orders', None)]
+
+
+def get_default_config_hash(monkeypatch):
+    install(monkeypatch)
+    return load_lambda('create-dms-tasks').get_config_hash(DEFAULT_MAPPINGS, DEFAULT_SETTINGS)
+
+
+def test_unchanged_task_is_reused_without_a_modify(monkeypatch):
+    client = ReuseDmsClient({KEPT_TASK['ReplicationTaskArn']: KEPT_TASK})
+    config_hash = get_default_config_hash(monkeypatch)
+
+    event, generation = create_task(monkeypatch, client, {'config_hash': config_hash})
+
+    assert client.calls == []
+    assert event['task_reused'] and not event['task_modified']
+    assert event['ReplicationTaskArn'] == KEPT_TASK['ReplicationTaskArn']
+    # the task already ran, the next start reloads the target
+    assert event['start_type'] == 'reload-target'
+    assert (generation['generation'], generation['runs']) == (4, 4)
+
+
+def test_changed_mappings_modify_the_kept_task(monkeypatch):
+    client = ReuseDmsClient({KEPT_TASK['ReplicationTaskArn']: dict(KEPT_TASK, ReplicationTaskStartDate=None)})
+
+    event, generation = create_task(monkeypatch, client, {'config_hash': 'previous-mappings'})
+
+    assert client.calls == ['modify_replication_task']
+    assert event['task_modified'] and event['start_type'] == 'start-replication'
+    assert generation['generation'] == 5
+
+
+def test_task_deleted_outside_the_framework_is_created_again(monkeypatch):
+    client = ReuseDmsClient()
+
+    event, generation = create_task(monkeypatch, client, {'config_hash': 'previous-mappings'})
+
+    assert client.calls == ['create_replication_task']
+    assert not event['task_reused']
+    assert event['ReplicationTaskArn'] == 'arn:task:orders:new'
+    assert (generation['generation'], generation['runs'], generation['start_type']) == (5, 1, 'start-replication')
+
+
+def test_running_kept_task_is_not_reused(monkeypatch):
+    client = ReuseDmsClient({KEPT_TASK['ReplicationTaskArn']: dict(KEPT_TASK, Status='running')})
+
+    with pytest.raises(ValueError, match='cannot be reused before it stops'):
+        create_task(monkeypatch, client, {'config_hash': 'previous-mappings'})
+    assert client.calls == []
+
+
+def test_packed_tables_keep_the_primary_key_of_their_staging_buckets(monkeypatch):
+    install(monkeypatch, tables={'dms-tasks': LocalTable('taskid')})
+    monkeypatch.setenv('dynamodb_table', 'dms-tasks')
+    create_dms_tasks = load_lambda('create-dms-tasks')
+    tables = [{'schema_name': 'SALES', 'table_name': 'ORDERS', 'primary_key': 'ID', 'pk_buckets': 16, 'size_bytes': 10},
+              {'schema_name': 'SALES', 'table_name': 'CURRENCIES', 'size_bytes': 5}]
+
+    task_group = create_dms_tasks.create_task_group(ReuseDmsClient(), {'replication_task_id': 'sales', 'task_type': 'full-load'},
+                                                    [('sales-p0', DEFAULT_MAPPINGS, tables)], ['arn:ri:dms'],
+                                                    'arn:endpoint:source', 'arn:endpoint:s3', DEFAULT_SETTINGS)
+
+    assert task_group[0]['tables'] == [{'schema_name': 'SALES', 'table_name': 'ORDERS', 'primary_key': 'ID', 'pk_buckets': 16},
+                                       {'schema_name': 'SALES', 'table_name': 'CURRENCIES'}]
@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+from tests.simulation.local_boto3 import install
+from tests.simulation.local_storage import ClientError, LocalTable
+
+
+INSTANCE_ARN = 'arn:aws:dms:us-east-1:123456789012:rep:INSTANCE1'
+
+
+class DescribeClient:
+    def __init__(self, arns):
+        self.arns = arns
+        self.describe_calls = 0
+
+    def describe(self, Filters, list_key, arn_key):
+        self.describe_calls += 1
+        arn = self.arns.get(Filters[0]['Values'][0])
+        return {list_key: [{arn_key: arn}] if arn else []}
+
+    def describe_replication_instances(self, Filters):
+        return self.describe(Filters, 'ReplicationInstances', 'ReplicationInstanceArn')
+
+    def describe_replication_tasks(self, Filters):
+        return self.describe(Filters, 'ReplicationTasks', 'ReplicationTaskArn')
+
+
+@pytest.fixture
+def cache_table(monkeypatch):
+    table = LocalTable('resource_key')
+    install(monkeypatch, tables={'arn-cache': table})
+    monkeypatch.setenv('arn_cache_table', 'arn-cache')
+    return table
+
+
+def test_resolved_arns_are_cached_in_process_and_in_dynamodb(cache_table):
+    import dms_resolver
+
+    client = DescribeClient({'dms-instance': INSTANCE_ARN})
+    assert dms_resolver.resolve_arn(client, 'replication-instance', 'dms-instance') == INSTANCE_ARN
+    assert dms_resolver.resolve_arn(client, 'replication-instance', 'dms-instance') == INSTANCE_ARN
+
+    assert client.describe_calls == 1
+    assert cache_table.calls == {'get_item': 1, 'put_item': 1}
+    assert dms_resolver.resolver_stats['describe_calls_saved'] == 1
+    assert cache_table.items[('replication-instance:dms-instance', None)]['arn'] == INSTANCE_ARN
+
+
+def test_a_cold_container_reads_the_dynamodb_cache(cache_table):
+    import dms_resolver
+
+    cache_table.put_item(Item={'resource_key': 'replication-instance:dms-instance', 'arn': INSTANCE_ARN,
+                               'expires_at': int(time.time()) + 60})
+    client = DescribeClient({})
+
+    assert dms_resolver.resolve_arn(client, 'replication-instance', 'dms-instance') == INSTANCE_ARN
+    assert client.describe_calls == 0
+    assert dms_resolver.resolver_stats['dynamodb_hits'] == 1
+
+
+def test_expired_entries_are_described_again(cache_table):
+    import dms_resolver
+
+    # TTL deletes are lazy, an expired item is still returned by get_item
+    cache_table.put_item(Item={'resource_key': 'replication-instance:dms-instance', 'arn': 'arn:old',
+                               'expires_at': int(time.time()) - 60})
+    client = DescribeClient({'dms-instance': INSTANCE_ARN})
+
+    assert dms_resolver.resolve_arn(client, 'replication-instance', 'dms-instance') == INSTANCE_ARN
+    assert client.describe_calls == 1
+
+
+def test_stale_arns_are_invalidated_and_resolved_again(cache_table):
+    import dms_resolver
+
+    client = DescribeClient({'orders-task': 'arn:task:1'})
+    dms_resolver.resolve_arn(client, 'replication-task', 'orders-task')
+    # the task was deleted and created again by the next run
+    client.arns['orders-task'] = 'arn:task:2'
+
+    def start_task(arn):
+        if arn != 'arn:task:2':
+            raise ClientError('ResourceNotFoundFault', f'{arn} not found')
+        return arn
+
+    assert dms_resolver.call_with_arn(client, 'replication-task', 'orders-task', start_task) == 'arn:task:2'
+    assert dms_resolver.resolver_stats['invalidations'] == 1
+    assert cache_table.items[('replication-task:orders-task', None)]['arn'] == 'arn:task:2'
+
+
+def test_unknown_resources_are_not_cached(cache_table):
+    import dms_resolver
+
+    with pytest.raises(ValueError):
+        dms_resolver.resolve_arn(DescribeClient({}), 'replication-instance', 'missing')
+    assert not dms_resolver.arn_cache
+    assert not cache_table.items
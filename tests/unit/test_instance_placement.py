@@ -0,0 +1,110 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda'))
+
+from instance_placement import (
+    add_reservations,
+    get_active_tasks,
+    get_instance_loads,
+    get_reservations,
+    place_tasks,
+    release_reservations,
+    reserve_placements,
+)
+from tests.simulation.local_storage import LocalTable
+
+
+class FakeDmsClient:
+    def __init__(self, tasks, page_size=2):
+        self.tasks = tasks
+        self.page_size = page_size
+        self.calls = 0
+
+    def describe_replication_tasks(self, Filters, MaxRecords, Marker, WithoutSettings):
+        self.calls += 1
+        start = int(Marker or 0)
+        matching = [task for task in self.tasks if task['ReplicationInstanceArn'] in Filters[0]['Values']]
+        response = {'ReplicationTasks': matching[start:start + self.page_size]}
+        if start + self.page_size < len(matching):
+            response['Marker'] = str(start + self.page_size)
+        return response
+
+
+INSTANCES = [{'id': 'dms', 'arn': 'arn:ri:1', 'max_tasks': 2, 'max_bytes': 100},
+             {'id': 'dms-2', 'arn': 'arn:ri:2', 'max_tasks': 2, 'max_bytes': 100}]
+
+
+def dms_task(task_id, instance_arn, status):
+    return {'ReplicationTaskIdentifier': task_id, 'ReplicationInstanceArn': instance_arn, 'Status': status}
+
+
+def test_active_tasks_across_pages():
+    client = FakeDmsClient([dms_task('a', 'arn:ri:1', 'running'), dms_task('b', 'arn:ri:1', 'stopped'),
+                            dms_task('c', 'arn:ri:2', 'creating'), dms_task('d', 'arn:ri:3', 'running')])
+
+    active_tasks = get_active_tasks(client, ['arn:ri:1', 'arn:ri:2'])
+
+    assert [task['replication_task_id'] for task in active_tasks] == ['a', 'c']
+    assert client.calls == 2
+
+
+def test_place_on_least_loaded_instance():
+    client = FakeDmsClient([dms_task('a', 'arn:ri:1', 'running')])
+    loads = get_instance_loads(INSTANCES, get_active_tasks(client, ['arn:ri:1', 'arn:ri:2']), {'a': 80})
+
+    assert place_tasks(INSTANCES, loads, [30, 10]) == ['arn:ri:2', 'arn:ri:2']
+    assert place_tasks(INSTANCES, loads, [10, 10, 10]) == ['arn:ri:2', 'arn:ri:2', 'arn:ri:1']
+
+
+def test_queue_when_pool_is_full():
+    client = FakeDmsClient([dms_task(task_id, arn, 'running') for task_id, arn in
+                            [('a', 'arn:ri:1'), ('b', 'arn:ri:1'), ('c', 'arn:ri:2')]])
+    loads = get_instance_loads(INSTANCES, get_active_tasks(client, ['arn:ri:1', 'arn:ri:2']), {'c': 50})
+
+    assert place_tasks(INSTANCES, loads, [10]) == ['arn:ri:2']
+    assert place_tasks(INSTANCES, loads, [60]) is None
+    assert place_tasks(INSTANCES, loads, [10, 10]) is None
+
+
+def test_concurrent_placements_cannot_share_the_last_slot():
+    table = LocalTable('replication_task_id')
+    client = FakeDmsClient([dms_task('a', 'arn:ri:1', 'running'), dms_task('b', 'arn:ri:1', 'running'),
+                            dms_task('c', 'arn:ri:2', 'running')])
+    active_tasks = get_active_tasks(client, ['arn:ri:1', 'arn:ri:2'])
+    loads = get_instance_loads(INSTANCES, active_tasks, {})
+
+    # both executions read the reservations before either of them writes
+    first = get_reservations(table, ['arn:ri:1', 'arn:ri:2'], now=1000)
+    second = get_reservations(table, ['arn:ri:1', 'arn:ri:2'], now=1000)
+    first_placements = place_tasks(INSTANCES, add_reservations(loads, first, active_tasks), [10])
+    second_placements = place_tasks(INSTANCES, add_reservations(loads, second, active_tasks), [10])
+    assert first_placements == second_placements == ['arn:ri:2']
+
+    assert reserve_placements(table, first, ['d'], first_placements, [10], now=1000)
+    assert not reserve_placements(table, second, ['e'], second_placements, [10], now=1000)
+
+    # placed again, the second execution sees the reservation of the first and queues
+    second = get_reservations(table, ['arn:ri:1', 'arn:ri:2'], now=1001)
+    assert place_tasks(INSTANCES, add_reservations(loads, second, active_tasks), [10]) is None
+    # once created, the task is counted from DMS and its reservation is given back
+    release_reservations(table, 'arn:ri:2', ['d'], now=1002)
+    assert get_reservations(table, ['arn:ri:2'], now=1002)['arn:ri:2'] == {'version': 2, 'reserved': {}}
+
+
+def test_failed_group_reservations_are_released():
+    table = LocalTable('replication_task_id')
+    loads = get_instance_loads(INSTANCES, [], {})
+    stale = get_reservations(table, ['arn:ri:1', 'arn:ri:2'], now=1000)
+    assert reserve_placements(table, get_reservations(table, ['arn:ri:2'], now=1000), ['x'], ['arn:ri:2'], [10], now=1000)
+
+    # the group reserves arn:ri:1 first and loses the race on arn:ri:2
+    placements = place_tasks(INSTANCES, loads, [10, 10])
+    assert placements == ['arn:ri:1', 'arn:ri:2']
+    assert not reserve_placements(table, stale, ['g0', 'g1'], placements, [10, 10], now=1000)
+
+    reservations = get_reservations(table, ['arn:ri:1', 'arn:ri:2'], now=1000)
+    assert reservations['arn:ri:1']['reserved'] == {}
+    assert list(reservations['arn:ri:2']['reserved']) == ['x']
+    # reservations of tasks never created expire
+    assert get_reservations(table, ['arn:ri:2'], now=5000)['arn:ri:2']['reserved'] == {}
@@ -0,0 +1,156 @@
+import json
+import os
+import sqlite3
+import sys
+from datetime import date, datetime
+from decimal import Decimal
+
+import pytest
+
+from tests.simulation.local_boto3 import install, load_lambda
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda'))
+
+from split_dialects import get_dialect
+from split_estimators import (
+    build_estimated_rows,
+    estimate_skew,
+    format_key_value,
+    get_composite_ntile_splits,
+    get_interpolated_splits,
+    get_key_family,
+    get_split_cache_key,
+    is_integer_type,
+    merge_duplicate_boundaries,
+    resplit_heavy_segments,
+)
+
+
+@pytest.fixture
+def sqlite_source():
+    dialect = get_dialect('sqlite')
+    connection = dialect.connect({'db_name': ':memory:'})
+    cursor = connection.cursor()
+    cursor.execute('CREATE TABLE orders (order_id INTEGER)')
+    cursor.executemany('INSERT INTO orders VALUES (?)', [(i,) for i in range(1, 1001)])
+    return dialect, cursor
+
+
+def test_ntile_splits(sqlite_source):
+    dialect, cursor = sqlite_source
+    cursor.execute(dialect.ntile_sql('main', 'orders', 'order_id', 4))
+    rows = cursor.fetchall()
+
+    assert [row[4] for row in rows] == [250, 500, 750, 1000]
+    assert estimate_skew(rows) == 1.0
+
+
+def test_ntile_splits_above_lower_bound(sqlite_source):
+    dialect, cursor = sqlite_source
+    cursor.execute(dialect.ntile_sql('main', 'orders', 'order_id', 2, lower_bound=True), {'lower_bound': 800})
+    rows = cursor.fetchall()
+
+    assert [(row[3], row[4], row[5]) for row in rows] == [(801, 900, 100), (901, 1000, 100)]
+
+
+def test_interpolated_splits(sqlite_source):
+    dialect, cursor = sqlite_source
+    rows = get_interpolated_splits(dialect, cursor, 'main', 'orders', 'order_id', 4)
+
+    assert [row[4] for row in rows] == [250, 500, 750, 1000]
+
+
+def test_estimated_splits_of_decimal_keys():
+    # NUMBER and DECIMAL keys are returned as Decimal by the drivers
+    points = [(Decimal('0.5'), 0.0), (Decimal('500.5'), 0.5), (Decimal('1000.5'), 1.0)]
+    rows = build_estimated_rows('main', 'orders', 'amount', points, 1000, 4)
+
+    assert [row[4] for row in rows] == [250, 500, 750, 1000]
+    assert sum(row[5] for row in rows) == 1000
+
+
+def test_estimated_splits_keep_the_fractional_boundaries_of_decimal_keys():
+    # a NUMBER(10,2) key between 0.1 and 0.9 would truncate to the same boundary 0 in every segment
+    points = [(Decimal('0.10'), 0.0), (Decimal('0.90'), 1.0)]
+    rows = build_estimated_rows('main', 'prices', 'rate', points, 800, 4, integer_key=False)
+
+    assert [format_key_value(row[4]) for row in rows] == ['0.3', '0.5', '0.7', '0.9']
+    # the next segment starts above the previous boundary, the create-dms-tasks gte/noteq filters
+    assert [row[3] for row in rows] == [0.1, 0.3, 0.5, 0.7]
+    assert [row[5] for row in rows] == [200, 200, 200, 200]
+
+
+def test_interpolated_splits_of_a_decimal_key_column(monkeypatch, sqlite_source):
+    dialect, cursor = sqlite_source
+    cursor.execute('CREATE TABLE prices (rate DECIMAL(10,2))')
+    cursor.executemany('INSERT INTO prices VALUES (?)', [(index / 100,) for index in range(10, 91)])
+    install(monkeypatch)
+    get_splits = load_lambda('get-splits')
+
+    result = get_splits.get_table_splits(dialect, cursor, {'edp_owner': 'main', 'table_name': 'prices',
+                                                           'partition_key': 'rate', 'num_segments': 4,
+                                                           'split_method': 'interpolate'})
+
+    boundaries = json.loads(result['splits_json_data'])['rules'][1]['parallel-load']['boundaries']
+    assert boundaries == [['0.3'], ['0.5'], ['0.7'], ['0.9'], ['100000']]
+    assert result['split_plan']['integer_key'] is False
+
+
+def test_resplit_heavy_segments(sqlite_source):
+    dialect, cursor = sqlite_source
+    cursor.executemany('INSERT INTO orders VALUES (?)', [(2000 + i % 30,) for i in range(3000)])
+    rows = [('main', 'orders', 'order_id', 1, 1000, 1000, 1),
+            ('main', 'orders', 'order_id', 1001, 2029, 3000, 2)]
+
+    resplit_rows = resplit_heavy_segments(dialect, cursor, 'main', 'orders', 'order_id', rows, 1.2, 49)
+
+    assert len(resplit_rows) > len(rows)
+    assert [row[6] for row in resplit_rows] == list(range(1, len(resplit_rows) + 1))
+    assert sum(row[5] for row in resplit_rows) == 4000
+
+
+def test_merge_duplicate_boundaries():
+    rows = [('S', 'T', 'ID', 1, 10, 5, 1), ('S', 'T', 'ID', 10, 10, 5, 2), ('S', 'T', 'ID', 11, 20, 5, 3)]
+
+    assert merge_duplicate_boundaries(rows) == [('S', 'T', 'ID', 1, 10, 10, 1), ('S', 'T', 'ID', 11, 20, 5, 2)]
+
+
+def test_unsupported_source_type():
+    with pytest.raises(ValueError):
+        get_dialect('db2')
+
+
+def test_composite_key_splits(sqlite_source):
+    dialect, cursor = sqlite_source
+    cursor.execute('CREATE TABLE trades (business_date DATE, account_id INTEGER)')
+    cursor.executemany('INSERT INTO trades VALUES (?, ?)',
+                       [(f'2024-01-0{day}', account) for day in range(1, 5) for account in range(1, 101)])
+
+    rows = get_composite_ntile_splits(dialect, cursor, 'main', 'trades', ['business_date', 'account_id'], 8)
+
+    assert [row[4] for row in rows][:2] == [('2024-01-01', 50), ('2024-01-01', 100)]
+    assert sum(row[5] for row in rows) == 400
+    assert get_key_family(dialect.get_column_type(cursor, 'main', 'trades', 'business_date')) == 'datetime'
+
+
+def test_integer_key_types():
+    assert all(is_integer_type(data_type) for data_type in ('INTEGER', 'bigint', 'int(11) unsigned', 'int8'))
+    assert not any(is_integer_type(data_type) for data_type in ('NUMBER', 'numeric', 'DECIMAL(10,2)', 'FLOAT', 'POINT', None))
+
+
+def test_format_key_value():
+    assert format_key_value(datetime(2024, 1, 31, 23, 59, 59)) == '2024-01-31 23:59:59'
+    assert format_key_value(date(2024, 1, 31)) == '2024-01-31'
+    assert format_key_value(Decimal('1000')) == '1000'
+    assert format_key_value('ACME') == 'ACME'
+
+
+def test_split_cache_key_separates_methods():
+    ntile = get_split_cache_key('SALES', 'ORDERS', 'ORDER_ID', 8, 'ntile')
+    sample = get_split_cache_key('SALES', 'ORDERS', 'ORDER_ID', 8, 'sample', sample_percent=1)
+
+    assert len({ntile, sample, get_split_cache_key('SALES', 'ORDERS', 'ORDER_ID', 8, 'sample', sample_percent=5),
+                get_split_cache_key('SALES', 'ORDERS', 'ORDER_ID', 8, 'interpolate'),
+                get_split_cache_key('SALES', 'ORDERS', 'ORDER_ID', 8, 'ntile', skew_threshold=2.0)}) == 5
+    # the sample percent only matters to the sample method
+    assert get_split_cache_key('SALES', 'ORDERS', 'ORDER_ID', 8, 'ntile', sample_percent=5) == ntile
@@ -0,0 +1,158 @@
+import json
+
+import pytest
+
+from dms_migration_app import config
+from tests.simulation.asl import apply_parameters
+from tests.simulation.local_boto3 import install, load_script
+from tests.simulation.stf_simulator import StateMachineSimulator, load_definitions
+from tests.simulation.stand_ins import SimulatedServices
+
+
+LAMBDA = 'arn:aws:states:::lambda:invoke'
+LOAD_TO_LAKE = 'dms-app-load-dms-to-lake'
+TABLE = {'schema_name': 'SALES', 'table_name': 'ORDERS', 'tgt_schema_name': 'sales', 'tgt_table_name': 'orders',
+         'task_type': 'full-load', 'replication_task_id': 'sales-orders'}
+LAKE_INPUT = {'src_schema_name': 'SALES', 'src_table_name': 'ORDERS', 'tgt_schema_name': 'sales', 'primary_key': 'ID',
+              'replication_task_id': 'sales-orders', 'task_type': 'cdc'}
+LAMBDA_NAMES = ['task-state-lambda', 'get-splits-lambda', 'create-task-lambda', 'start-task-lambda',
+                'delete-task-lambda', 'migration-manifest-lambda']
+
+
+@pytest.fixture(scope='module')
+def definitions(tmp_path_factory):
+    # the state machines as `cdk synth` writes them for the StfStack, against imported Lambdas and tables
+    cdk = pytest.importorskip('aws_cdk')
+    from aws_cdk import assertions, aws_dynamodb as dynamodb, aws_lambda as _lambda
+    from dms_migration_app.stf_stack import StfStack
+
+    stack = cdk.Stack(cdk.App(), 'ApplicationStack', env={'account': '123456789012', 'region': 'us-east-1'})
+    props = {name.replace('-', '_'): _lambda.Function.from_function_name(stack, name, name) for name in LAMBDA_NAMES}
+    props.update({
+        'emr_application_id': 'emr-application',
+        'emr_role_arn': 'arn:aws:iam::123456789012:role/emr-job-role',
+        'cdc_file_index_table': dynamodb.Table.from_table_name(stack, 'cdc-file-index', 'cdc-file-index'),
+        'cdc_batch_table': dynamodb.Table.from_table_name(stack, 'cdc-batch', 'cdc-batch'),
+    })
+    stf_stack = StfStack(stack, 'Stf_stack', props=props)
+    template_path = tmp_path_factory.mktemp('cdk.out') / 'stf_stack.json'
+    template_path.write_text(json.dumps(assertions.Template.from_stack(stf_stack).to_json()))
+    return load_definitions(str(template_path))
+
+
+def run(definitions, profile=None):
+    simulator = StateMachineSimulator(definitions, SimulatedServices(profile))
+    return simulator.run(LOAD_TO_LAKE, dict(TABLE))
+
+
+def test_event_driven_waits_detect_the_state_changes_by_their_event(definitions):
+    event_driven = run(definitions)
+    polled = run(definitions, {'events_enabled': False})
+
+    assert event_driven['status'] == polled['status'] == 'SUCCEEDED'
+    # every state change is seen when its event arrives, without a poll of the task
+    assert 'Task Completion Poll State' not in event_driven['metrics'].states
+    assert polled['metrics'].states['Task Completion Poll State'] > 0
+    assert event_driven['metrics'].detection_delay_seconds < polled['metrics'].detection_delay_seconds
+    assert event_driven['duration_seconds'] < polled['duration_seconds']
+
+
+def test_lost_events_fall_back_to_polling_with_backoff(definitions):
+    result = run(definitions, {'events_enabled': False, 'task_fails': True, 'expected_seconds': 400})
+
+    assert result['status'] == 'FAILED'
+    # the failed task is seen by a poll after the tokens registered again timed out
+    assert result['metrics'].states['Task Completion Register Token Again'] > 0
+    assert result['metrics'].states['Task Completion Poll Result'] == 1
+
+
+def test_loads_longer_than_the_timeout_are_resumed_by_their_event(definitions):
+    result = run(definitions, {'load_seconds': 4000})
+
+    assert result['status'] == 'SUCCEEDED'
+    # the load outlives the first token, the event of the stopped task resumes a token registered again
+    assert result['metrics'].states['Task Completion Register Token Again'] > 0
+    assert 'Task Completion Poll Result' not in result['metrics'].states
+
+
+def wait_for_task(next_state):
+    # the creation wait of a task as a single token wait on the task-state Lambda
+    return {
+        'Type': 'Task', 'Resource': f'{LAMBDA}.waitForTaskToken', 'TimeoutSeconds': 1800,
+        'Parameters': {'FunctionName': 'task-state-lambda', 'Payload': {
+            'action': 'register', 'resource_type': 'dms-task', 'wait_for': 'creation', 'token.$': '$$.Task.Token',
+            'resource_id.$': '$.ReplicationTaskArn', 'task_type.$': '$.task_type'}},
+        'ResultPath': '$.ReplicationDetails', 'Next': next_state,
+    }
+
+
+def create_and_wait():
+    return {'StartAt': 'Create', 'States': {
+        'Create': {'Type': 'Task', 'Resource': LAMBDA, 'OutputPath': '$.Payload', 'Next': 'Wait For Task',
+                   'Parameters': {'FunctionName': 'create-task-lambda', 'Payload.$': '$'}},
+        'Wait For Task': wait_for_task('Ready'),
+        'Ready': {'Type': 'Pass', 'End': True},
+    }}
+
+
+def test_the_task_state_handler_sends_the_token_back_on_the_state_change_event():
+    services = SimulatedServices()
+    result = StateMachineSimulator({'create': create_and_wait()}, services).run('create', dict(TABLE))
+
+    assert result['status'] == 'SUCCEEDED'
+    assert result['output']['ReplicationDetails']['ReplicationTasks'][0]['Status'] == 'ready'
+    # ready 90s after the creation, resumed 2s later by the event
+    assert result['metrics'].detection_delay_seconds == 2
+    assert result['metrics'].api_calls['states:SendTaskSuccess'] == 1
+    assert services.token_table.items == {}
+
+
+def test_map_iterations_share_the_concurrency_slots():
+    definition = {'StartAt': 'Tables', 'States': {'Tables': {
+        'Type': 'Map', 'ItemsPath': '$.tables', 'MaxConcurrency': 2, 'End': True, 'Iterator': create_and_wait()}}}
+    tables = [dict(TABLE, table_name=f'T{index}', replication_task_id=f't{index}') for index in range(3)]
+    result = StateMachineSimulator({'batch': definition}, SimulatedServices()).run('batch', {'tables': tables})
+
+    single = StateMachineSimulator({'create': create_and_wait()}, SimulatedServices()).run('create', dict(TABLE))
+    assert result['status'] == 'SUCCEEDED'
+    assert len(result['output']) == 3
+    assert result['duration_seconds'] == 2 * single['duration_seconds']
+
+
+def get_job_arguments(definitions, state_name, data):
+    # the argument vector a job run of the lake processing starts the EMR script with
+    parameters = apply_parameters(definitions['dms-app-etl-processing']['States'][state_name]['Parameters'], data,
+                                  {'Execution': {'Name': 'execution'}})
+    return parameters['JobDriver']['SparkSubmit']['EntryPointArguments']
+
+
+def test_the_cdc_job_arguments_parse_with_the_script_parser(definitions, monkeypatch):
+    pytest.importorskip('pyspark')
+    install(monkeypatch)
+    cdc_processing = load_script('cdc_processing')
+
+    args = cdc_processing.get_parser().parse_args(get_job_arguments(definitions, 'SubmitCdcEmrServerlessStep', LAKE_INPUT))
+
+    assert (args.schema, args.table, args.pk, args.taskid) == ('SALES', 'ORDERS', 'ID', 'sales-orders')
+    assert (args.bucket, args.env) == (config.S3_BUCKET_NAME, config.ENV_NAME)
+    assert args.index_settle_seconds == config.CDC_FILE_INDEX_SETTLE_SECONDS
+    assert args.pk_buckets == config.CDC_PK_BUCKETS
+    assert cdc_processing.get_tables(args)[0]['task_id'] == 'sales-orders'
+
+
+def test_the_full_load_job_arguments_parse_with_the_script_parser(definitions, monkeypatch):
+    pytest.importorskip('pyspark')
+    install(monkeypatch)
+    fl_processing = load_script('fl_processing')
+    tables = [{'schema_name': 'SALES', 'table_name': 'ORDERS', 'primary_key': 'ID'},
+              {'schema_name': 'SALES', 'table_name': 'CURRENCIES'}]
+
+    single = fl_processing.get_parser().parse_args(
+        get_job_arguments(definitions, 'SubmitFlEmrServerlessStep', dict(LAKE_INPUT, task_type='full-load')))
+    packed = fl_processing.get_parser().parse_args(
+        get_job_arguments(definitions, 'SubmitMultiTableEmrServerlessStep', {'tgt_schema_name': 'sales', 'tables': tables}))
+
+    assert fl_processing.get_tables(single) == [{'src_schema_name': 'SALES', 'table_name': 'ORDERS', 'tgt_schema_name': 'sales',
+                                                 'primary_key': 'ID', 'pk_buckets': config.CDC_PK_BUCKETS}]
+    assert [table['primary_key'] for table in fl_processing.get_tables(packed)] == ['ID', None]
+    assert single.env == packed.env == config.ENV_NAME
@@ -0,0 +1,40 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda'))
+
+from task_packing import build_packed_mappings, pack_tables
+
+
+def test_pack_tables_respects_limits():
+    tables = [{'schema_name': 'SALES', 'table_name': f'T{i}', 'size_bytes': size}
+              for i, size in enumerate([60, 50, 40, 30, 20, 10, 150])]
+
+    tasks = pack_tables(tables, max_task_bytes=100, max_tables_per_task=3)
+
+    assert [task['tables'][0]['table_name'] for task in tasks][0] == 'T6'
+    assert all(len(task['tables']) <= 3 for task in tasks)
+    assert all(task['size_bytes'] <= 100 for task in tasks[1:])
+    assert sum(len(task['tables']) for task in tasks) == len(tables)
+    assert len(tasks) == 4
+
+
+def test_pack_tables_default_size():
+    tables = [{'schema_name': 'SALES', 'table_name': f'T{i}'} for i in range(5)]
+
+    tasks = pack_tables(tables, max_task_bytes=100, max_tables_per_task=10, default_table_bytes=40)
+
+    assert [len(task['tables']) for task in tasks] == [2, 2, 1]
+
+
+def test_build_packed_mappings_renumbers_rules():
+    tables = [{'schema_name': 'SALES', 'table_name': 'DIM_A'}, {'schema_name': 'SALES', 'table_name': 'FACT'}]
+    splits = {'FACT': {'splits_json_data': json.dumps({'rules': [
+        {'rule-type': 'selection', 'rule-id': '1', 'rule-name': '1'},
+        {'rule-type': 'table-settings', 'rule-id': '2', 'rule-name': '2'}]})}}
+
+    rules = json.loads(build_packed_mappings(tables, splits))['rules']
+
+    assert [rule['rule-id'] for rule in rules] == ['1', '2', '3']
+    assert rules[0]['object-locator'] == {'schema-name': 'SALES', 'table-name': 'DIM_A'}
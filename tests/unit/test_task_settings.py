@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from tests.simulation.local_boto3 import install, load_lambda
+from tests.simulation.local_storage import LocalTable
+
+
+PROFILES = {
+    'default': {'FullLoadSettings': {'CommitRate': 10000}, 'Logging': {'EnableLogging': False}},
+    'cdc': {'TargetMetadata': {'ParallelLoadBufferSize': 50}, 'ChangeProcessingTuning': {'BatchApplyEnabled': True}},
+    'wide': {'FullLoadSettings': {'CommitRate': 2000}, 'TargetMetadata': {'LobChunkSize': 64}},
+}
+
+
+@pytest.fixture
+def task_settings(monkeypatch):
+    table = LocalTable('taskid')
+    # the latest full load of ORDERS, 1 GB of 1 million rows of 1 KB
+    table.put_item(Item={'taskid': 'orders-1', 'tablename': 'ORDERS', 'schema_name': 'SALES', 'size_bytes': 1024 ** 3,
+                         'last_full_load_date': '01/01/2024 10:00:00', 'table_statistics': {'FullLoadRows': 1048576},
+                         'replication_details': {'ElapsedTimeMillis': 600000}})
+    install(monkeypatch, tables={'dms-tasks': table})
+    monkeypatch.setenv('task_settings_profiles', json.dumps(PROFILES))
+    monkeypatch.setenv('table_settings_profiles', json.dumps({'sales.orders': 'wide'}))
+    import task_settings
+    return task_settings
+
+
+def test_recommendations_override_the_default_profile(task_settings):
+    settings, report = task_settings.build_task_settings(
+        {'schema_name': 'SALES', 'table_name': 'ORDERS', 'task_type': 'full-load', 'settings_profile': None},
+        'dms-tasks')
+
+    assert report['recommendation'] == {'FullLoadSettings': {'CommitRate': 10240},
+                                        'TargetMetadata': {'ParallelLoadBufferSize': 51}}
+    assert report['expected_seconds'] == 600
+    # the table profile is looked up case insensitively and wins over the recommendation
+    assert report['profile'] == 'wide'
+    assert settings['FullLoadSettings'] == {'MaxFullLoadSubTasks': 49, 'CommitRate': 2000}
+    assert settings['TargetMetadata'] == {'ParallelLoadBufferSize': 51, 'LobChunkSize': 64}
+    assert settings['Logging'] == {'EnableLogging': False}
+
+
+def test_cdc_profile_then_execution_overrides_win(task_settings):
+    event = {'schema_name': 'SALES', 'table_name': 'CUSTOMERS', 'task_type': 'cdc',
+             'task_settings': {'TargetMetadata': {'ParallelLoadBufferSize': 10}}}
+
+    settings, report = task_settings.build_task_settings(event, 'dms-tasks')
+
+    assert report == {'history_runs': 0, 'profile': None, 'recommendation': {}}
+    assert settings['FullLoadSettings'] == {'MaxFullLoadSubTasks': 49, 'CommitRate': 10000}
+    assert settings['TargetMetadata'] == {'ParallelLoadBufferSize': 10}
+    assert settings['ChangeProcessingTuning'] == {'BatchApplyEnabled': True}
+
+
+def test_named_profile_wins_over_the_table_profile(task_settings):
+    event = {'schema_name': 'SALES', 'table_name': 'ORDERS', 'task_type': 'full-load', 'settings_profile': 'cdc'}
+
+    settings, report = task_settings.build_task_settings(event, 'dms-tasks')
+
+    assert report['profile'] == 'cdc'
+    assert settings['TargetMetadata'] == {'ParallelLoadBufferSize': 50}
+    assert settings['FullLoadSettings']['CommitRate'] == 10240
+
+    with pytest.raises(ValueError, match='Unknown task settings profile'):
+        task_settings.build_task_settings(dict(event, settings_profile='narrow'), 'dms-tasks')
+
+
+def test_the_size_recorded_at_the_creation_survives_the_start_of_the_task(monkeypatch):
+    table = LocalTable('taskid', 'tablename')
+    table.put_item(Item={'taskid': 'orders-1', 'tablename': 'ORDERS', 'schema_name': 'SALES', 'task_type': 'full-load',
+                         'task_status': 'creating', 'group_index': 0, 'size_bytes': 1024 ** 3})
+    install(monkeypatch, tables={'dms-tasks': table})
+    start_dms_tasks = load_lambda('start-dms-tasks')
+    import task_settings
+
+    start_dms_tasks.update_task_status({'ReplicationTaskIdentifier': 'orders-1', 'Status': 'starting',
+                                        'SourceEndpointArn': 'arn:endpoint:source', 'TargetEndpointArn': 'arn:endpoint:s3',
+                                        'ReplicationInstanceArn': 'arn:ri:dms', 'ReplicationTaskStartDate': '2024-01-01'},
+                                       'SALES', 'ORDERS', 'dms-tasks', 'full-load')
+    # the statistics delete-dms-tasks records at the end of the load
+    table.update_item(Key={'taskid': 'orders-1', 'tablename': 'ORDERS'},
+                      UpdateExpression='SET table_statistics = :stats, last_full_load_date = :date',
+                      ExpressionAttributeValues={':stats': {'FullLoadRows': 1048576}, ':date': '01/01/2024 10:00:00'})
+
+    item = table.items[('orders-1', 'ORDERS')]
+    assert (item['task_status'], item['group_index'], item['size_bytes']) == ('starting', 0, 1024 ** 3)
+    recommendation, report = task_settings.recommend_settings(task_settings.get_table_history('dms-tasks', 'SALES', 'ORDERS'))
+    assert report['avg_row_bytes'] == 1024
+    assert recommendation['FullLoadSettings'] == {'CommitRate': 10240}
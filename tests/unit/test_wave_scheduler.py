@@ -0,0 +1,48 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'lambda'))
+
+from wave_scheduler import build_waves, simulate, simulate_fifo
+
+
+def table(name, expected_seconds, **kwargs):
+    return dict({'schema_name': 'SALES', 'table_name': name, 'expected_seconds': expected_seconds}, **kwargs)
+
+
+def test_longest_table_first_shortens_the_batch():
+    # a six hour table listed last sets the length of a FIFO batch
+    tables = [table(f'SMALL_{i}', 3600) for i in range(6)] + [table('HUGE', 6 * 3600)]
+    waves = build_waves(tables)
+
+    assert waves[0]['tables'][0]['table_name'] == 'HUGE'
+    assert simulate(waves, 3)['makespan_seconds'] == 6 * 3600
+    assert simulate_fifo(tables, 3)['makespan_seconds'] == 8 * 3600
+
+
+def test_dependencies_run_in_later_waves():
+    tables = [table('ORDER_ITEMS', 100, depends_on=['sales.orders', 'SALES.ITEMS']),
+              table('ORDERS', 300, depends_on=['SALES.CUSTOMERS']),
+              table('CUSTOMERS', 50),
+              table('ITEMS', 200, depends_on=['REF.CURRENCIES'])]
+    waves = build_waves(tables)
+
+    assert [[t['table_name'] for t in wave['tables']] for wave in waves] == [['ITEMS', 'CUSTOMERS'], ['ORDERS'], ['ORDER_ITEMS']]
+    assert simulate(waves, 4)['makespan_seconds'] == 200 + 300 + 100
+
+    with pytest.raises(ValueError):
+        build_waves([table('A', 1, depends_on=['SALES.B']), table('B', 1, depends_on=['SALES.A'])])
+
+
+def test_priority_and_sla_order_the_wave():
+    tables = [table('LONG', 1000),
+              table('REPORTING', 100, sla_seconds=150),
+              table('URGENT', 10, priority=1)]
+    waves = build_waves(tables)
+    estimate = simulate(waves, 1)
+
+    assert [t['table_name'] for t in waves[0]['tables']] == ['URGENT', 'REPORTING', 'LONG']
+    assert estimate['sla_misses'] == []
+    assert simulate_fifo(tables, 1)['sla_misses'] == ['SALES.REPORTING']